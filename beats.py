@@ -0,0 +1,221 @@
+# Beat handling for the heart rate monitor
+# Peaks from the detector are turned into peak-to-peak intervals (PPI) and
+# heart rate values as soon as they arrive.
+from array import array
+
+
+PPI_MIN = 300 # Shortest valid PPI in ms (200 BPM)
+PPI_MAX = 2000 # Longest valid PPI in ms (30 BPM)
+CORRECTED = 1 # Flag of a beat changed by the BeatCorrector
+
+
+# Streaming artifact and ectopic beat correction
+# Each PPI is compared with the median of the latest accepted beats. A long interval
+# that is a multiple of the median is split (missed peaks), a short one is merged with
+# the next interval when together they make one normal beat (extra peak), and other
+# outliers are replaced by the median. Changed beats are flagged CORRECTED. Gaps of
+# PPI_MAX or more that are no such multiple are dropped and the reference is rebuilt.
+class BeatCorrector:
+    def __init__(self, window=7, tolerance=0.2, max_run=3):
+        self.window = window # Number of accepted beats in the reference median
+        self.tolerance = tolerance # Allowed relative deviation from the median
+        self.max_run = max_run # Consecutive corrections after which the reference is rebuilt
+        self.recent = array('H', bytes(2 * window)) # Latest accepted PPIs
+        self.scratch = array('H', bytes(2 * window)) # Sorted copy for the median
+        self.out = array('H', bytes(2 * 4)) # Beats produced by the last add()
+        self.out_flags = bytearray(4) # Flags of those beats
+        self.reset()
+
+    def reset(self):
+        self.head = 0 # Next slot of the reference ring
+        self.length = 0 # Number of beats in the reference ring
+        self.pending = 0 # Short interval waiting to be merged with the next one
+        self.run = 0 # Consecutive corrected beats
+
+    def median(self):
+        # Median of the reference beats
+        n = self.length
+        scratch = self.scratch
+        for i in range(n):
+            value = self.recent[i]
+            j = i
+            while j > 0 and scratch[j - 1] > value:
+                scratch[j] = scratch[j - 1]
+                j -= 1
+            scratch[j] = value
+        return scratch[n // 2]
+
+    def accept(self, ppi):
+        # Add a normal beat to the reference
+        self.recent[self.head] = ppi
+        self.head = (self.head + 1) % self.window
+        if self.length < self.window:
+            self.length += 1
+        self.run = 0
+
+    def emit(self, count, ppi, flag):
+        # Write count beats of length ppi to the output buffer
+        for i in range(count):
+            self.out[i] = ppi
+            self.out_flags[i] = flag
+        return count
+
+    def add(self, ppi):
+        # Add one raw PPI in ms, return the number of beats written to out/out_flags
+        if self.length < 3: # No reference yet, take plausible beats as they are
+            if PPI_MIN < ppi < PPI_MAX:
+                self.accept(ppi)
+                return self.emit(1, ppi, 0)
+            return 0
+
+        median = self.median()
+        limit = self.tolerance * median
+
+        if self.pending: # The previous interval was too short
+            pending = self.pending
+            self.pending = 0
+            if abs(pending + ppi - median) <= limit: # Extra peak: merge both intervals into one beat
+                self.run += 1
+                return self.emit(1, pending + ppi, CORRECTED)
+            self.run += 1
+            count = self.add(ppi) # Otherwise handle the current interval on its own
+            for i in range(count, 0, -1): # and put the median in front of it in place of the short one
+                self.out[i] = self.out[i - 1]
+                self.out_flags[i] = self.out_flags[i - 1]
+            self.out[0] = median
+            self.out_flags[0] = CORRECTED
+            return count + 1
+
+        if abs(ppi - median) <= limit: # Normal beat
+            self.accept(ppi)
+            return self.emit(1, ppi, 0)
+
+        if self.run >= self.max_run and PPI_MIN < ppi < PPI_MAX: # The rhythm changed, rebuild the reference
+            self.length = 0
+            self.head = 0
+            self.accept(ppi)
+            return self.emit(1, ppi, 0)
+
+        self.run += 1
+        if ppi > median:
+            missed = int(ppi / median + 0.5)
+            if missed >= 2 and missed <= 3 and abs(ppi - missed * median) <= limit: # Missed peaks: split evenly
+                return self.emit(missed, ppi // missed, CORRECTED)
+            if ppi >= PPI_MAX: # A gap of unknown beats (e.g. signal dropout), restart the reference
+                self.reset()
+                return 0
+            return self.emit(1, median, CORRECTED) # Outlier: replace by the median
+
+        self.pending = ppi # Possibly an extra peak, decide with the next interval
+        return 0
+
+
+# Event-driven beat stream with a fixed-capacity ring of PPI and heart rate values
+class BeatStream:
+    def __init__(self, capacity=32, sample_rate=250, smoothing='median', window=5, trim=1, corrector=None):
+        if smoothing not in ('median', 'trimmed', 'none'):
+            raise ValueError("smoothing must be 'median', 'trimmed' or 'none'")
+        self.capacity = capacity # Number of beats kept in the ring
+        self.sample_rate = sample_rate # Samples per second of the peak positions
+        self.smoothing = smoothing # How smoothed_hr() combines the latest heart rates
+        self.window = min(window, capacity) # Number of latest heart rates used for smoothing
+        self.trim = trim # Values dropped from each end for the trimmed mean
+        self.corrector = corrector # Optional BeatCorrector applied to each PPI
+        self.ppi = array('H', bytes(2 * capacity)) # PPI values in milliseconds
+        self.hr = array('H', bytes(2 * capacity)) # Heart rate values in BPM
+        self.flags = bytearray(capacity) # CORRECTED for beats changed by the corrector
+        self.scratch = array('H', bytes(2 * self.window)) # Sorted copy used for smoothing
+        self.reset()
+
+    def reset(self):
+        # Forget all beats
+        self.head = 0 # Next slot to write
+        self.length = 0 # Number of beats in the ring
+        self.count = 0 # Number of valid beats since reset
+        self.corrected = 0 # Number of those beats changed by the corrector
+        self.last_peak = None # Position of the previous peak in samples
+        if self.corrector:
+            self.corrector.reset()
+
+    def add_peak(self, position):
+        # Add a peak position (in samples), return the number of new beats (0 if none resulted)
+        last_peak = self.last_peak
+        self.last_peak = position
+        if last_peak is None:
+            return 0
+
+        ppi = int((position - last_peak) * 1000 / self.sample_rate + 0.5) # Interval in milliseconds
+        if not self.corrector:
+            if ppi <= PPI_MIN or ppi >= PPI_MAX: # Only consider heart rates between 30 and 200 BPM
+                return 0
+            self.store(ppi, 0)
+            return 1
+
+        added = 0
+        corrector = self.corrector
+        for i in range(corrector.add(ppi)):
+            ppi = corrector.out[i]
+            if PPI_MIN < ppi < PPI_MAX: # Only consider heart rates between 30 and 200 BPM
+                self.store(ppi, corrector.out_flags[i])
+                added += 1
+        return added
+
+    def store(self, ppi, flag):
+        # Append one beat to the ring
+        self.ppi[self.head] = ppi
+        self.hr[self.head] = (60000 + ppi // 2) // ppi
+        self.flags[self.head] = flag
+        self.head = (self.head + 1) % self.capacity
+        if self.length < self.capacity:
+            self.length += 1
+        self.count += 1
+        if flag:
+            self.corrected += 1
+
+    def ppi_at(self, age):
+        # PPI in milliseconds of the beat age steps back (0 is the latest)
+        return self.ppi[(self.head - 1 - age) % self.capacity]
+
+    def flag_at(self, age):
+        # Flag of the beat age steps back (0 is the latest)
+        return self.flags[(self.head - 1 - age) % self.capacity]
+
+    def latest_ppi(self):
+        # Most recent PPI in milliseconds, 0 if there is none
+        return self.ppi_at(0) if self.length else 0
+
+    def latest_hr(self):
+        # Most recent heart rate in BPM, 0 if there is none
+        return self.hr[(self.head - 1) % self.capacity] if self.length else 0
+
+    def smoothed_hr(self):
+        # Median or trimmed mean of the latest heart rates, 0 if there is none
+        n = min(self.length, self.window)
+        if n == 0:
+            return 0
+        if self.smoothing == 'none':
+            return self.latest_hr()
+
+        # Insertion sort of the latest n values into the scratch buffer
+        scratch = self.scratch
+        hr = self.hr
+        index = self.head
+        for i in range(n):
+            index = (index - 1) % self.capacity
+            value = hr[index]
+            j = i
+            while j > 0 and scratch[j - 1] > value:
+                scratch[j] = scratch[j - 1]
+                j -= 1
+            scratch[j] = value
+
+        if self.smoothing == 'median':
+            if n % 2:
+                return scratch[n // 2]
+            return (scratch[n // 2 - 1] + scratch[n // 2] + 1) // 2
+
+        trim = self.trim if n > 2 * self.trim else 0 # Trimmed mean
+        total = 0
+        for i in range(trim, n - trim):
+            total += scratch[i]
+        return (total + (n - 2 * trim) // 2) // (n - 2 * trim)
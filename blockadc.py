@@ -0,0 +1,155 @@
+# Block acquisition for the PPG sensor
+# The RP2040 ADC runs free and DMA fills two array('H') buffers in turn,
+# so the main loop receives whole blocks instead of one Piotimer callback per sample.
+from array import array
+
+
+# RP2040 ADC registers (datasheet chapter 4.9)
+ADC_BASE = 0x4004C000
+ADC_CS = ADC_BASE + 0x00 # Control and status
+ADC_FCS = ADC_BASE + 0x08 # FIFO control and status
+ADC_FIFO = ADC_BASE + 0x0C # FIFO read port
+ADC_DIV = ADC_BASE + 0x10 # Clock divider
+DREQ_ADC = 36 # DMA request line of the ADC FIFO
+ADC_CLOCK = 48000000 # ADC clock in Hz, one conversion takes 96 cycles
+MAX_DIV = 0xFFFF # Integer part of the divider is 16 bits wide
+
+
+# Base class with the double buffer handoff shared by the DMA driver and the host stand-in
+class BlockReader:
+    def __init__(self, block_size=50, oversample=4):
+        self.block_size = block_size # Number of output samples per block
+        self.oversample = oversample # Number of ADC conversions averaged into one output sample
+        raw_size = block_size * oversample
+        self.buffers = (array('H', bytes(2 * raw_size)), array('H', bytes(2 * raw_size))) # Raw 12-bit conversions
+        self.block = array('H', bytes(2 * block_size)) # Decimated block handed to the main loop
+        self.filled = 0 # Number of raw buffers completed, only written by the producer
+        self.taken = 0 # Number of raw buffers consumed, only written by the main loop
+        self.overruns = 0 # Number of blocks lost because the main loop fell behind
+
+    # Called by the producer when the raw buffer with the given index is full
+    def block_done(self, index):
+        self.filled += 1
+
+    # Return the next block scaled like ADC.read_u16(), or None if no block is ready
+    def get_block(self):
+        filled = self.filled
+        if filled == self.taken:
+            return None
+
+        if filled - self.taken > 1: # Older blocks were overwritten, skip to the newest one
+            self.overruns += filled - self.taken - 1
+            self.taken = filled - 1
+
+        raw = self.buffers[self.taken & 1]
+        self.taken += 1
+
+        # Average the oversampled conversions and scale 12-bit values to 16 bits
+        block = self.block
+        oversample = self.oversample
+        j = 0
+        for i in range(self.block_size):
+            total = 0
+            for k in range(j, j + oversample):
+                total += raw[k]
+            block[i] = (total << 4) // oversample
+            j += oversample
+        return block
+
+    # Drop blocks that are ready but not yet processed
+    def discard(self):
+        self.taken = self.filled
+
+
+# Free-running ADC with two chained DMA channels on the RP2040
+class DmaBlockReader(BlockReader):
+    def __init__(self, adc_channel, sample_rate=250, block_size=50, oversample=4):
+        super().__init__(block_size, oversample)
+        self.adc_channel = adc_channel # ADC input 0-3 (GPIO26-29)
+        self.sample_rate = sample_rate # Output sample rate in Hz
+        self.dma = None # DMA channels, claimed on start
+
+        divider = ADC_CLOCK // (sample_rate * oversample) - 1 # Conversion starts every divider + 1 cycles
+        if divider > MAX_DIV:
+            raise ValueError("sample_rate * oversample must be at least 733 Hz")
+        self.divider = divider
+
+    def start(self):
+        import rp2
+        from machine import mem32
+
+        # Configure the ADC: selected input, FIFO with DMA request, free-running at the requested rate
+        mem32[ADC_CS] = 1 | (self.adc_channel << 12) # Enable the ADC on the selected input
+        mem32[ADC_DIV] = self.divider << 8 # Integer divider, no fraction
+        mem32[ADC_FCS] = 1 | (1 << 3) | (1 << 24) | (1 << 10) | (1 << 11) # FIFO, DREQ at 1 entry, clear flags
+        while not mem32[ADC_FCS] & (1 << 8): # Empty stale FIFO entries
+            mem32[ADC_FIFO]
+
+        # Each channel fills one buffer and then triggers the other one
+        self.dma = (rp2.DMA(), rp2.DMA())
+        handlers = (self.dma_handler0, self.dma_handler1)
+        count = self.block_size * self.oversample
+        for i in range(2):
+            other = self.dma[1 - i].channel
+            ctrl = self.dma[i].pack_ctrl(size=1, inc_read=False, inc_write=True, treq_sel=DREQ_ADC, chain_to=other, irq_quiet=False)
+            self.dma[i].config(read=ADC_FIFO, write=self.buffers[i], count=count, ctrl=ctrl, trigger=(i == 0))
+            self.dma[i].irq(handlers[i])
+
+        mem32[ADC_CS] = 1 | (1 << 3) | (self.adc_channel << 12) # START_MANY: convert continuously
+
+    # DMA completion handlers re-arm the finished channel before it is chained again
+    def dma_handler0(self, dma):
+        dma.write = self.buffers[0]
+        self.block_done(0)
+
+    def dma_handler1(self, dma):
+        dma.write = self.buffers[1]
+        self.block_done(1)
+
+    def stop(self):
+        from machine import mem32
+
+        mem32[ADC_CS] = 1 | (self.adc_channel << 12) # Stop free-running conversions
+        if self.dma:
+            for dma in self.dma:
+                dma.irq(None)
+                dma.active(0)
+                dma.close()
+            self.dma = None
+        mem32[ADC_FCS] = 0 # Disable the FIFO so ADC.read_u16() works again
+        mem32[ADC_DIV] = 0
+
+
+# Host stand-in: feeds 16-bit samples from an iterable through the same handoff as the DMA driver
+class HostBlockReader(BlockReader):
+    def __init__(self, samples, block_size=50, oversample=4):
+        super().__init__(block_size, oversample)
+        self.samples = iter(samples) # Source of 16-bit samples, e.g. a capture file
+        self.running = False
+        self.next_buffer = 0 # Buffer the simulated DMA writes next
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    # Fill one raw buffer as the DMA channel would, return False when the source is exhausted
+    def pump(self):
+        if not self.running:
+            return False
+        raw = self.buffers[self.next_buffer]
+        oversample = self.oversample
+        j = 0
+        for i in range(self.block_size):
+            try:
+                value = next(self.samples) >> 4 # The ADC FIFO delivers 12-bit conversions
+            except StopIteration:
+                self.running = False
+                return False
+            for k in range(j, j + oversample): # Repeat the sample for each oversampled conversion
+                raw[k] = value
+            j += oversample
+        self.block_done(self.next_buffer)
+        self.next_buffer = 1 - self.next_buffer
+        return True
@@ -0,0 +1,344 @@
+# OLED helpers for the SSD1306 display
+# The SSD1306 buffer is organised in pages of 8 rows; each byte is one column of a page.
+
+
+SET_COL_ADDR = 0x21 # SSD1306 command: column window for the following data
+SET_PAGE_ADDR = 0x22 # SSD1306 command: page window for the following data
+CLEAN = 255 # dirty_lo of a page with no changes
+
+
+# Wrapper around SSD1306_I2C that remembers which columns of which pages were drawn on
+# show() sends only those parts of the framebuffer instead of the whole 1 KB.
+# The drawing methods match framebuf.FrameBuffer, so the wrapper replaces the display object.
+class DirtyOLED:
+    def __init__(self, oled):
+        self.oled = oled # The wrapped SSD1306_I2C
+        self.width = oled.width
+        self.height = oled.height
+        self.pages = self.height // 8
+        self.buffer = oled.buffer
+        self.column_offset = 32 if self.width == 64 else 0 # 64 pixel wide panels start at column 32
+        self.dirty_lo = bytearray(self.pages) # First dirty column of each page, CLEAN if unchanged
+        self.dirty_hi = bytearray(self.pages) # Last dirty column of each page
+        self.mark_all() # The panel content is unknown until the first show()
+        self.background = False # When True show() only queues the changes and flush_step() sends them
+        self.pending_lo = bytearray(self.pages) # First queued column of each page, CLEAN if none
+        self.pending_hi = bytearray(self.pages) # Last queued column of each page
+        for page in range(self.pages):
+            self.pending_lo[page] = CLEAN
+
+    def __getattr__(self, name):
+        # Everything not handled here (contrast, invert, poweroff, ...) goes to the display
+        return getattr(self.oled, name)
+
+    def mark(self, x0, y0, x1, y1):
+        # Mark the box from (x0, y0) to (x1, y1), inclusive, as changed
+        if x0 < 0:
+            x0 = 0
+        if y0 < 0:
+            y0 = 0
+        if x1 >= self.width:
+            x1 = self.width - 1
+        if y1 >= self.height:
+            y1 = self.height - 1
+        if x0 > x1 or y0 > y1:
+            return
+        for page in range(y0 >> 3, (y1 >> 3) + 1):
+            if x0 < self.dirty_lo[page]:
+                self.dirty_lo[page] = x0
+            if x1 > self.dirty_hi[page]:
+                self.dirty_hi[page] = x1
+
+    def mark_all(self):
+        # Mark the whole screen as changed
+        for page in range(self.pages):
+            self.dirty_lo[page] = 0
+            self.dirty_hi[page] = self.width - 1
+
+    def clear_marks(self):
+        # Mark the whole screen as unchanged
+        for page in range(self.pages):
+            self.dirty_lo[page] = CLEAN
+            self.dirty_hi[page] = 0
+
+    def is_dirty(self):
+        for page in range(self.pages):
+            if self.dirty_lo[page] != CLEAN:
+                return True
+        return False
+
+    # Drawing methods: draw on the framebuffer and mark the affected area
+    def fill(self, c):
+        self.oled.fill(c)
+        self.mark_all()
+
+    def fill_rect(self, x, y, w, h, c):
+        self.oled.fill_rect(x, y, w, h, c)
+        self.mark(x, y, x + w - 1, y + h - 1)
+
+    def rect(self, x, y, w, h, c, f=False):
+        if f:
+            self.oled.fill_rect(x, y, w, h, c)
+        else:
+            self.oled.rect(x, y, w, h, c)
+        self.mark(x, y, x + w - 1, y + h - 1)
+
+    def hline(self, x, y, w, c):
+        self.oled.hline(x, y, w, c)
+        self.mark(x, y, x + w - 1, y)
+
+    def vline(self, x, y, h, c):
+        self.oled.vline(x, y, h, c)
+        self.mark(x, y, x, y + h - 1)
+
+    def line(self, x0, y0, x1, y1, c):
+        self.oled.line(x0, y0, x1, y1, c)
+        self.mark(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+    def pixel(self, x, y, c=None):
+        if c is None: # Reading a pixel changes nothing
+            return self.oled.pixel(x, y)
+        self.oled.pixel(x, y, c)
+        self.mark(x, y, x, y)
+
+    def text(self, s, x, y, c=1):
+        self.oled.text(s, x, y, c)
+        self.mark(x, y, x + 8 * len(s) - 1, y + 7)
+
+    def scroll(self, xstep, ystep):
+        self.oled.scroll(xstep, ystep)
+        self.mark_all()
+
+    def blit(self, fbuf, x, y, *args):
+        self.oled.blit(fbuf, x, y, *args)
+        self.mark_all() # The source size is not known here
+
+    def show(self):
+        # Send the changed parts of the framebuffer to the display, or queue them in background mode
+        if self.background:
+            self.queue()
+            return
+        oled = self.oled
+        width = self.width
+        pages = self.pages
+        buffer = memoryview(self.buffer)
+        page = 0
+        while page < pages:
+            lo = self.dirty_lo[page]
+            hi = self.dirty_hi[page]
+            if lo == CLEAN: # Nothing changed on this page
+                page += 1
+                continue
+
+            last = page
+            if lo == 0 and hi == width - 1: # Full-width pages are contiguous in the buffer, send them together
+                while last + 1 < pages and self.dirty_lo[last + 1] == 0 and self.dirty_hi[last + 1] == width - 1:
+                    last += 1
+
+            oled.write_cmd(SET_COL_ADDR)
+            oled.write_cmd(lo + self.column_offset)
+            oled.write_cmd(hi + self.column_offset)
+            oled.write_cmd(SET_PAGE_ADDR)
+            oled.write_cmd(page)
+            oled.write_cmd(last)
+            if last == page:
+                oled.write_data(buffer[page * width + lo:page * width + hi + 1])
+            else:
+                oled.write_data(buffer[page * width:(last + 1) * width])
+            page = last + 1
+        self.clear_marks()
+
+
+    def window(self, lo, hi, page):
+        # Send columns lo to hi of one page
+        oled = self.oled
+        oled.write_cmd(SET_COL_ADDR)
+        oled.write_cmd(lo + self.column_offset)
+        oled.write_cmd(hi + self.column_offset)
+        oled.write_cmd(SET_PAGE_ADDR)
+        oled.write_cmd(page)
+        oled.write_cmd(page)
+        start = page * self.width
+        oled.write_data(memoryview(self.buffer)[start + lo:start + hi + 1])
+
+    def queue(self):
+        # Add the changed parts to the transfer queue and clear the marks
+        for page in range(self.pages):
+            lo = self.dirty_lo[page]
+            if lo == CLEAN:
+                continue
+            hi = self.dirty_hi[page]
+            if self.pending_lo[page] == CLEAN:
+                self.pending_lo[page] = lo
+                self.pending_hi[page] = hi
+            else:
+                if lo < self.pending_lo[page]:
+                    self.pending_lo[page] = lo
+                if hi > self.pending_hi[page]:
+                    self.pending_hi[page] = hi
+        self.clear_marks()
+
+    def busy(self):
+        # True while queued data has not been sent
+        for page in range(self.pages):
+            if self.pending_lo[page] != CLEAN:
+                return True
+        return False
+
+    def flush_step(self, budget=128):
+        # Send up to budget bytes of the queue, return True if more is left
+        # The buffer is read at transfer time, so drawing in between is sent with its latest content.
+        for page in range(self.pages):
+            lo = self.pending_lo[page]
+            if lo == CLEAN:
+                continue
+            if budget <= 0:
+                return True
+            hi = self.pending_hi[page]
+            end = min(hi, lo + budget - 1)
+            self.window(lo, end, page)
+            budget -= end - lo + 1
+            if end == hi:
+                self.pending_lo[page] = CLEAN
+                self.pending_hi[page] = 0
+            else: # Budget used up in the middle of the page
+                self.pending_lo[page] = end + 1
+                return True
+        return False
+
+    def flush(self):
+        # Send everything that is queued or marked, blocking until done
+        self.queue()
+        while self.flush_step(self.width):
+            pass
+
+
+# Host stand-in for machine.I2C: records the transfers instead of driving the bus
+# Useful to run the display code under desktop Python and count the bytes sent.
+class HostI2C:
+    def __init__(self, freq=400000):
+        self.freq = freq # Bus clock, used to estimate the transfer time
+        self.log = [] # (address, bytes) of every transaction
+        self.sent = 0 # Number of bytes written
+
+    def writeto(self, addr, buf, stop=True):
+        self.log.append((addr, bytes(buf)))
+        self.sent += len(buf)
+        return len(buf)
+
+    def writevto(self, addr, vector, stop=True):
+        data = b"".join(bytes(buf) for buf in vector)
+        return self.writeto(addr, data, stop)
+
+    def scan(self):
+        return [0x3C]
+
+    def transfer_us(self):
+        # Time the recorded bytes take on the bus, 9 clocks per byte plus start and address
+        return (self.sent + 2 * len(self.log)) * 9 * 1000000 // self.freq
+
+
+EMPTY = 255 # Span start of a column with nothing drawn
+
+
+# Scrolling waveform that redraws only the columns that changed
+# Each new point replaces the oldest column: its old span is erased, the new one is drawn
+# (a vertical segment from the previous point when lines are on), and the column `gap`
+# steps ahead is cleared to show where the trace is being written. With a DirtyOLED,
+# show() then transmits only those columns.
+class WaveformRenderer:
+    def __init__(self, oled, width=128, height=56, gap=8, lines=True):
+        self.oled = oled
+        self.width = width # Number of columns used, starting at x = 0
+        self.height = height # Number of rows used, starting at y = 0
+        self.gap = gap # Number of empty columns ahead of the newest point
+        self.lines = lines # Join consecutive points with line segments
+        self.span_lo = bytearray(width) # Top row drawn in each column, EMPTY if nothing
+        self.span_hi = bytearray(width) # Bottom row drawn in each column
+        self.reset()
+
+    def reset(self):
+        # Forget the drawn trace, the plot area is cleared by the next push
+        for x in range(self.width):
+            self.span_lo[x] = EMPTY
+        self.x = 0 # Column of the next point
+        self.previous = -1 # Row of the previous point, -1 if there is none
+        self.cleared = False # True once the plot area has been cleared for this trace
+
+    def erase(self, x):
+        # Clear what was drawn in column x
+        lo = self.span_lo[x]
+        if lo != EMPTY:
+            self.oled.vline(x, lo, self.span_hi[x] - lo + 1, 0)
+            self.span_lo[x] = EMPTY
+
+    def push(self, y):
+        # Draw the next point at row y (0 is the top)
+        if y < 0:
+            y = 0
+        elif y >= self.height:
+            y = self.height - 1
+        if not self.cleared: # Remove what another screen left in the plot area
+            self.oled.fill_rect(0, 0, self.width, self.height, 0)
+            self.cleared = True
+        x = self.x
+        self.erase(x)
+
+        lo = hi = y
+        if self.lines and self.previous >= 0 and x > 0: # Segment from the previous point
+            if self.previous < lo:
+                lo = self.previous
+            else:
+                hi = max(hi, self.previous)
+        self.oled.vline(x, lo, hi - lo + 1, 1)
+        self.span_lo[x] = lo
+        self.span_hi[x] = hi
+
+        self.erase((x + self.gap) % self.width) # Keep a gap ahead of the trace
+        self.previous = y
+        self.x = (x + 1) % self.width
+
+
+# Cache of pre-rendered full screens
+# A screen is drawn once by its render function and a copy of the framebuffer is kept
+# under its key. Showing it again copies the bytes back and marks only the pages that
+# differ from what is on the screen. Keys are (kind, variant) tuples, e.g. ("menu", 2),
+# so that invalidate(kind) can drop every variant of a screen whose content changed.
+class ScreenCache:
+    def __init__(self, oled, limit=10):
+        self.oled = oled # DirtyOLED the screens are drawn on
+        self.limit = limit # Maximum number of cached screens, 1 KB each on a 128x64 display
+        self.screens = {} # Framebuffer copies by key
+        self.order = [] # Keys from the oldest to the newest, for eviction
+        self.hits = 0
+        self.misses = 0
+
+    def show(self, key, render):
+        # Put the screen for key on the display, calling render() to draw it if it is not cached
+        oled = self.oled
+        screen = self.screens.get(key)
+        if screen is None:
+            self.misses += 1
+            render() # Draws the whole screen on oled
+            if len(self.order) >= self.limit:
+                del self.screens[self.order.pop(0)]
+            self.screens[key] = bytearray(oled.buffer)
+            self.order.append(key)
+        else:
+            self.hits += 1
+            buffer = oled.buffer
+            width = oled.width
+            for page in range(oled.pages): # Copy back only the pages that differ
+                start = page * width
+                end = start + width
+                if buffer[start:end] != screen[start:end]:
+                    buffer[start:end] = screen[start:end]
+                    oled.mark(0, page * 8, width - 1, page * 8 + 7)
+        oled.show()
+
+    def invalidate(self, kind=None):
+        # Drop the cached screens of one kind, or all of them
+        for key in self.order[:]:
+            if kind is None or key[0] == kind:
+                self.order.remove(key)
+                del self.screens[key]
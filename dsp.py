@@ -0,0 +1,272 @@
+# Streaming signal processing helpers for the PPG pipeline
+# Everything here works sample by sample on preallocated state, so it runs
+# unchanged on the Pico and under desktop Python.
+from array import array
+
+
+# Minimum and maximum of the last `size` samples with monotonic deques
+# Each push is O(1) amortized, reading min or max is O(1).
+class SlidingMinMax:
+    def __init__(self, size):
+        self.size = size # Window length in samples
+        # Ring buffers holding the deques as (sample number, value) pairs
+        self.max_index = array('i', bytes(4 * size))
+        self.max_value = array('i', bytes(4 * size))
+        self.min_index = array('i', bytes(4 * size))
+        self.min_value = array('i', bytes(4 * size))
+        self.reset()
+
+    def reset(self):
+        # Forget all samples
+        self.count = 0 # Number of samples pushed
+        self.max_head = 0 # Oldest entry of the max deque
+        self.max_len = 0 # Number of entries in the max deque
+        self.min_head = 0 # Oldest entry of the min deque
+        self.min_len = 0 # Number of entries in the min deque
+
+    def push(self, value):
+        # Add a sample and drop the one that falls out of the window
+        size = self.size
+        n = self.count
+        oldest = n - size # Sample numbers up to this one are outside the window
+
+        # Max deque: values decrease from head to tail
+        head = self.max_head
+        length = self.max_len
+        index = self.max_index
+        values = self.max_value
+        if length and index[head] <= oldest: # Expire the front entry
+            head = (head + 1) % size
+            length -= 1
+        while length and values[(head + length - 1) % size] <= value: # Drop entries the new value dominates
+            length -= 1
+        tail = (head + length) % size
+        index[tail] = n
+        values[tail] = value
+        self.max_head = head
+        self.max_len = length + 1
+
+        # Min deque: values increase from head to tail
+        head = self.min_head
+        length = self.min_len
+        index = self.min_index
+        values = self.min_value
+        if length and index[head] <= oldest:
+            head = (head + 1) % size
+            length -= 1
+        while length and values[(head + length - 1) % size] >= value:
+            length -= 1
+        tail = (head + length) % size
+        index[tail] = n
+        values[tail] = value
+        self.min_head = head
+        self.min_len = length + 1
+
+        self.count = n + 1
+
+    def max(self):
+        # Largest value in the window
+        return self.max_value[self.max_head]
+
+    def min(self):
+        # Smallest value in the window
+        return self.min_value[self.min_head]
+
+    def has_data(self):
+        return self.count > 0
+
+
+# Moving average over the last `size` samples with a running sum
+# The samples are kept in a preallocated ring, so pushing allocates nothing.
+class MovingAverage:
+    def __init__(self, size):
+        self.size = size # Number of samples averaged
+        self.samples = array('i', bytes(4 * size))
+        self.reset()
+
+    def reset(self):
+        self.head = 0 # Slot of the oldest sample, overwritten next
+        self.length = 0 # Number of samples in the ring
+        self.total = 0 # Sum of the samples in the ring
+
+    def push(self, value):
+        # Add a sample, replacing the oldest one once the ring is full
+        if self.length == self.size:
+            self.total -= self.samples[self.head]
+        else:
+            self.length += 1
+        self.samples[self.head] = value
+        self.total += value
+        self.head = (self.head + 1) % self.size
+
+    def full(self):
+        return self.length == self.size
+
+    def mean(self):
+        # Integer average of the samples in the ring
+        return self.total // self.length if self.length else 0
+
+
+# Minimum and maximum of group averages over consecutive blocks of samples
+# Every `group` samples are averaged, and after `block` samples the lowest and highest
+# group averages of that block are published in low/high. A partial group at the end
+# of a block is dropped.
+class BlockRange:
+    def __init__(self, block, group=5):
+        self.block = block # Samples per block
+        self.group = group # Samples per averaged group
+        self.low = 0 # Smallest group average of the last complete block
+        self.high = 0 # Largest group average of the last complete block
+        self.reset()
+
+    def reset(self):
+        self.count = 0 # Samples in the current block
+        self.group_count = 0 # Samples in the current group
+        self.group_sum = 0 # Sum of the current group
+        self.block_low = None # Running minimum of the current block
+        self.block_high = None # Running maximum of the current block
+
+    def push(self, value):
+        # Add a sample, return True when a block completed and low/high were updated
+        self.group_sum += value
+        self.group_count += 1
+        if self.group_count == self.group:
+            average = self.group_sum // self.group
+            if self.block_low is None or average < self.block_low:
+                self.block_low = average
+            if self.block_high is None or average > self.block_high:
+                self.block_high = average
+            self.group_sum = 0
+            self.group_count = 0
+
+        self.count += 1
+        if self.count < self.block:
+            return False
+        done = self.block_low is not None
+        if done:
+            self.low = self.block_low
+            self.high = self.block_high
+        self.reset()
+        return done
+
+
+# Offset of the apex of the parabola through three equally spaced samples
+# Returns the fractional position (-0.5 to 0.5) of the true maximum relative to
+# the centre sample. If a neighbour is larger the centre is no maximum, and 0 is returned.
+def parabolic_offset(left, centre, right):
+    if left > centre or right > centre:
+        return 0.0
+    denominator = left - 2 * centre + right
+    if denominator == 0:
+        return 0.0
+    return 0.5 * (left - right) / denominator
+
+
+COEF_BITS = 14 # Fixed-point fraction bits of the filter coefficients
+INPUT_SHIFT = 2 # read_u16() samples are divided by 4; the 12-bit ADC fills only the top bits anyway
+
+
+# Second-order Butterworth section (RBJ cookbook), coefficients as Q14 integers
+def butterworth_biquad(kind, cutoff, sample_rate):
+    import math
+    w0 = 2 * math.pi * cutoff / sample_rate
+    cos_w0 = math.cos(w0)
+    alpha = math.sin(w0) / (2 * 0.7071067811865476) # Q = 1/sqrt(2)
+    if kind == 'low':
+        b0 = (1 - cos_w0) / 2
+        b1 = 1 - cos_w0
+    elif kind == 'high':
+        b0 = (1 + cos_w0) / 2
+        b1 = -(1 + cos_w0)
+    else:
+        raise ValueError("kind must be 'low' or 'high'")
+    a0 = 1 + alpha
+    scale = (1 << COEF_BITS) / a0
+    return (round(b0 * scale), round(b1 * scale), round(b0 * scale),
+            round(-2 * cos_w0 * scale), round((1 - alpha) * scale))
+
+
+# Streaming band-pass: Butterworth high-pass and low-pass biquads in integer fixed-point
+# Input is a read_u16() sample, output is the band-passed signal centred on zero
+# in units of four read_u16() counts. With that scaling the accumulators stay below
+# 0.75 * 2**30 even for a full-scale square wave, so MicroPython keeps every value a
+# small int and processing a sample allocates nothing. Halving the input instead
+# reaches 1.13 * 2**30 through the a1 * hy1 term.
+# The remainder of each shift is carried into the next sample (error feedback);
+# without it the rounding noise of the 0.5 Hz poles swamps the low band.
+class BandPassFilter:
+    def __init__(self, low=0.5, high=5.0, sample_rate=250):
+        self.hp = butterworth_biquad('high', low, sample_rate) # Removes baseline drift
+        self.lp = butterworth_biquad('low', high, sample_rate) # Removes noise above the heart rate band
+        self.prime(32768)
+
+    def prime(self, value):
+        # Set the state as if the input had been constant at value, avoiding the start-up transient
+        x = (value - 32768) >> INPUT_SHIFT
+        self.hx1 = self.hx2 = x # High-pass input history
+        self.hy1 = self.hy2 = 0 # High-pass output history, zero for a constant input
+        self.ly1 = self.ly2 = 0 # Low-pass history (its input is the high-pass output)
+        self.lx1 = self.lx2 = 0
+        self.h_err = self.l_err = 0 # Fraction bits carried over from the previous shift
+
+    def process(self, value):
+        # Filter one sample
+        x = (value - 32768) >> INPUT_SHIFT # Centre and scale the sample to keep the accumulators below 2**30
+
+        b0, b1, b2, a1, a2 = self.hp
+        acc = b0 * x + b1 * self.hx1 + b2 * self.hx2 - a1 * self.hy1 - a2 * self.hy2 + self.h_err
+        y = acc >> COEF_BITS
+        self.h_err = acc - (y << COEF_BITS)
+        self.hx2 = self.hx1
+        self.hx1 = x
+        self.hy2 = self.hy1
+        self.hy1 = y
+
+        b0, b1, b2, a1, a2 = self.lp
+        acc = b0 * y + b1 * self.lx1 + b2 * self.lx2 - a1 * self.ly1 - a2 * self.ly2 + self.l_err
+        out = acc >> COEF_BITS
+        self.l_err = acc - (out << COEF_BITS)
+        self.lx2 = self.lx1
+        self.lx1 = y
+        self.ly2 = self.ly1
+        self.ly1 = out
+        return out
+
+
+# Host benchmark: per-sample cost of the band-pass compared with the moving average + EMA
+# used in the offline experiments (HW2_project_exercise_task4.1)
+if __name__ == "__main__":
+    import math
+    import time
+
+    try:
+        ticks_us = time.ticks_us # MicroPython
+        ticks_diff = time.ticks_diff
+    except AttributeError:
+        def ticks_us():
+            return int(time.perf_counter() * 1000000)
+
+        def ticks_diff(end, start):
+            return end - start
+
+    # Five seconds of synthetic PPG: 1.2 Hz pulse on a drifting baseline
+    n = 1250
+    samples = [int(30000 + 4000 * math.sin(2 * math.pi * 1.2 * i / 250) + 3000 * math.sin(2 * math.pi * 0.05 * i / 250))
+               for i in range(n)]
+
+    band_pass = BandPassFilter()
+    band_pass.prime(samples[0])
+    start = ticks_us()
+    for sample in samples:
+        band_pass.process(sample)
+    print("band-pass:            %.2f us/sample" % (ticks_diff(ticks_us(), start) / n))
+
+    buffer = []
+    previous_output = 0
+    start = ticks_us()
+    for sample in samples:
+        buffer.append(sample)
+        if len(buffer) > 10:
+            buffer.pop(0)
+        previous_output = 0.1 * (sum(buffer) / len(buffer)) + 0.9 * previous_output
+    print("moving average + EMA: %.2f us/sample" % (ticks_diff(ticks_us(), start) / n))
@@ -0,0 +1,42 @@
+# Gateway bridge: binary PPI requests from the devices to the Kubios JSON request topic
+# Runs on the gateway computer next to the broker and needs paho-mqtt (pip install paho-mqtt).
+# Usage: python gateway.py [broker host] [broker port]
+import json
+import sys
+
+from ppicodec import kubios_dataset
+
+
+BINARY_TOPIC = "kubios-request-bin" # Compact requests published by the devices
+JSON_TOPIC = "kubios-request" # Requests in the JSON format the Kubios bridge expects
+
+
+def on_connect(client, userdata, flags, rc):
+    client.subscribe(BINARY_TOPIC) # Also renews the subscription after a reconnect
+
+
+def on_message(client, userdata, message):
+    try:
+        dataset = kubios_dataset(message.payload)
+    except ValueError as error:
+        print("Dropped payload of %d bytes: %s" % (len(message.payload), error))
+        return
+    body = json.dumps(dataset)
+    client.publish(JSON_TOPIC, body)
+    print("Request %d: %d PPIs, %d -> %d bytes" % (dataset["id"], len(dataset["data"]), len(message.payload), len(body)))
+
+
+def main(host="localhost", port=21883):
+    import paho.mqtt.client as mqtt
+    try:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1) # paho-mqtt 2.x
+    except AttributeError:
+        client = mqtt.Client() # paho-mqtt 1.x
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(host, port)
+    client.loop_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "localhost", int(sys.argv[2]) if len(sys.argv) > 2 else 21883)
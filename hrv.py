@@ -0,0 +1,231 @@
+# Local HRV analysis of peak-to-peak intervals (PPI)
+from array import array
+
+from beats import PPI_MIN, PPI_MAX # Range of the PPIs the beat stream accepts
+
+
+TRI_BINS = (PPI_MAX - PPI_MIN) * 128 // 1000 + 1 # 1/128 s bins for the triangular index
+MODE_BIN = 50 # Bin width in ms for the mode used by the stress index
+MODE_BINS = (PPI_MAX - PPI_MIN) // MODE_BIN + 1
+
+
+# Online HRV accumulator, updated in O(1) per beat without storing the PPI values
+# Mean HR, mean PPI, SDNN and RMSSD come from values(); pNN50, Poincare SD1/SD2,
+# triangular index and stress index from metrics(). SDNN uses Welford's running
+# mean and sum of squares; the histograms are preallocated.
+class HrvAccumulator:
+    def __init__(self):
+        self.tri_hist = array('H', bytes(2 * TRI_BINS)) # Histogram for the triangular index
+        self.mode_hist = array('H', bytes(2 * MODE_BINS)) # Histogram for the mode of the stress index
+        self.reset()
+
+    def reset(self):
+        # Forget all beats
+        self.count = 0 # Number of PPI values added
+        self.mean = 0.0 # Running mean PPI in ms
+        self.m2 = 0.0 # Sum of squared deviations from the running mean
+        self.hr_sum = 0.0 # Sum of the heart rates of all beats
+        self.previous = 0 # Previous PPI for the successive differences
+        self.diff_count = 0 # Number of successive differences
+        self.diff_sq_sum = 0 # Sum of squared successive differences
+        self.diff_sum = 0 # Sum of successive differences
+        self.nn50 = 0 # Number of successive differences larger than 50 ms
+        self.min_ppi = PPI_MAX # Shortest PPI
+        self.max_ppi = 0 # Longest PPI
+        for i in range(TRI_BINS):
+            self.tri_hist[i] = 0
+        for i in range(MODE_BINS):
+            self.mode_hist[i] = 0
+
+    def add(self, ppi):
+        # Add one PPI in milliseconds
+        self.count += 1
+        delta = ppi - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (ppi - self.mean)
+        self.hr_sum += 60000 / ppi
+
+        if self.count > 1:
+            diff = ppi - self.previous
+            self.diff_sq_sum += diff * diff
+            self.diff_sum += diff
+            self.diff_count += 1
+            if diff > 50 or diff < -50:
+                self.nn50 += 1
+        self.previous = ppi
+
+        if ppi < self.min_ppi:
+            self.min_ppi = ppi
+        if ppi > self.max_ppi:
+            self.max_ppi = ppi
+        clamped = min(max(ppi, PPI_MIN), PPI_MAX) - PPI_MIN
+        self.tri_hist[clamped * 128 // 1000] += 1
+        self.mode_hist[clamped // MODE_BIN] += 1
+
+    def mean_ppi(self):
+        return int(self.mean)
+
+    def mean_hr(self):
+        return int(self.hr_sum / self.count) if self.count else 0
+
+    def sdnn(self):
+        # Standard deviation of the PPI values
+        return int((self.m2 / self.count) ** 0.5) if self.count else 0
+
+    def rmssd(self):
+        # Root mean square of successive differences
+        return int((self.diff_sq_sum / self.diff_count) ** 0.5) if self.diff_count else 0
+
+    def values(self):
+        # Current values in the format published and saved by the device
+        return {
+                "mean_hr": self.mean_hr(),
+                "mean_ppi": self.mean_ppi(),
+                "rmssd": self.rmssd(),
+                "sdnn": self.sdnn()
+                }
+
+    def metrics(self):
+        # Extended metrics: pNN50 (%), SD1 and SD2 (ms), triangular index and stress index
+        if self.diff_count < 2:
+            return {}
+        sdnn_sq = self.m2 / self.count
+        diff_mean = self.diff_sum / self.diff_count
+        sdsd_sq = self.diff_sq_sum / self.diff_count - diff_mean * diff_mean # Variance of successive differences
+        sd1_sq = 0.5 * sdsd_sq
+        sd2_sq = max(2 * sdnn_sq - sd1_sq, 0)
+
+        # Mode of the PPI distribution in 50 ms bins
+        mode_bin = 0
+        for i in range(MODE_BINS):
+            if self.mode_hist[i] > self.mode_hist[mode_bin]:
+                mode_bin = i
+        mode = (PPI_MIN + mode_bin * MODE_BIN + MODE_BIN / 2) / 1000 # Mo in seconds
+        amplitude = 100 * self.mode_hist[mode_bin] / self.count # AMo in percent
+        spread = max(self.max_ppi - self.min_ppi, MODE_BIN) / 1000 # MxDMn in seconds, at least one bin
+        stress = amplitude / (2 * mode * spread) # Baevsky stress index
+
+        return {
+                "pnn50": round(100 * self.nn50 / self.diff_count, 1),
+                "sd1": int(sd1_sq ** 0.5),
+                "sd2": int(sd2_sq ** 0.5),
+                "tri_index": round(self.count / max(self.tri_hist), 1),
+                "stress_index": round(stress ** 0.5, 1) # Square root, as reported by Kubios
+                }
+
+
+# Basic and extended HRV metrics of a PPI list in a single traversal
+def hrv_metrics(ppi_intervals):
+    accumulator = HrvAccumulator()
+    for ppi in ppi_intervals:
+        accumulator.add(ppi)
+    result = accumulator.values()
+    result.update(accumulator.metrics())
+    return result
+
+
+LF_BAND = (0.04, 0.15) # Low frequency band in Hz
+HF_BAND = (0.15, 0.4) # High frequency band in Hz
+MIN_SPECTRUM_PPIS = 4 # Shorter series give no spectrum
+
+
+# Beat times in seconds and mean-removed PPI values of a PPI series
+def ppi_series(ppi_intervals):
+    times = []
+    values = []
+    t = 0.0
+    mean = sum(ppi_intervals) / len(ppi_intervals)
+    for ppi in ppi_intervals:
+        t += ppi / 1000
+        times.append(t)
+        values.append(ppi - mean)
+    return times, values
+
+
+# Frequency grid over both bands, oversampled relative to the resolution 1/T of the recording
+def frequency_grid(duration, oversample=4):
+    df = 1 / (oversample * duration)
+    count = int((HF_BAND[1] - LF_BAND[0]) / df) + 1
+    return LF_BAND[0], df, count
+
+
+# Lomb-Scargle power spectral density in ms^2/Hz on the grid f_min + k * df
+# The sines and cosines of every sample are advanced from one frequency to the next
+# by a precomputed per-sample rotation, so only four trig calls per sample are needed.
+def lomb_scargle(times, values, f_min, df, count):
+    import math
+    n = len(times)
+    duration = times[-1] - times[0]
+    two_pi = 2 * math.pi
+
+    # Trig tables: current cos/sin of 2*pi*f*t and the rotation by 2*pi*df*t for each sample
+    cos_t = [math.cos(two_pi * f_min * t) for t in times]
+    sin_t = [math.sin(two_pi * f_min * t) for t in times]
+    cos_step = [math.cos(two_pi * df * t) for t in times]
+    sin_step = [math.sin(two_pi * df * t) for t in times]
+
+    psd = [0.0] * count
+    for k in range(count):
+        yc = ys = c2 = s2 = 0.0
+        for j in range(n):
+            c = cos_t[j]
+            s = sin_t[j]
+            y = values[j]
+            yc += y * c
+            ys += y * s
+            c2 += c * c - s * s # cos(2wt)
+            s2 += 2 * c * s # sin(2wt)
+            # Rotate to the next frequency
+            cos_t[j] = c * cos_step[j] - s * sin_step[j]
+            sin_t[j] = s * cos_step[j] + c * sin_step[j]
+
+        # Time offset tau makes the sine and cosine terms orthogonal
+        half = 0.5 * math.atan2(s2, c2)
+        ct = math.cos(half)
+        st = math.sin(half)
+        cc = 0.5 * n + 0.5 * (c2 * math.cos(2 * half) + s2 * math.sin(2 * half)) # sum of cos^2(w(t - tau))
+        ss = n - cc
+        yct = ct * yc + st * ys
+        yst = ct * ys - st * yc
+        power = 0.5 * (yct * yct / cc + (yst * yst / ss if ss > 0 else 0.0))
+        psd[k] = 2 * duration * power / n # Scale so that the spectrum integrates to the variance
+    return psd
+
+
+# NumPy-vectorized Lomb-Scargle for batch use on a host, same grid and scaling as lomb_scargle
+def lomb_scargle_numpy(times, values, f_min, df, count):
+    import numpy as np
+    t = np.asarray(times, dtype=float)
+    y = np.asarray(values, dtype=float)
+    w = 2 * np.pi * (f_min + df * np.arange(count))[:, None]
+    tau = np.arctan2(np.sin(2 * w * t).sum(axis=1), np.cos(2 * w * t).sum(axis=1))[:, None] / (2 * w)
+    arg = w * (t - tau)
+    cos_arg = np.cos(arg)
+    sin_arg = np.sin(arg)
+    power = 0.5 * ((cos_arg @ y) ** 2 / (cos_arg ** 2).sum(axis=1) + (sin_arg @ y) ** 2 / (sin_arg ** 2).sum(axis=1))
+    return 2 * (t[-1] - t[0]) * power / len(t)
+
+
+# LF and HF power (ms^2) and LF/HF ratio of a PPI series, all zero for a series too short to analyse
+def lf_hf(ppi_intervals, oversample=4, vectorized=False):
+    if len(ppi_intervals) < MIN_SPECTRUM_PPIS:
+        return {"lf": 0, "hf": 0, "lf_hf": 0}
+    times, values = ppi_series(ppi_intervals)
+    f_min, df, count = frequency_grid(times[-1] - times[0], oversample)
+    if vectorized:
+        psd = lomb_scargle_numpy(times, values, f_min, df, count)
+    else:
+        psd = lomb_scargle(times, values, f_min, df, count)
+
+    lf = hf = 0.0
+    for k in range(count):
+        f = f_min + k * df
+        if f < LF_BAND[1]:
+            lf += psd[k] * df
+        elif f <= HF_BAND[1]:
+            hf += psd[k] * df
+    return {
+            "lf": int(lf),
+            "hf": int(hf),
+            "lf_hf": round(float(lf / hf), 2) if hf else 0
+            }
@@ -0,0 +1,110 @@
+# Streaming JSON serialisation for large messages
+# json_length() computes the size of the JSON text of a value without building it, and
+# JsonWriter writes the text through a small buffer, so a dataset with thousands of
+# PPIs is sent without ever holding its JSON string in RAM. The output is identical
+# to json.dumps() with the default separators.
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+def int_length(value):
+    # Number of characters of an integer
+    length = 1
+    if value < 0:
+        value = -value
+        length += 1
+    while value >= 10:
+        value //= 10
+        length += 1
+    return length
+
+
+def json_length(value):
+    # Length in bytes of json.dumps(value)
+    if isinstance(value, bool) or not isinstance(value, (int, dict, list, tuple)):
+        return len(json.dumps(value).encode())
+    if isinstance(value, int):
+        return int_length(value)
+    if isinstance(value, dict):
+        length = 2 + 2 * max(len(value) - 1, 0) # Braces and ", " separators
+        for key in value:
+            length += json_length(key) + 2 + json_length(value[key]) # ": " after the key
+        return length
+    length = 2 + 2 * max(len(value) - 1, 0) # Brackets and ", " separators
+    for item in value:
+        length += json_length(item)
+    return length
+
+
+class JsonWriter:
+    def __init__(self, write, size=128):
+        self.write = write # Called with a memoryview of each full buffer, e.g. sock.write
+        self.buffer = bytearray(size)
+        self.used = 0 # Bytes waiting in the buffer
+        self.written = 0 # Bytes passed to write()
+
+    def flush(self):
+        if self.used:
+            self.write(memoryview(self.buffer)[:self.used])
+            self.written += self.used
+            self.used = 0
+
+    def put(self, data):
+        # Append bytes
+        n = len(data)
+        if self.used + n > len(self.buffer):
+            self.flush()
+            if n > len(self.buffer): # Larger than the buffer, write it directly
+                self.write(data)
+                self.written += n
+                return
+        self.buffer[self.used:self.used + n] = data
+        self.used += n
+
+    def put_int(self, value):
+        # Append the digits of an integer without creating a string
+        n = int_length(value)
+        if self.used + n > len(self.buffer):
+            self.flush()
+        buffer = self.buffer
+        if value < 0:
+            buffer[self.used] = 0x2D # "-"
+            value = -value
+        end = self.used + n
+        position = end - 1
+        while True:
+            buffer[position] = 0x30 + value % 10
+            value //= 10
+            position -= 1
+            if not value:
+                break
+        self.used = end
+
+    def value(self, value):
+        # Append the JSON text of a value
+        if isinstance(value, bool) or not isinstance(value, (int, dict, list, tuple)):
+            self.put(json.dumps(value).encode())
+        elif isinstance(value, int):
+            self.put_int(value)
+        elif isinstance(value, dict):
+            self.put(b"{")
+            first = True
+            for key in value:
+                if not first:
+                    self.put(b", ")
+                first = False
+                self.value(key)
+                self.put(b": ")
+                self.value(value[key])
+            self.put(b"}")
+        else:
+            self.put(b"[")
+            first = True
+            for item in value:
+                if not first:
+                    self.put(b", ")
+                first = False
+                self.value(item)
+            self.put(b"]")
@@ -0,0 +1,338 @@
+# Long-lived MQTT session for the heart rate monitor
+# One MqttSession is kept per broker and port for the whole run instead of a new
+# MQTTClient per measurement. poll() keeps it alive with pings, reads incoming
+# messages and PUBACKs, and reconnects with exponential backoff after a failure.
+# No call waits for the broker: QoS 1 publishes return at once and their PUBACKs are
+# collected by poll(), and every socket read or write is bounded by io_timeout.
+import time
+
+from jsonstream import JsonWriter, json_length
+
+try:
+    ticks_ms = time.ticks_ms # MicroPython
+    ticks_diff = time.ticks_diff
+    ticks_add = time.ticks_add
+except AttributeError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(end, start):
+        return end - start
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+
+# Connection states shown by the UI
+DISCONNECTED = "OFFLINE" # Not started or stopped
+CONNECTED = "ONLINE"
+BACKOFF = "RETRY" # Waiting before the next connection attempt
+PUBACK = 0x40 # Packet type returned by MQTTClient.check_msg()
+
+
+# Socket wrapper that turns blocking mode into a timeout
+# umqtt.simple switches the socket back to blocking after every check_msg(), which on
+# MicroPython also removes a timeout. Through this wrapper every read and write of the
+# client is bounded, and a silent broker raises OSError instead of hanging the main loop.
+class BoundedSocket:
+    def __init__(self, sock, timeout):
+        self.sock = sock
+        self.timeout = timeout # Seconds
+        sock.settimeout(timeout)
+
+    def setblocking(self, flag):
+        if flag:
+            self.sock.settimeout(self.timeout)
+        else:
+            self.sock.setblocking(False)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(self.timeout if timeout is None else timeout)
+
+    def read(self, n):
+        return self.sock.read(n)
+
+    def write(self, data, n=None):
+        if n is None:
+            return self.sock.write(data)
+        return self.sock.write(data, n)
+
+    def close(self):
+        self.sock.close()
+
+
+class MqttSession:
+    def __init__(self, server, port=1883, client_id="", keepalive=60, callback=None,
+                 min_backoff=1000, max_backoff=60000, connect_timeout=2000, io_timeout=1000,
+                 ack_timeout=10000, factory=None):
+        self.server = server # Broker address
+        self.port = port # Broker port
+        self.client_id = client_id
+        self.keepalive = keepalive # Seconds, the broker drops the session after 1.5 times this without traffic
+        self.callback = callback # Called with (topic, msg) for incoming messages
+        self.min_backoff = min_backoff # First retry delay in ms
+        self.max_backoff = max_backoff # Longest retry delay in ms
+        self.connect_timeout = connect_timeout # ms a connection attempt may block, TCP connect and CONNACK
+        self.io_timeout = io_timeout # ms a socket read or write may block once connected
+        self.ack_timeout = ack_timeout # ms without PUBACK after which the connection is taken as dead
+        self.factory = factory # Creates the client, umqtt.simple.MQTTClient if None
+        self.client = None # Connected client
+        self.topics = [] # Subscriptions, renewed after every reconnect
+        self.state = DISCONNECTED
+        self.wanted = False # The session should be kept up
+        self.backoff = min_backoff # Delay before the next retry
+        self.retry_at = 0 # Time of the next connection attempt
+        self.last_activity = 0 # Time of the last packet sent, for the keepalive ping
+        self.failures = 0 # Consecutive failed attempts
+        self.connections = 0 # Successful connects, QoS 1 messages of an older connection must be sent again
+        self.pid = 0 # Packet identifier of the last QoS 1 publish
+        self.inflight = {} # Send time of the QoS 1 publishes waiting for their PUBACK, by packet identifier
+        self.acked = [] # Packet identifiers acknowledged since the last take_acks()
+
+    def connected(self):
+        return self.state == CONNECTED
+
+    def status(self):
+        # Short connection state for the display, e.g. "ONLINE" or "RETRY 8S"
+        if self.state == BACKOFF:
+            wait = max(ticks_diff(self.retry_at, ticks_ms()), 0)
+            return "%s %dS" % (BACKOFF, (wait + 999) // 1000)
+        return self.state
+
+    def start(self, connect=True):
+        # Keep the session up from now on, connecting right away if it is not connected
+        # With connect=False the first attempt is left to poll().
+        self.wanted = True
+        if connect and not self.connected():
+            self.connect()
+        return self.connected()
+
+    def stop(self):
+        # Close the session and stop reconnecting
+        self.wanted = False
+        if self.client:
+            try:
+                self.client.disconnect()
+            except OSError:
+                pass
+        self.close()
+        self.state = DISCONNECTED
+
+    def connect(self):
+        # One connection attempt, schedules the next one on failure
+        self.close()
+        try:
+            if self.factory:
+                client = self.factory(self.client_id, self.server, self.port, keepalive=self.keepalive)
+            else:
+                from umqtt.simple import MQTTClient
+                client = MQTTClient(self.client_id, self.server, self.port, keepalive=self.keepalive)
+            self.client = client
+            if self.callback:
+                client.set_callback(self.callback)
+            try:
+                client.connect(clean_session=True, timeout=self.connect_timeout / 1000)
+            except TypeError: # umqtt.simple before 1.4 has no timeout, the attempt is unbounded
+                client.connect(clean_session=True)
+            client.sock = BoundedSocket(client.sock, self.io_timeout / 1000)
+            for topic in self.topics:
+                client.subscribe(topic)
+        except OSError as error:
+            self.fail(error)
+            return False
+        self.connections += 1
+        self.state = CONNECTED
+        self.backoff = self.min_backoff
+        self.failures = 0
+        self.last_activity = ticks_ms()
+        return True
+
+    def close(self):
+        # Release the socket of the current client, if any
+        client = self.client
+        self.client = None
+        if client and getattr(client, "sock", None):
+            try:
+                client.sock.close()
+            except OSError:
+                pass
+
+    def fail(self, error):
+        # Drop the connection and wait before trying again, doubling the delay each time
+        print("MQTT %s:%d: %s" % (self.server, self.port, error))
+        self.close()
+        self.inflight.clear() # Unacknowledged messages are sent again after the reconnect
+        self.failures += 1
+        self.state = BACKOFF
+        self.retry_at = ticks_add(ticks_ms(), self.backoff)
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def poll(self, allow_connect=True):
+        # Maintenance step: reconnect when due, ping when idle, handle incoming messages
+        # A reconnect blocks for up to connect_timeout, allow_connect=False postpones it
+        # while that would stall sampling or the user interface.
+        if not self.wanted:
+            return
+        now = ticks_ms()
+        if self.state != CONNECTED:
+            if allow_connect and ticks_diff(now, self.retry_at) >= 0:
+                self.connect()
+            return
+        try:
+            if ticks_diff(now, self.last_activity) >= self.keepalive * 500: # Ping at half the keepalive
+                self.client.ping()
+                self.last_activity = now
+            while self.read_packet(): # Incoming messages go to the callback
+                pass
+        except OSError as error:
+            self.fail(error)
+            return
+        for pid in self.inflight:
+            if ticks_diff(now, self.inflight[pid]) >= self.ack_timeout: # Half-open connection
+                self.fail("no PUBACK for message %d" % pid)
+                return
+
+    def read_packet(self):
+        # Handle one incoming packet without waiting, return False if there was none
+        client = self.client
+        op = client.check_msg() # Handles PUBLISH and PINGRESP, returns the type of other packets
+        if op is None:
+            return False
+        if op & 0xF0 == 0x30:
+            return True
+        size = client.sock.read(1)[0] # Packets other than PUBLISH are short
+        body = client.sock.read(size) if size else b""
+        if op == PUBACK:
+            pid = body[0] << 8 | body[1]
+            if self.inflight.pop(pid, None) is not None:
+                self.acked.append(pid)
+        return True
+
+    def take_acks(self):
+        # Packet identifiers of the QoS 1 publishes acknowledged since the last call
+        acked = self.acked
+        self.acked = []
+        return acked
+
+    def publish(self, topic, msg, qos=0):
+        # Publish if connected, return False if the message could not be sent
+        # A QoS 1 publish returns its packet identifier right away, take_acks() reports the PUBACK.
+        if self.state != CONNECTED:
+            return False
+        try:
+            pid = self.write_publish(topic, msg, qos)
+        except OSError as error:
+            self.fail(error)
+            return False
+        self.last_activity = ticks_ms()
+        if qos:
+            self.inflight[pid] = self.last_activity
+            return pid
+        return True
+
+    def write_publish(self, topic, msg, qos=0):
+        # PUBLISH packet framed like umqtt.simple does, return the packet identifier (0 for QoS 0)
+        # A dict or list is serialised to JSON straight into the socket through a small buffer,
+        # the remaining length is known in advance from json_length().
+        if qos > 1:
+            raise ValueError("QoS 2 is not supported")
+        sock = self.client.sock
+        topic = topic.encode() if isinstance(topic, str) else topic
+        is_json = isinstance(msg, (dict, list))
+        if isinstance(msg, str):
+            msg = msg.encode()
+        header = bytearray(7)
+        header[0] = 0x30 | (qos << 1)
+        size = 2 + len(topic) + (json_length(msg) if is_json else len(msg))
+        if qos:
+            size += 2 # Packet identifier
+        i = 1
+        while size > 0x7F: # Remaining length as a varint
+            header[i] = (size & 0x7F) | 0x80
+            size >>= 7
+            i += 1
+        header[i] = size
+        header[i + 1] = len(topic) >> 8
+        header[i + 2] = len(topic) & 0xFF
+        sock.write(header, i + 3)
+        sock.write(topic)
+        pid = 0
+        if qos:
+            self.pid = self.pid % 0xFFFF + 1 # 1 to 65535, 0 is not a valid identifier
+            pid = self.pid
+            sock.write(bytes((pid >> 8, pid & 0xFF)))
+
+        if is_json:
+            writer = JsonWriter(sock.write)
+            writer.value(msg)
+            writer.flush()
+        else:
+            sock.write(msg)
+        return pid
+
+    def subscribe(self, topic):
+        # Subscribe now if connected and again after every reconnect
+        if topic not in self.topics:
+            self.topics.append(topic)
+            if self.state == CONNECTED:
+                try:
+                    self.client.subscribe(topic)
+                except OSError as error:
+                    self.fail(error)
+
+
+# Requests over a session without blocking, matched to their responses by ID
+# send() publishes a request under a caller-chosen ID. The response arrives through
+# the session callback, which passes its ID to response(). poll() republishes requests
+# whose deadline passed and gives up after `retries` repeats. Several requests can be
+# outstanding at the same time.
+class RequestTracker:
+    def __init__(self, session, topic, timeout=10000, retries=2):
+        self.session = session # MqttSession the requests are published on
+        self.topic = topic # Request topic
+        self.timeout = timeout # ms to wait for a response to one attempt
+        self.retries = retries # Repeats after the first attempt
+        self.pending = {} # [payload, attempts, deadline, topic] by request ID
+
+    def send(self, request_id, payload, topic=None):
+        # Publish a new request, on topic instead of the default one if given
+        self.pending[request_id] = [payload, 0, 0, topic or self.topic]
+        self.attempt(request_id)
+
+    def attempt(self, request_id):
+        request = self.pending[request_id]
+        request[1] += 1
+        request[2] = ticks_add(ticks_ms(), self.timeout)
+        if not self.session.publish(request[3], request[0]): # Offline: the next attempt may find it reconnected
+            print("MQTT %s, request %s not sent (attempt %d)" % (self.session.status(), request_id, request[1]))
+
+    def response(self, request_id):
+        # Called with the ID of an incoming response, return True if it answers a pending request
+        # Responses to other devices, or to requests given up or cancelled, return False.
+        return self.pending.pop(request_id, None) is not None
+
+    def poll(self):
+        # Retry requests whose deadline passed, return the ID of one that has just timed out or None
+        now = ticks_ms()
+        for request_id, request in self.pending.items():
+            if ticks_diff(now, request[2]) < 0:
+                continue
+            if request[1] <= self.retries:
+                self.attempt(request_id)
+                continue
+            del self.pending[request_id]
+            return request_id
+        return None
+
+    def waiting(self, request_id=None):
+        # True while the request (or any request) waits for a response
+        if request_id is None:
+            return bool(self.pending)
+        return request_id in self.pending
+
+    def cancel(self, request_id=None):
+        # Stop waiting for one request, or for all of them
+        if request_id is None:
+            self.pending.clear()
+        else:
+            self.pending.pop(request_id, None)
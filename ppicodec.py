@@ -0,0 +1,142 @@
+# Compact binary format for PPI datasets sent from the device to the gateway
+# The gateway decodes it back into the Kubios JSON dataset (see gateway.py).
+#
+# Layout, all integers little-endian:
+#   0  2 bytes  magic b"PI"
+#   2  1 byte   version (1)
+#   3  1 byte   encoding: DELTA_VARINT or FIXED_U16
+#   4  1 byte   analysis type, index into ANALYSIS_TYPES
+#   5  4 bytes  request ID
+#   9  2 bytes  number of PPIs
+#  11  PPIs: FIXED_U16 stores each as 2 bytes, DELTA_VARINT stores the first value and
+#      then the differences to the previous one, zigzag encoded as 7-bit varints
+#      (1 byte for changes within +-63 ms, 2 bytes up to +-8191 ms).
+MAGIC = b"PI"
+VERSION = 1
+DELTA_VARINT = 0
+FIXED_U16 = 1
+HEADER_SIZE = 11
+ANALYSIS_TYPES = ("readiness",) # Kubios analysis types by their code
+
+
+def zigzag(value):
+    # Map signed to unsigned: 0, -1, 1, -2, ... to 0, 1, 2, 3, ...
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def varint_size(value):
+    size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+
+def encoded_size(ppi_intervals, encoding=DELTA_VARINT):
+    if encoding == FIXED_U16:
+        return HEADER_SIZE + 2 * len(ppi_intervals)
+    size = HEADER_SIZE
+    previous = 0
+    for ppi in ppi_intervals:
+        size += varint_size(zigzag(ppi - previous))
+        previous = ppi
+    return size
+
+
+# Encode a PPI list in ms into one preallocated bytearray, the only allocation made
+def encode(request_id, ppi_intervals, analysis="readiness", encoding=DELTA_VARINT):
+    if encoding not in (DELTA_VARINT, FIXED_U16):
+        raise ValueError("unknown encoding")
+    if analysis not in ANALYSIS_TYPES:
+        raise ValueError("unknown analysis type")
+    if not 0 <= request_id <= 0xFFFFFFFF:
+        raise ValueError("request ID out of range")
+    count = len(ppi_intervals)
+    if count > 0xFFFF:
+        raise ValueError("too many PPIs")
+    buffer = bytearray(encoded_size(ppi_intervals, encoding))
+    buffer[0:2] = MAGIC
+    buffer[2] = VERSION
+    buffer[3] = encoding
+    buffer[4] = ANALYSIS_TYPES.index(analysis)
+    for i in range(4):
+        buffer[5 + i] = (request_id >> (8 * i)) & 0xFF
+    buffer[9] = count & 0xFF
+    buffer[10] = count >> 8
+
+    position = HEADER_SIZE
+    if encoding == FIXED_U16:
+        for ppi in ppi_intervals:
+            if not 0 <= ppi <= 0xFFFF:
+                raise ValueError("PPI out of range")
+            buffer[position] = ppi & 0xFF
+            buffer[position + 1] = (ppi >> 8) & 0xFF
+            position += 2
+        return buffer
+
+    previous = 0
+    for ppi in ppi_intervals:
+        value = zigzag(ppi - previous)
+        previous = ppi
+        while value >= 0x80:
+            buffer[position] = (value & 0x7F) | 0x80
+            value >>= 7
+            position += 1
+        buffer[position] = value
+        position += 1
+    return buffer
+
+
+# Decode a payload made by encode(), return (request ID, analysis type, PPI list)
+def decode(data):
+    if len(data) < HEADER_SIZE or bytes(data[0:2]) != MAGIC:
+        raise ValueError("not a PPI payload")
+    if data[2] != VERSION:
+        raise ValueError("unsupported version %d" % data[2])
+    encoding = data[3]
+    if data[4] >= len(ANALYSIS_TYPES):
+        raise ValueError("unknown analysis type %d" % data[4])
+    analysis = ANALYSIS_TYPES[data[4]]
+    request_id = data[5] | (data[6] << 8) | (data[7] << 16) | (data[8] << 24)
+    count = data[9] | (data[10] << 8)
+
+    ppi_intervals = []
+    position = HEADER_SIZE
+    if encoding == FIXED_U16:
+        if len(data) != HEADER_SIZE + 2 * count:
+            raise ValueError("wrong payload length")
+        for i in range(count):
+            ppi_intervals.append(data[position] | (data[position + 1] << 8))
+            position += 2
+    elif encoding == DELTA_VARINT:
+        previous = 0
+        for i in range(count):
+            value = 0
+            shift = 0
+            while True:
+                if position >= len(data):
+                    raise ValueError("truncated payload")
+                byte = data[position]
+                position += 1
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            previous += (value >> 1) if not value & 1 else -((value + 1) >> 1) # Undo the zigzag mapping
+            ppi_intervals.append(previous)
+        if position != len(data):
+            raise ValueError("wrong payload length")
+    else:
+        raise ValueError("unknown encoding %d" % encoding)
+    return request_id, analysis, ppi_intervals
+
+
+# The Kubios request dataset the device would otherwise send as JSON
+def kubios_dataset(data):
+    request_id, analysis, ppi_intervals = decode(data)
+    return {
+            "id": request_id,
+            "type": "RRI",
+            "data": ppi_intervals,
+            "analysis": {"type": analysis}
+            }
@@ -1,15 +1,31 @@
-from machine import ADC, Pin, I2C # For controlling pins and I2C interface
+from machine import ADC, Pin, I2C, unique_id # For controlling pins and I2C interface
 from piotimer import Piotimer  # Timer for periodic operations
 from ssd1306 import SSD1306_I2C  # Import the SSD1306 OLED display driver
+from display import DirtyOLED, WaveformRenderer, ScreenCache # Partial OLED updates, the live PPG trace and cached screens
 from fifo import Fifo # FIFO queue for buffering data
+from blockadc import DmaBlockReader # ADC DMA block acquisition
+from dsp import SlidingMinMax, BandPassFilter, MovingAverage, BlockRange, parabolic_offset # Streaming signal processing helpers
+from beats import BeatStream, BeatCorrector # Per-beat PPI and heart rate stream
+from hrv import HrvAccumulator, lf_hf, MIN_SPECTRUM_PPIS # Local HRV analysis
 import time # Import time module for timing operations
 import micropython # MicroPython utilities
 micropython.alloc_emergency_exception_buf(200) # Allocate buffer for emergency exception handling
 import network# For WiFi connectivity
 from time import sleep # For delays
-from umqtt.simple import MQTTClient # For MQTT messaging
+from ppicodec import encode as encode_ppi # Compact binary PPI format, expanded to JSON by gateway.py
+from spool import Spool # Results kept on flash until the broker acknowledged them
+from mqttsession import MqttSession, RequestTracker # Long-lived MQTT sessions with reconnect and backoff
 import ujson # For JSON handling
+import _thread # For running the signal processing on the second core
+from array import array # Preallocated sample block
+from scheduler import Scheduler, AsyncFifo, Wakeup, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW # Cooperative tasks instead of the polling loop
 
+PPG_SCALE_BITS = 16 # Fraction bits of the live PPG scale factor, products stay below 2**30
+PPG_SCALE_ROUND = 1 << (PPG_SCALE_BITS - 1) # Half a row for rounding
+USE_SCHEDULER = False # Run the device as uasyncio tasks instead of the polling main loop
+USE_DUAL_CORE = False # Run acquisition, filtering and peak detection on core 1
+CORE1_STOP_TIMEOUT = 100 # ms to wait for core 1 to stop before it is given up
+USE_BINARY_PPI = False # Send Kubios requests in the binary format of ppicodec, needs gateway.py next to the broker
 
 
 # Define a class to manage the heart rate monitoring device
@@ -26,17 +42,27 @@ class Pico:
         
         # Initialize the ADC for the heart rate sensor
         self.sensor = ADC(Pin(sensor_pin)) # Analog input for the heart rate sensor
+        self.adc_channel = sensor_pin - 26 # ADC input number of the sensor pin (GPIO26 is ADC0)
         
         # Set up I2C communication for OLED display
         self.i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000) # Initialize I2C for OLED
         self.oled_width = 128 # OLED width
         self.oled_height = 64 # OLED height
-        self.oled = SSD1306_I2C(self.oled_width, self.oled_height, self.i2c) # Create OLED object
+        self.oled = DirtyOLED(SSD1306_I2C(self.oled_width, self.oled_height, self.i2c)) # Create OLED object with partial updates
+        self.oled.background = True # show() only queues, the main loop sends the data in chunks
+        self.oled_chunk = 128 # Bytes sent per main loop pass, about 3 ms at 400 kHz
+        self.screens = ScreenCache(self.oled) # Static screens rendered once and copied back on demand
         
         # Initialize FIFO queues for button, sensor, and encoder events
-        self.button_fifo = Fifo(30, typecode='i') # FIFO for button events
-        self.sensor_fifo = Fifo(750, typecode='i') # FIFO for sensor readings
-        self.encoder_fifo = Fifo(30, typecode='i') # FIFO for encoder events
+        # Every put() from an interrupt handler also wakes the task waiting for the FIFO
+        self.ui_wakeup = Wakeup() # Shared by the button and encoder FIFOs, both read by the UI task
+        self.button_fifo = AsyncFifo(Fifo(30, typecode='i'), self.ui_wakeup) # FIFO for button events
+        self.sensor_fifo = AsyncFifo(Fifo(750, typecode='i')) # FIFO for sensor readings
+        self.sample_block = array('i', bytes(4 * 50)) # Samples drained from the sensor FIFO in one go
+        self.encoder_fifo = AsyncFifo(Fifo(30, typecode='i'), self.ui_wakeup) # FIFO for encoder events
+        self.menu_redraw = False # Encoder turns moved the selection, the menu needs redrawing
+        self.frame_interval = 40 # Minimum ms between menu redraws (25 frames per second)
+        self.last_frame = 0 # Time of the last menu redraw
         
         # Variables to manage debounce for buttons
         self.last_press_time_sw1 = 0 # Last press time for SW_1
@@ -54,14 +80,35 @@ class Pico:
         
         # Initialize measurement variables
         self.sensor_timer = None # Timer for sensor
+        self.use_dma = False # Acquire samples in DMA blocks instead of one Piotimer callback per sample
+        self.block_reader = None # DMA block reader while a measurement is running
         self.option = 0 # Initialize highlighted menu item
         self.measurement_on = False# Flag to indicate if measurement is active
         self.threshold = 0 # Peak detection threshold
         self.thresval = 0.8 # Relative threshold multiplier
         self.max_value = 0 # Maximum sensor value for peak detection
+        self.max_position = 0 # Sample count of the maximum
+        self.before_max = 0 # Sample before the maximum
+        self.after_max = 0 # Sample after the maximum
+        self.after_max_pending = False # True until the sample after the maximum has arrived
+        self.previous_value = 0 # Previous sample seen by peak detection
+        self.peak_handler = self.calculate_hr # Receives each detected peak position
+        
+        # Dual-core mode: core 1 runs acquisition, filtering and peak detection,
+        # core 0 gets peaks and waveform samples through lock-free FIFOs (one writer, one reader each)
+        self.dual_core = USE_DUAL_CORE # Run the signal processing on core 1, cleared if core 1 fails
+        self.beat_fifo = Fifo(30, typecode='f') # Peak positions from core 1
+        self.wave_fifo = Fifo(250, typecode='i') # Samples for the live PPG view from core 1
+        self.core1_running = False # Cleared by core 0 to stop core 1
+        self.core1_done = True # Set by core 1 when its loop has ended
+        self.window = SlidingMinMax(750) # Min and max of the last 750 samples (3 s) for the threshold
+        self.signal_filter = BandPassFilter(0.5, 5, 250) # Band-pass ahead of peak detection, None for raw samples
+        self.warmup_samples = 0 if self.signal_filter else 999 # Noisy samples discarded at the start
+        self.threshold_start = self.warmup_samples + 250 # Sample count at which peak detection starts
         self.count = 0 # Counter for samples
-        self.peaks = [] # List of detected peak positions
-        self.hr_values = [] # List of calculated heart rate values
+        self.beats = BeatStream(capacity=32, sample_rate=250, smoothing='median', window=5,
+                                corrector=BeatCorrector()) # Latest beats as PPI and HR, artifacts corrected
+        self.hrv = HrvAccumulator() # Running mean HR, mean PPI, RMSSD and SDNN of the measurement
         self.hr_value = 0 # Current heart rate value to display
         self.ppi_intervals = []  # List of Peak-to-Peak Intervals (PPI)
         
@@ -71,12 +118,27 @@ class Pico:
         self.BROKER_IP = "192.168.8.253"
         self.wlan = None
         #self.connect_wlan() # Connect to WiFi
-        self.mqtt_client = None
+        self.mqtt_hrv = MqttSession(self.BROKER_IP) # Session for the basic HRV results, kept for the whole run
+        self.mqtt_kubios = MqttSession(self.BROKER_IP, 21883, callback=self.mqtt_callback) # Session for Kubios Cloud requests
+        self.mqtt_client = None # Session used by the current measurement
+        self.kubios_request = RequestTracker(self.mqtt_kubios, "kubios-request", timeout=10000, retries=2) # Waits for Kubios responses without blocking
+        board_id = unique_id()
+        self.device_id = ((board_id[-2] << 8) | board_id[-1]) & 0x7FFF # From the flash serial number, tells this device's requests apart
+        self.request_sequence = 0 # Number of Kubios requests sent
+        self.kubios_request_id = None # ID of the request of the current measurement
+        self.binary_ppi = USE_BINARY_PPI # Send Kubios PPIs in the compact binary format through the gateway
+        self.mqtt_poll_interval = 100 # ms between keepalive and incoming message checks
+        self.spool = Spool("spool.txt", limit=20) # HRV results waiting for the broker, survives restarts
+        self.last_mqtt_poll = 0
+        self.reconnect_idle = 2000 # ms without user input before a reconnect may block the main loop
+        self.last_input = 0 # Time of the last encoder or button event
+        self.mqtt_shown_state = None # Connection state on the collecting data screen
         
         
         # Variables for storing data and menu states
         self.json_message = {}# To store data in json format to publish 
         self.kubios_response = {}# To store Kubios Cloud analysis response
+        self.network_job = None # MQTT or Kubios work queued by the measurement for the network task
         self.kubios_measurement = {}# To store Kubios Cloud analysis response for saving and displaying
         self.timestamp = 0
         self.hrv_measurement = {}# To store basic hrv analysis data
@@ -85,11 +147,14 @@ class Pico:
         self.in_history_data = False  # Flag to indicate if viewing history data
 
         # Initialize OLED live PPG signal variables
-        self.PPG_raw = [] # Stores raw sensor data for OLED live PPG signal
-        self.PPG_scaled = [-1]*128 # Stores scaled sensor data for OLED live PPG signal
-        self.PPG_average = [] # Stores average sensor data for OLED live PPG signal
+        self.PPG_range = BlockRange(3*128, 5) # Min and max of 5-sample averages over every 384 samples
+        self.PPG_waveform = WaveformRenderer(self.oled, width=self.oled_width, height=56, gap=8, lines=True) # Draws the trace column by column
+        self.PPG_refresh = 10 # New columns between OLED updates of the live PPG signal
+        self.PPG_average = MovingAverage(10) # Smooths the sensor data for OLED live PPG signal
         self.min_PPG = 0 # Historical min for scaling
         self.max_PPG = 0 # Historical max for scaling
+        self.range_PPG = 1 # max_PPG - min_PPG, at least 1
+        self.scale_PPG = 0 # 55 / range_PPG with PPG_SCALE_BITS fraction bits
         self.OLED_current_x = 0 # Keeps track of PPG signal between refreshes
         
         self.screen_timer = None # Timer for screen updates
@@ -131,7 +196,10 @@ class Pico:
             
             
     def display_main_menu(self):
-        # Display the menu on the OLED screen
+        # Display the menu on the OLED screen, one cached screen per highlighted option
+        self.screens.show(("menu", self.option), self.render_main_menu)
+        
+    def render_main_menu(self):
         self.oled.fill(0) # Clear the OLED screen
         
         y_position = 0
@@ -148,12 +216,13 @@ class Pico:
                 self.oled.text(options[i], 0, y_position, 1) # Display other options in white color
 
             y_position += 12 # Move down for the next option
-
-        self.oled.show() # Update the OLED display with new content
         
          
     def display_instruction1(self):
         # Display instructions for starting heart rate measurement
+        self.screens.show(("instruction", 1), self.render_instruction1)
+        
+    def render_instruction1(self):
         self.oled.fill(0)  # Clear the OLED screen
         lines = [
         "START",
@@ -167,17 +236,17 @@ class Pico:
         for i, line in enumerate(lines):
             self.oled.text(line, 0, int(self.oled_height / 2) - 30 + i * 10, 1)
         
-        self.oled.show() # Update the OLED display
-        
         
     def display_instruction_HR(self):
         # Display instructions for stopping heart rate measurement
+        self.screens.show(("instruction", 2), self.render_instruction_HR)
+        
+    def render_instruction_HR(self):
         self.oled.fill(0) # Clear OLED screen
         instruction_line1 = "PRESS SW1 BUTTON"
         instruction_line2 = "TO STOP"
         self.oled.text(instruction_line1, 0,  30, 1)
         self.oled.text(instruction_line2, 32, 40, 1)
-        self.oled.show() # Update the OLED display
         
     # Clear the sensor FIFO by consuming all data        
     def empty_sensor_fifo(self):
@@ -193,80 +262,80 @@ class Pico:
     
     # Calculate the threshold for peak detection
     def set_threshold(self):
-        #self.max_PPG = max(self.sensor_fifo.data)
-        #self.min_PPG = min(self.sensor_fifo.data)
-        h = max(self.sensor_fifo.data) - min(self.sensor_fifo.data) # Calculate range
-        self.threshold = min(self.sensor_fifo.data) + self.thresval * h # Set threshold
-        self.max_value = self.threshold # Initialize max_value
+        in_peak = self.max_value > self.threshold # A peak above the old threshold is being tracked
+        low = self.window.min() # Smallest of the latest samples
+        h = self.window.max() - low # Calculate range
+        self.threshold = low + self.thresval * h # Set threshold
+        if not in_peak or self.max_value <= self.threshold: # Keep a running peak so its apex is not lost
+            self.max_value = self.threshold # Initialize max_value
+        
+    
+    # Return peak detection to its initial state
+    def reset_peak_detection(self):
+        self.threshold = 0
+        self.max_value = 0
+        self.max_position = 0
+        self.before_max = 0
+        self.after_max = 0
+        self.after_max_pending = False
+        self.previous_value = 0
         
     
     # Detect peaks in the filtered signal   
     def detect_peaks(self, value):
         if value > self.max_value:
             self.max_value = value # Update maximum value
-        elif value < self.threshold and self.max_value > self.threshold: # Check for peaks
-            self.peaks.append(self.count) # Record peak position
-            self.max_value = self.threshold # Reset max value
+            self.max_position = self.count # Remember where the maximum is
+            self.before_max = self.previous_value # and its left neighbour
+            self.after_max_pending = True
+        else:
+            if self.after_max_pending: # Right neighbour of the maximum
+                self.after_max = value
+                self.after_max_pending = False
+            if value < self.threshold and self.max_value > self.threshold: # Check for peaks
+                # Locate the apex between samples with a parabola through the maximum and its neighbours
+                peak = self.max_position + parabolic_offset(self.before_max, self.max_value, self.after_max)
+                self.max_value = self.threshold # Reset max value
+                self.peak_handler(peak) # Turn the peak into a PPI and heart rate right away (or queue it for core 0)
+        self.previous_value = value
             
             
-    # Calculate heart rate from detected peaks
-    def calculate_hr(self):
-        if len(self.peaks) > 2:
-            num_samples = self.peaks[-1] - self.peaks[-2] # Time difference between peaks
-
-            if num_samples > 0: # Ensure the sample distance is positive
-                ppi_seconds = num_samples * 0.004 # Calculate the time between peaks in seconds (0.004 seconds per sample)
-
-                if ppi_seconds > 0: # If the time between peaks is positive
-                    hr = 60 / ppi_seconds # Calculate the heart rate in beats per minute (bpm)
-                   
-                    if hr > 30 and hr < 200: # Only consider valid heart rates
-                        self.hr_values.append(hr) # Append the valid heart rate to the hr_values list
-                        print(hr) # Print the heart rate value
-                        
-                        
-                        self.peaks = self.peaks[-1:] # Keep only the latest peak
-                        if self.option == 1 or self.option == 2: # If the HRV analysis or the Kubios menu is selected
-                            self.ppi_intervals.append(int(ppi_seconds*1000)) # Store the PPI value in milliseconds
+    # Calculate heart rate for each detected peak
+    def calculate_hr(self, peak):
+        # A peak gives no beat (first peak, invalid heart rate, held possible extra beat),
+        # one beat, or several when the corrector splits an interval with missed peaks
+        new_beats = self.beats.add_peak(peak)
+        for age in range(new_beats - 1, -1, -1): # Oldest new beat first
+            ppi = self.beats.ppi_at(age) # PPI in milliseconds from fractional sample positions
+            self.hrv.add(ppi) # Update the running HRV values
+            print(60000 // ppi, "(corrected)" if self.beats.flag_at(age) else "") # Print the heart rate value
+            
+            if self.option == 0: # If in the HR measurement mode
+                self.hr_display_flag = True # Show the new value without waiting for the screen timer
+            elif self.option == 1 or self.option == 2: # If the HRV analysis or the Kubios menu is selected
+                self.ppi_intervals.append(ppi) # Store the PPI value in milliseconds
                         
     
     def set_sensor_timer(self):
         # Set up a timer to read sensor data periodically
-        self.sensor_timer = Piotimer(period=4, mode=Piotimer.PERIODIC, callback=self.read_sensor)                      
+        if self.use_dma: # Let the ADC run free and collect blocks with DMA instead
+            self.block_reader = DmaBlockReader(self.adc_channel, sample_rate=250)
+            self.block_reader.start()
+        else:
+            self.sensor_timer = Piotimer(period=4, mode=Piotimer.PERIODIC, callback=self.read_sensor)                      
     
+    def stop_sensor_timer(self):
+        # Stop sampling, whichever acquisition mode is active
+        if self.core1_running: # Stop the signal processing on core 1 first
+            self.stop_dsp_core()
+        if self.sensor_timer:  # Check if sensor_timer exists
+            self.sensor_timer.deinit()  # Stop the sensor_timer
+            self.sensor_timer = None  # Reset sensor_timer reference
+        if self.block_reader:  # Check if the DMA block reader exists
+            self.block_reader.stop()  # Stop the ADC and release the DMA channels
+            self.block_reader = None  # Reset block_reader reference
+
 
-    def calculate_rmssd(self):
-        # Calculate RMSSD (Root Mean Square of Successive Differences)
-        differences = [] # List to store successive differences
-        for i in range(len(self.ppi_intervals) - 1): 
-            difference = self.ppi_intervals[i + 1] - self.ppi_intervals[i] # Calculate the difference between consecutive PPI values
-            differences.append(difference) # Store the difference
-        
-        squared_differences = [] # Square the differences
-        for diff in differences:
-            squared_differences.append(diff**2)
-            
-        mean_squared_difference = sum(squared_differences) / len(squared_differences) # Calculate the mean squared difference
-        
-        
-    
-        return int(mean_squared_difference ** 0.5)  # Calculate the square root of the mean squared difference and return it
-    
-    
-    def calculate_sdnn(self, m_ppi):
-        # Calculate SDNN (Standard Deviation of NN intervals)
-        
-        # Calculate squared differences from the mean PPI
-        differences = []
-        for i in range(len(self.ppi_intervals)):
-            difference = m_ppi - self.ppi_intervals[i]
-            differences.append(difference ** 2)
-        # Calculate the average of the squared differences
-        avg_differences = sum(differences) / len(differences)
-        
-        return int(avg_differences ** 0.5) # Calculate the square root of the average squared difference and return int
-    
-    
     def get_timestamp(self):
         # Generate a human-readable timestamp from the current time
         ts = time.gmtime()
@@ -274,44 +343,40 @@ class Pico:
     
 
     def calculate_hrv(self):
-        # Calculate HRV metrics (mean HR, mean PPI, RMSSD, and SDNN)
-        mean_hr = int(sum(self.hr_values) / len(self.hr_values))  # Calculate the mean heart rate
-        mean_ppi = int(sum(self.ppi_intervals) / len(self.ppi_intervals)) # Calculate the mean PPI
-        rmssd = self.calculate_rmssd() # Calculate RMSSD
-        sdnn = self.calculate_sdnn(mean_ppi) # Calculate SDNN
-        
-         # Store the calculated HRV metrics in a dictionary
-        self.hrv_measurement = { 
-                        "mean_hr": mean_hr, 
-                        "mean_ppi": mean_ppi, 
-                        "rmssd": rmssd, 
-                        "sdnn": sdnn 
-                        }
-        
-        # Convert the HRV metrics dictionary into a JSON-formatted string
-        self.json_message = ujson.dumps(self.hrv_measurement)
+        # Read the HRV metrics (mean HR, mean PPI, RMSSD, SDNN and extended metrics), kept up to date beat by beat
+        self.hrv_measurement = self.hrv.values()
+        self.hrv_measurement.update(self.hrv.metrics()) # pNN50, SD1, SD2, triangular index and stress index
+        self.hrv_measurement["corrected_beats"] = self.beats.corrected # Beats changed by artifact correction
+        if len(self.ppi_intervals) >= MIN_SPECTRUM_PPIS: # Frequency-domain HRV (LF, HF and LF/HF) computed on the device
+            self.hrv_measurement.update(lf_hf(self.ppi_intervals))
+        
+        # Message to publish, serialised to JSON by the spool
+        self.json_message = self.hrv_measurement
      
         self.send_mqtt_message_hrv() # Send the HRV metrics to an MQTT topic
         self.display_hrv()
         self.save_data() # Save the HRV metrics to a file
     
     def send_mqtt_message_hrv(self):
-        # Publish the HRV metrics to an MQTT broker if the option is in Basic hrv 
+        # Spool the HRV metrics and publish what the spool holds if the option is in Basic hrv
+        # Without a connection the result stays on flash and poll_mqtt sends it later.
         if self.json_message: # Ensure there is data to send
-            message = self.json_message
             topic = "project"
-            self.mqtt_client.publish(topic, self.json_message) # Publish the message
-            print(f"Sending to MQTT: {topic} -> {message}") # print the message being sent
+            seq = self.spool.add(topic, self.hrv_measurement)
+            if not self.spool.drain(self.mqtt_hrv):
+                print(f"MQTT {self.mqtt_hrv.status()}, result {seq} spooled ({len(self.spool)} waiting)")
         
     def send_mqtt_message_kubios(self):
         # Publish the HRV metrics to an MQTT broker if the option is in kubios 
         if self.json_message: # Ensure there is data to send
             message = self.json_message
-            topic = "kubios-request"
-            self.mqtt_client.publish(topic, self.json_message) # Publish the message
-            print(f"Sending to MQTT: {topic} -> {message}") # print the message being sent
-        
-            self.mqtt_client.wait_msg()
+            if self.binary_ppi:
+                topic = "kubios-request-bin" # Translated to kubios-request by the gateway
+                print(f"Sending to MQTT: {topic} -> {len(message)} bytes")
+            else:
+                topic = "kubios-request"
+                print(f"Sending to MQTT: {topic} -> {len(self.ppi_intervals)} PPIs") # print the message being sent
+            self.kubios_request.send(self.kubios_request_id, message, topic) # The response is handled by mqtt_callback, poll_mqtt retries or gives up
 
    
     def connect_wlan(self):
@@ -332,43 +397,64 @@ class Pico:
 
     def connect_mqtt_hrv(self):
         # Connect to the MQTT broker if the option is in basic hrv
-        self.mqtt_client=MQTTClient("", self.BROKER_IP) # Initialize the MQTT client with the broker IP
-        self.mqtt_client.connect(clean_session=True)  # Establish the connection with a clean session
+        self.mqtt_client = self.mqtt_hrv
+        self.mqtt_client.start() # Connects only if the session is not up already
 
     
     def connect_mqtt_kubios(self):
         # Connect to the MQTT broker if the option is in kubios
-        self.mqtt_client=MQTTClient("", self.BROKER_IP, 21883) # Initialize the MQTT client with the broker IP
-        self.mqtt_client.set_callback(self.mqtt_callback) # Set the callback function for handling incoming messages
-        self.mqtt_client.connect(clean_session=True)  # Establish the connection with a clean session
+        self.mqtt_client = self.mqtt_kubios # Incoming messages go to mqtt_callback
+        self.mqtt_client.start() # Connects only if the session is not up already
     
     
     def mqtt_callback(self, topic, msg):
         # This function is the callback to handle incoming MQTT messages.
-        self.kubios_response = msg.decode('utf-8') # Store the decoded message in the class variable `kubios_response`.
+        # Every device receives all responses on kubios-response, only those with one of our request IDs are used
+        try:
+            response = ujson.loads(msg)
+        except ValueError:
+            return
+        request_id = response.get("id") if isinstance(response, dict) else None
+        if not self.kubios_request.response(request_id): # Another device's response, or one no longer awaited
+            return
+        if request_id != self.kubios_request_id: # Answer to an earlier measurement
+            return
+        self.kubios_response = response # Store the parsed message in the class variable `kubios_response`.
         self.get_response_data_from_Kubios()  # Call a method to process the received data from Kubios.
 
     
     def create_kubios_request(self):
-        # Subscribe to the response topic to listen for Kubios Cloud's response
+        # Subscribe to the response topic to listen for Kubios Cloud's response (kept across reconnects)
         self.mqtt_client.subscribe("kubios-response")
         # Create a dataset for the request, including an ID, type, PPI intervals, and analysis type
+        self.kubios_request_id = self.next_request_id()
+        if self.binary_ppi: # 1-2 bytes per PPI instead of about 5 characters of JSON, gateway.py expands it
+            self.json_message = encode_ppi(self.kubios_request_id, self.ppi_intervals, "readiness")
+            self.send_mqtt_message_kubios()
+            return
         dataset = {
-                    "id": 123,
+                    "id": self.kubios_request_id,
                     "type": "RRI", 
                     "data": self.ppi_intervals, 
                     "analysis": {"type": "readiness"} 
                     }
-        # Convert the dataset into a JSON-formatted string for transmission
-        self.json_message = ujson.dumps(dataset)
+        # Keep the dataset as it is, the session writes its JSON straight into the socket
+        # instead of building the whole string in RAM first
+        self.json_message = dataset
         # Send the created JSON message to Kubios Cloud via MQTT
         self.send_mqtt_message_kubios()
         
     
 
+    def next_request_id(self):
+        # Unique request ID: device ID in the upper bits, sequence number in the lower 16
+        self.request_sequence = (self.request_sequence + 1) & 0xFFFF
+        return (self.device_id << 16) | self.request_sequence
+        
+        
     def get_response_data_from_Kubios(self):
         if self.kubios_response:
-            response = ujson.loads(self.kubios_response) # Parse the analysis results
+            response = self.kubios_response # Analysis results parsed by mqtt_callback
             # Extract HRV metrics and PNS/SNS values from the response
             mean_hr = int(response["data"]["analysis"]["mean_hr_bpm"])  
             mean_ppi = int(response["data"]["analysis"]["mean_rr_ms"])  
@@ -440,6 +526,7 @@ class Pico:
         # Append the new data as a JSON string into the history file
         with open('history.txt', 'a') as file:
             file.write(f"{ujson.dumps(data)}\n")
+        self.screens.invalidate("history") # The history menu changed
         
         # Read all lines from the history file to manage its size
         with open('history.txt', 'r') as file:
@@ -467,6 +554,8 @@ class Pico:
         instruction_line = "PRESS SW1 BUTTON"
         
         hrv_list = [hr_line, ppi_line, rmssd_line, sdnn_line]
+        if "lf_hf" in self.hrv_measurement: # Add the local frequency-domain result when available
+            hrv_list.append(f"LF/HF: {self.hrv_measurement['lf_hf']}")
         
         # Loop through each line and display it on the OLED
         for i in hrv_list:
@@ -503,8 +592,22 @@ class Pico:
         
         
     
+    def display_kubios_timeout(self):
+        # Kubios did not answer, the user returns to the menu with SW1
+        self.screens.show(("status", 3), self.render_kubios_timeout)
+        
+    def render_kubios_timeout(self):
+        self.oled.fill(0)
+        self.oled.text("NO RESPONSE", 20, 12)
+        self.oled.text("FROM KUBIOS", 20, 22)
+        self.oled.text("PRESS SW1 TO", 16, 40)
+        self.oled.text("RETURN", 40, 50)
+        
     def display_history_menu(self):
-        # Display the history menu on the OLED screen
+        # Display the history menu on the OLED screen, cached until save_data changes the history
+        self.screens.show(("history", self.history_option), self.render_history_menu)
+        
+    def render_history_menu(self):
         self.oled.fill(0) # Clear the OLED screen
         y_position = 0 # Starting vertical position for the menu items
         
@@ -541,9 +644,6 @@ class Pico:
         # Add return instructions at the bottom of the screen
         self.oled.text(instruction_text1, 0, 44, 1)
         self.oled.text(instruction_text2, 0, 56, 1)
-            
-       
-        self.oled.show() # Update the OLED display with new content
         
     def display_history(self):
         # Display the selected history entry on the OLED screen
@@ -560,16 +660,16 @@ class Pico:
             if i == self.history_option: # Find the selected history option
                 # Extract main HRV data from the entry
                 timestamp_line = data[i]["timestamp"]
-                mean_hr_line = f"MEAN HR: {data[i]["mean_hr"]}"
-                mean_ppi_line = f"MEAN PPI: {data[i]["mean_ppi"]}"
-                rmssd_line = f"RMSSD: {data[i]["rmssd"]}"
-                sdnn_line = f"SDNN: {data[i]["sdnn"]}"
+                mean_hr_line = f"MEAN HR: {data[i]['mean_hr']}"
+                mean_ppi_line = f"MEAN PPI: {data[i]['mean_ppi']}"
+                rmssd_line = f"RMSSD: {data[i]['rmssd']}"
+                sdnn_line = f"SDNN: {data[i]['sdnn']}"
                 history_data = [timestamp_line, mean_hr_line, mean_ppi_line, rmssd_line, sdnn_line]
                 
                 # If the entry is a Kubios result, extract additional data
                 if data[i]["option"] == "kubios":
-                    sns_line = f"SNS: {data[i]["sns"]}"
-                    pns_line = f"PNS: {data[i]["pns"]}"
+                    sns_line = f"SNS: {data[i]['sns']}"
+                    pns_line = f"PNS: {data[i]['pns']}"
                     kubios_data = [sns_line, pns_line]
                     history_data.extend(kubios_data) # Add Kubios data to the main history data
                     
@@ -584,81 +684,59 @@ class Pico:
         self.oled.show() # Update the OLED display
         
     def scale_PPG_value(self, value): 
-        scaledValue = 55 - (value - self.min_PPG)*(55 / (self.max_PPG - self.min_PPG)) # Scale the PPG value
-        if scaledValue < 0: # Ensure the value is within the OLED range
-            scaledValue = 0
-        elif scaledValue > 55: 
-            scaledValue = 55
-        return int(scaledValue) # Return the scaled value
+        # Integer-only scaling with the factor precomputed by update_min_max_for_scaling
+        offset = value - self.min_PPG
+        if offset <= 0: # Ensure the value is within the OLED range
+            return 55
+        if offset >= self.range_PPG:
+            return 0
+        return 55 - ((offset * self.scale_PPG + PPG_SCALE_ROUND) >> PPG_SCALE_BITS) # Scale the PPG value
     
-    def update_min_max_for_scaling(self, rawData):
-        # Try different ways: average vs not
-        if True:
-            # Calculate the average of every 5 consecutive values
-            averaged_data = [sum(rawData[i:i+5]) / 5 for i in range(0, len(rawData), 5) if len(rawData[i:i+5]) == 5]
-            
-            # Update min and max values based on the averaged data
-            self.min_PPG = min(averaged_data) if averaged_data else None
-            self.max_PPG = max(averaged_data) if averaged_data else None
-        else:
-            self.min_PPG = min(rawData)
-            self.max_PPG = max(rawData)
+    def update_min_max_for_scaling(self, low, high):
+        # Range of the 5-sample averages of the last block
+        self.min_PPG = low
+        self.max_PPG = high
+        self.range_PPG = max(high - low, 1) # Avoid dividing by zero on a flat signal
+        self.scale_PPG = (55 << PPG_SCALE_BITS) // self.range_PPG # Rows per ADC count in fixed-point
     
 
-    def delete_trail(self):
-        # Delete the trail of the PPG signal
-        for i in range(8):
-            index = (self.current_x + i) % 128  # Calculate the index with wrap-around
-            self.oled.pixel(index, self.PPG_scaled[index], 0)  # Clear the pixel on the OLED screen
-    
     def update_live_PPG(self, sampleValue):
-        self.PPG_raw.append(sampleValue) # Stores raw sensor data for OLED live PPG signal
-        multiplier = 3 # Multiplier for number of samples to collect for min and max
-
-        if len(self.PPG_raw) == (multiplier*128): # Update min and max values every x samples
-            self.update_min_max_for_scaling(self.PPG_raw) # Update min and max values for scaling
-            self.PPG_raw = [] # Clear the raw sensor data list
+        if self.PPG_range.push(sampleValue): # Update min and max values every 3*128 samples
+            self.update_min_max_for_scaling(self.PPG_range.low, self.PPG_range.high)
             
         if self.max_PPG == 0:
             return
         
-        self.PPG_average.append(sampleValue) # Stores average sensor data for OLED live PPG signal
-        
-        averaging_multiplier = 10
-        if len(self.PPG_average) == averaging_multiplier: # Update averaging last x samples
-            sampleValue = sum(self.PPG_average) // len(self.PPG_average)
-            self.PPG_average.pop(0)
-        else:
+        self.PPG_average.push(sampleValue) # Averaging last x samples
+        if not self.PPG_average.full():
             return
+        sampleValue = self.PPG_average.mean()
 
-        self.current_x = self.OLED_current_x % 128 # Calculate the current x position with wrap-around
-        self.PPG_scaled[self.current_x] = self.scale_PPG_value(sampleValue) # Scale the PPG value
+        self.PPG_waveform.push(self.scale_PPG_value(sampleValue)) # Draw the scaled value in the next column
         self.OLED_current_x += 1
         
-        #print((self.current_x-1), len(self.PPG_scaled), self.scale_PPG_value(sampleValue))
-        # update OLED every x new values
-        if (self.OLED_current_x % 30) != 0:
+        # update OLED every x new values, only the changed columns are sent
+        if (self.OLED_current_x % self.PPG_refresh) != 0:
             return
         
-        self.oled.fill_rect(0, 0, self.oled_width, 56, 0)
-        for index, value in enumerate(self.PPG_scaled): # Draw the PPG signal on the OLED
-            if value == -1:
-                continue
-            self.oled.pixel(index, value, 1) # Draw a pixel at the scaled PPG value
-
-        self.delete_trail() # Delete the trail of the PPG signal
         self.oled.show()
     
     def reset_PPG_variables(self):
         # Reset variables after measurement
-        self.PPG_raw = [] # Stores raw sensor data for OLED live PPG signal
-        self.PPG_scaled = [-1]*128 # Stores scaled sensor data for OLED live PPG signal
-        self.PPG_average = [] # Stores average sensor data for OLED live PPG signal
+        self.PPG_range.reset() # Start a new block for the min and max
+        self.PPG_waveform.reset() # Forget the drawn trace
+        self.PPG_average.reset() # Forget the averaged sensor data
         self.min_PPG = 0 # Historical min for scaling
         self.max_PPG = 0 # Historical max for scaling
+        self.range_PPG = 1
+        self.scale_PPG = 0
         self.OLED_current_x = 0 # Keeps track of PPG signal between refreshes
         
     def show_collecting_data(self):
+        self.mqtt_shown_state = self.mqtt_client.state if self.mqtt_client else None
+        self.screens.show(("status", 1, self.mqtt_shown_state), self.render_collecting_data)
+        
+    def render_collecting_data(self):
         self.oled.fill(0)
         text_1 = "COLLECTING"
         text_2 = "DATA..."
@@ -668,24 +746,28 @@ class Pico:
         text_x_2 = text_x_1 + 16
         self.oled.text(text_1, text_x_1, text_y_1)
         self.oled.text(text_2, text_x_2, text_y_2)
-        self.oled.show()
+        if self.mqtt_shown_state:
+            self.oled.text("MQTT " + self.mqtt_shown_state, 0, 56) # Connection state of the session
         
     def show_sending_data(self):
+        self.screens.show(("status", 2), self.render_sending_data)
+        self.oled.flush() # Sampling is stopped and the network calls that follow block, send it now
+        
+    def render_sending_data(self):
         self.oled.fill(0)
         text = "SENDING DATA..."
         text_y = 63//2 - 4
         text_x = 10
         self.oled.text(text, text_x, text_y)
-        self.oled.show()
         
     def set_screen_timer(self):
         # Set a timer to periodically update the OLED display
-        self.screen_timer = Piotimer(period=5000, mode=Piotimer.PERIODIC, callback=pico.display_hr_flag)
+        self.screen_timer = Piotimer(period=5000, mode=Piotimer.PERIODIC, callback=self.display_hr_flag)
 
 
     def display_hr_flag(self, timer):
         # Set a flag to indicate that the OLED screen should be updated
-        if self.hr_values:  # Check if there are any calculated heart rate values in the hr_values list.
+        if self.beats.count:  # Check if there are any calculated heart rate values.
             self.hr_display_flag = True  # Set the flag to True to indicate the display needs to be updated.
             
     # Update the OLED with the current heart rate
@@ -697,165 +779,415 @@ class Pico:
         self.oled.text(hr_value_line, 32, 57, 1) # Display heart rate
         
         self.oled.show() # Update the OLED display
-
         
-# Instantiate the Pico class with appropriate GPIO pin numbers
-# sw1_pin=8, sensor_pin=27, rot_a=10, rot_b=11, e_switch=12
-pico = Pico(7, 8, 27, 10, 11, 12)
-
-# Display the main menu on the OLED screen
-pico.display_main_menu()
-
-# Main loop to process events and update heart rate
-while True:
-    # Handle events from the rotary encoder (turns and button press)
-    if pico.encoder_fifo.has_data():
-        encoder_data = pico.encoder_fifo.get() # Get the data from the FIFO
         
-        if encoder_data == 2: # If the encoder button is pressed
-            if not pico.in_history_menu: # If not in the history menu
-                if pico.option == 3:  # If the History option is selected
-                    pico.in_history_menu = True # Enter the history menu
-                    pico.display_history_menu()  # Display the history menu
-                else: # For other menu options
-                    pico.display_instruction1()  # Show the instructions for starting measurement
+    def process_sample(self, sample):
+        # Process one sensor sample from the FIFO or from a DMA block
+        if not self.measurement_on:
+            return
+        
+        detecting = self.process_dsp(sample) # Filter the sample and detect peaks
+        
+        if self.count == 1 and self.option == 0: # On the first sample
+            self.display_instruction_HR() # Show stop instructions
             
-            else: # If already in the history menu
-                pico.display_history() # Display the selected history data
-                pico.in_history_data = True # Mark that history data is being displayed
-     
+        if detecting:
+            self.process_results(sample)
+            
+            
+    def process_block(self, block, n):
+        # Process the first n samples of a block with the per-sample lookups hoisted out of the loop
+        # Samples before detection starts take the general path of process_sample.
+        i = 0
+        while i < n and self.count < self.threshold_start:
+            self.process_sample(block[i])
+            i += 1
+        if i == n or not self.measurement_on:
+            return
+        
+        process = self.signal_filter.process if self.signal_filter else None
+        push = self.window.push
+        set_threshold = self.set_threshold
+        detect_peaks = self.detect_peaks
+        process_results = self.process_results
+        count = self.count
+        while i < n:
+            sample = block[i]
+            count += 1
+            self.count = count # detect_peaks records the position of the maximum
+            value = process(sample) if process else sample
+            push(value)
+            if count % 125 == 0: # Set threshold periodically
+                set_threshold()
+            detect_peaks(value)
+            process_results(sample)
+            i += 1
+            
+            
+    def drain_sensor_fifo(self):
+        # Move the samples waiting in the sensor FIFO into sample_block, return how many
+        fifo = self.sensor_fifo
+        block = self.sample_block
+        size = len(block)
+        n = 0
+        while n < size and fifo.has_data():
+            block[n] = fifo.get()
+            n += 1
+        return n
+        
+        
+    def process_dsp(self, sample):
+        # Signal processing part of a sample; returns True once peak detection has started
+        self.count += 1 # Increment the sample counter
+        
+        if self.count <= self.warmup_samples: # Ignore the initial noise of the raw signal
+            self.empty_sensor_fifo()  # Clear the FIFO to discard noisy data
+            return False
+        
+        value = sample
+        if self.signal_filter: # Band-pass the signal for peak detection
+            if self.count == self.warmup_samples + 1: # First sample used
+                self.signal_filter.prime(sample) # Start from the current level without a transient
+            value = self.signal_filter.process(sample)
+        self.window.push(value) # Track min and max of the latest samples for the threshold
+
+        if self.count < self.threshold_start: # Start processing once the threshold window has data
+            return False
         
-        if encoder_data == -1: # Check for counter-clockwise turn event
-            if pico.in_history_menu: # If in the history menu
-                if pico.history_option > 0: # Ensure it doesn't go out of bounds
-                    pico.history_option -= 1 # Move the selection up
-                    pico.display_history_menu() # Update the history menu display
-            else: # If in the main menu
-                if pico.option > 0: # Ensure it doesn't go out of bounds
-                    pico.option -= 1 # Move highlight up in the menu
-                    pico.display_main_menu() # Update the menu display
+        if self.count == self.threshold_start or self.count % 125 == 0:  # Set threshold periodically
+            self.set_threshold()# Set threshold for peak detection
+            
+        self.detect_peaks(value)# Detect peaks and calculate the heart rate of each beat
+        return True
+    
+    
+    def process_results(self, sample):
+        # Display and measurement part of a sample that went through peak detection
+        if self.option == 0: # If in the HR measurement mode
+            
+            self.update_live_PPG(sample) # Update the live PPG signal on the OLED
+            
+            if self.hr_display_flag and self.beats.count: # Check if the OLED needs updating
+                self.hr_value = self.beats.smoothed_hr() # Get the smoothed latest heart rate
+                self.display_hr() # Update OLED display with the heart rate
+                self.hr_display_flag = False # Reset display flag
+
+
+        elif self.option == 1 and not self.hrv_measurement: # If in HRV analysis mode
+            if self.count > self.threshold_start + 7500 and self.hrv.count > 2 and not self.network_job: # Process HRV metrics after sufficient data is collected
+                self.show_sending_data()
+                self.stop_sensor_timer() # Stop sampling
                 
-        elif encoder_data == 1:  # Check for clockwise turn event
-            if pico.in_history_menu: # If in the history menu
-                if pico.history_option < 2: # Ensure it doesn't go out of bounds
-                    pico.history_option += 1 # Move the selection up
-                    pico.display_history_menu() # Update the history menu display
-            else: # If in the main menu
-                if pico.option < 3:  # Ensure it doesn't exceed the menu options
-                    pico.option += 1 # Move highlight down in the menu
-                    pico.display_main_menu() # Update the menu display
-        
-    # Handle events from the SW1 button
-    if pico.button_fifo.has_data(): # Check if there are any events in the button FIFO
-        button_data = pico.button_fifo.get() # Get the data from the FIFO queue
+                self.network_job = self.calculate_hrv # Calculate and send the HRV metrics (Mean HR, Mean PPI, RMSSD, SDNN) outside the sample path
+ 
 
-        if button_data == 2: # If SW_1 button press is detected
-            if pico.option != 3: # If not in the History option
-                if pico.measurement_on: # If measurement is currently active
-                    pico.count = 0 # Reset the sample counter
-                    pico.measurement_on = False # Stop measurement
-                    pico.option = 0 # Reset the menu option
-                    pico.display_main_menu() # Return to the main menu
-                    pico.peaks = [] # Clear the list of detected peaks
-                    pico.hr_values = []  # Clear the heart rate values
-                    pico.empty_sensor_fifo() # Clear FIFO
-                    pico.ppi_intervals = [] # Clear the PPI values
-                    pico.hrv_measurement = {} # Clear HRV measurement
-                    pico.kubios_response = {} # Clear Kubios response data
-                    pico.json_message = {}#Clear json format data
-                    pico.reset_PPG_variables()
-                    pico.hr_display_flag = False 
-                    if pico.sensor_timer:  # Check if sensor_timer exists
-                        pico.sensor_timer.deinit()  # Stop the sensor_timer
-                        pico.sensor_timer = None  # Reset sensor_timer reference
-                    if pico.screen_timer:  # Check if screen_timer exists
-                        pico.screen_timer.deinit()  # Stop the screen_timer
-                        pico.screen_timer = None  # Reset screen_timer reference                        
-                        
-                        
-                else: # If measurement is not currently active
-                    if pico.option == 0: # If in the HR measurement mode
-                        if not pico.screen_timer:  # Avoid creating multiple timers
-                            pico.set_screen_timer() # Set a screen update timer
-                    elif pico.option == 1:
-                        pico.connect_mqtt_hrv()# Connect to the MQTT broker for HRV (Heart Rate Variability) analysis
-                        pico.show_collecting_data()
-                    elif pico.option == 2:
-                        pico.connect_mqtt_kubios() # Connect to the MQTT broker for Kubios Cloud analysis
-                        pico.show_collecting_data()
-                    pico.set_sensor_timer() # Start the sensor timer
-                    pico.measurement_on = True # Start measurement
-                    
+        elif self.option == 2: # If in Kubios analysis mode
+            if self.count > self.threshold_start + 7500 and len(self.ppi_intervals) > 15 and not self.json_message and not self.network_job:
+                self.show_sending_data()
+                self.stop_sensor_timer() # Stop sampling
 
-        if button_data == 3: # If SW2 button press is detected       
-            if pico.option == 3: # If in the History option
-                if not pico.in_history_data: # If not viewing history data
-                    pico.option = 0 # Reset the menu option
-                    pico.display_main_menu() # Return to the main menu
-                    pico.in_history_menu = False # Exit the history menu
-                else: # If viewing history data
-                    pico.history_option = 0 # Reset the history option
-                    pico.display_history_menu() # Return to the history menu
-                    pico.in_history_data = False # Exit the history data view
-                     
+                self.network_job = self.create_kubios_request # Send data to Kubios and process the response outside the sample path
                 
-    # Handle sensor data processing    
-    if pico.sensor_fifo.has_data(): # Check if there is data in the FIFO
-        sample = pico.sensor_fifo.get() # Get the data from the FIFO
-        
-        if pico.measurement_on == True:
-            
                 
+    def start_dsp_core(self):
+        # Start acquisition, filtering and peak detection on core 1
+        while self.beat_fifo.has_data(): # Drop results left from a previous measurement
+            self.beat_fifo.get()
+        while self.wave_fifo.has_data():
+            self.wave_fifo.get()
+        if self.option == 0: # Core 0 shows the stop instructions right away
+            self.display_instruction_HR()
             
-            pico.count += 1 # Increment the sample counter
+        self.peak_handler = self.beat_fifo.put # Peaks go to core 0 through the beat FIFO
+        self.core1_running = True
+        self.core1_done = False
+        _thread.start_new_thread(self.dsp_core_loop, ())
+        
+        
+    def dsp_core_loop(self):
+        # Core 1: take samples from the sensor FIFO or DMA blocks and run the signal processing
+        try:
+            while self.core1_running:
+                if self.block_reader:
+                    block = self.block_reader.get_block()
+                    if block:
+                        for sample in block:
+                            if self.process_dsp(sample):
+                                self.wave_fifo.put(sample) # Pass the sample on to core 0
+                        continue
+                                
+                elif self.sensor_fifo.has_data():
+                    sample = self.sensor_fifo.get()
+                    if self.process_dsp(sample):
+                        self.wave_fifo.put(sample) # Pass the sample on to core 0
+                    continue
+                    
+                time.sleep_ms(1) # Nothing to process, wait for the next samples instead of spinning
+        finally: # Also when the processing raised, so core 0 never waits for a dead core 1
+            self.core1_done = True
             
-            # Draw to OLED with scaling based on previous 125 samples
             
-            if pico.count == 1 and pico.option == 0: # On the first sample
-                pico.display_instruction_HR() # Show stop instructions
+    def stop_dsp_core(self):
+        # Core 0: stop core 1 and go back to single-core processing
+        self.core1_running = False
+        deadline = time.ticks_add(time.ticks_ms(), CORE1_STOP_TIMEOUT)
+        while not self.core1_done:
+            if time.ticks_diff(deadline, time.ticks_ms()) <= 0: # Core 1 hangs, stop using it
+                self.dual_core = False
+                break
+            time.sleep_ms(1)
+        self.peak_handler = self.calculate_hr
+        
+        
+    def process_core1_output(self):
+        # Core 0: handle the peaks and samples produced by core 1, return True if there were any
+        busy = False
+        while self.beat_fifo.has_data():
+            self.calculate_hr(self.beat_fifo.get())
+            busy = True
             
-            if pico.count < 1000: # Ignore the first 1000 samples (initial noise)
-                pico.empty_sensor_fifo()  # Clear the FIFO to discard noisy data
+        while self.wave_fifo.has_data() and self.measurement_on:
+            self.process_results(self.wave_fifo.get())
+            busy = True
+        return busy
 
-            if pico.count >= 1250: # Start processing data after the initial noise is ignored
-                if pico.count == 1250 or pico.count % 125 == 0:  # Set threshold periodically
-                    pico.set_threshold()# Set threshold for peak detection
-                    
+
+
+    def handle_encoder_events(self):
+        # Drain all encoder events, move the selection for every turn and redraw at most once per frame
+        # Returns True if there were events
+        busy = False
+        while self.encoder_fifo.has_data():
+            busy = True
+            self.last_input = time.ticks_ms()
+            encoder_data = self.encoder_fifo.get() # Get the data from the FIFO
+            if encoder_data == 2: # Button presses change the screen right away
+                self.menu_redraw = False # The new screen replaces any pending menu redraw
+                self.encoder_press()
+            else:
+                self.encoder_turn(encoder_data)
                 
-                pico.detect_peaks(sample)# Detect peaks
-                    
-                if pico.count % 500 == 0: # Every 500 samples
-                    pico.calculate_hr() # Calculate heart rate
-                    
+        if self.menu_redraw:
+            now = time.ticks_ms()
+            if time.ticks_diff(now, self.last_frame) >= self.frame_interval: # Frame-rate cap
+                self.menu_redraw = False
+                self.last_frame = now
+                if self.in_history_menu:
+                    self.display_history_menu() # Update the history menu display
+                else:
+                    self.display_main_menu() # Update the menu display
+        return busy
                     
                     
-                if pico.option == 0: # If in the HR measurement mode
+    def encoder_press(self):
+        # Handle the encoder button
+        if not self.in_history_menu: # If not in the history menu
+            if self.option == 3:  # If the History option is selected
+                self.in_history_menu = True # Enter the history menu
+                self.display_history_menu()  # Display the history menu
+            else: # For other menu options
+                self.display_instruction1()  # Show the instructions for starting measurement
+        
+        else: # If already in the history menu
+            self.display_history() # Display the selected history data
+            self.in_history_data = True # Mark that history data is being displayed
+            
+            
+    def encoder_turn(self, step):
+        # Move the selection by one step (-1 up, 1 down), the redraw is left to handle_encoder_events
+        if self.in_history_menu: # If in the history menu
+            option = min(max(self.history_option + step, 0), 2) # Ensure it doesn't go out of bounds
+            if option != self.history_option:
+                self.history_option = option
+                self.menu_redraw = True
+        else: # If in the main menu
+            option = min(max(self.option + step, 0), 3) # Ensure it doesn't exceed the menu options
+            if option != self.option:
+                self.option = option
+                self.menu_redraw = True
+
+
+    def handle_button_events(self):
+        # Handle one event from the SW1/SW2 buttons, return True if there was one
+        if not self.button_fifo.has_data(): # Check if there are any events in the button FIFO
+            return False
+        
+        button_data = self.button_fifo.get() # Get the data from the FIFO queue
+        self.last_input = time.ticks_ms()
+
+        if button_data == 2: # If SW_1 button press is detected
+            if self.option != 3: # If not in the History option
+                if self.measurement_on: # If measurement is currently active
+                    self.measurement_on = False # Stop measurement
+                    self.stop_sensor_timer() # Stop sampling
+                    self.count = 0 # Reset the sample counter
+                    self.option = 0 # Reset the menu option
+                    self.display_main_menu() # Return to the main menu
+                    self.beats.reset() # Clear the detected beats
+                    self.window.reset() # Clear the threshold window
+                    self.reset_peak_detection() # Forget a peak tracked when sampling stopped
+                    self.hrv.reset()  # Clear the heart rate and HRV values
+                    self.empty_sensor_fifo() # Clear FIFO
+                    self.ppi_intervals = [] # Clear the PPI values
+                    self.hrv_measurement = {} # Clear HRV measurement
+                    self.kubios_response = {} # Clear Kubios response data
+                    self.json_message = {}#Clear json format data
+                    self.network_job = None # Drop a result that was not sent yet
+                    self.kubios_request.cancel(self.kubios_request_id) # Stop waiting for the Kubios response
+                    self.kubios_request_id = None
+                    self.reset_PPG_variables()
+                    self.hr_display_flag = False 
+                    if self.screen_timer:  # Check if screen_timer exists
+                        self.screen_timer.deinit()  # Stop the screen_timer
+                        self.screen_timer = None  # Reset screen_timer reference                        
                     
-                    pico.update_live_PPG(sample) # Update the live PPG signal on the OLED
                     
-                    if pico.hr_display_flag and pico.hr_values: # Check if the OLED needs updating
-                        pico.hr_value = int(pico.hr_values[-1]) # Get the latest heart rate
-                        pico.display_hr() # Update OLED display with the heart rate
-                        pico.hr_display_flag = False # Reset display flag
-
-
-                elif pico.option == 1 and not pico.hrv_measurement: # If in HRV analysis mode
-                    if pico.count > 8750 and len(pico.ppi_intervals) > 2: # Process HRV metrics after sufficient data is collected
-                        pico.show_sending_data()
-                        if pico.sensor_timer:  # Check if sensor_timer exists
-                            pico.sensor_timer.deinit()  # Stop the sensor_timer
-                            pico.sensor_timer = None  # Reset sensor_timer reference
+                else: # If measurement is not currently active
+                    if self.option == 0: # If in the HR measurement mode
+                        if not self.screen_timer:  # Avoid creating multiple timers
+                            self.set_screen_timer() # Set a screen update timer
+                    elif self.option == 1:
+                        self.connect_mqtt_hrv()# Connect to the MQTT broker for HRV (Heart Rate Variability) analysis
+                        self.show_collecting_data()
+                    elif self.option == 2:
+                        self.connect_mqtt_kubios() # Connect to the MQTT broker for Kubios Cloud analysis
+                        self.show_collecting_data()
+                    self.set_sensor_timer() # Start the sensor timer
+                    self.measurement_on = True # Start measurement
+                    if self.dual_core: # Hand the signal processing over to core 1
+                        self.start_dsp_core()
+                
+
+        if button_data == 3: # If SW2 button press is detected       
+            if self.option == 3: # If in the History option
+                if not self.in_history_data: # If not viewing history data
+                    self.option = 0 # Reset the menu option
+                    self.display_main_menu() # Return to the main menu
+                    self.in_history_menu = False # Exit the history menu
+                else: # If viewing history data
+                    self.history_option = 0 # Reset the history option
+                    self.display_history_menu() # Return to the history menu
+                    self.in_history_data = False # Exit the history data view
+        return True
                         
-                        pico.calculate_hrv() # Calculate HRV metrics (Mean HR, Mean PPI, RMSSD, SDNN)
-     
+                        
+    def process_sensor_data(self):
+        # Handle sensor data processing, return True if there was data
+        if self.core1_running: # Core 1 does the signal processing, only collect its results
+            if not self.core1_done:
+                return self.process_core1_output()
+            self.process_core1_output() # Core 1 stopped on an error, take what it left
+            self.dual_core = False # and carry on with single-core processing
+            self.stop_dsp_core()
+        
+        if self.block_reader: # In DMA mode whole blocks are handed over at once
+            block = self.block_reader.get_block() # Get the next block of samples, if ready
+            if not block:
+                return False
+            self.process_block(block, len(block))
+            return True
+                
+        n = self.drain_sensor_fifo() # Take all samples waiting in the FIFO
+        if not n:
+            return False
+        self.process_block(self.sample_block, n)
+        return True
+    
+    
+    def handle_ui_events(self):
+        # Encoder and button events, return True if there were any
+        encoder = self.handle_encoder_events()
+        button = self.handle_button_events()
+        return encoder or button
+    
+    
+    def flush_display(self):
+        # Send part of the queued display data, return True if more is left
+        return self.oled.flush_step(self.oled_chunk)
+    
+    
+    def poll_mqtt(self):
+        # Keep the MQTT sessions alive and reconnect them, at most every mqtt_poll_interval ms
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.last_mqtt_poll) < self.mqtt_poll_interval:
+            return
+        self.last_mqtt_poll = now
+        sampling = self.sensor_timer or self.block_reader
+        allow_connect = not sampling and self.ui_idle(now) # The reconnect handshake would stall sampling or the UI
+        for session in (self.mqtt_hrv, self.mqtt_kubios):
+            session.poll(allow_connect)
+        if self.spool and not sampling: # Send results spooled while the broker was unreachable
+            if not self.mqtt_hrv.wanted: # Results left from before a restart, poll connects when allowed
+                self.mqtt_hrv.start(connect=False)
+            self.spool.drain(self.mqtt_hrv)
+        timed_out = self.kubios_request.poll()
+        if timed_out is not None and timed_out == self.kubios_request_id: # No response after all retries
+            self.display_kubios_timeout()
+            
+        # Show connection changes while collecting data
+        if sampling and self.option in (1, 2) and self.mqtt_client and self.mqtt_client.state != self.mqtt_shown_state:
+            self.show_collecting_data()
+    
+    
+    def ui_idle(self, now):
+        # True if no input is waiting, the screen is sent, and the user has not touched anything for reconnect_idle ms
+        if self.encoder_fifo.has_data() or self.button_fifo.has_data() or self.menu_redraw or self.oled.busy():
+            return False
+        return time.ticks_diff(now, self.last_input) >= self.reconnect_idle
+    
+    
+    def handle_network(self):
+        # Run the pending MQTT or Kubios job, return True if there was one
+        self.poll_mqtt()
+        job = self.network_job
+        if not job:
+            return False
+        self.network_job = None
+        job()
+        return True
 
-                elif pico.option == 2: # If in Kubios analysis mode
-                    if pico.count > 8750 and len(pico.ppi_intervals) > 15 and not pico.json_message:
-                        pico.show_sending_data()
-                        if pico.sensor_timer:  # Check if sensor_timer exists
-                            pico.sensor_timer.deinit()  # Stop the sensor_timer
-                            pico.sensor_timer = None  # Reset sensor_timer reference
 
-                        pico.create_kubios_request() # Send data to Kubios and process the response
-                        
-               
+def create_scheduler(pico):
+    # Cooperative tasks: signal processing first, then the user interface, display transfers and network.
+    # Sampling itself runs from the Piotimer interrupt or DMA and needs no task. The signal
+    # processing and UI tasks sleep until their interrupt handlers put data into the FIFOs.
+    scheduler = Scheduler()
+    scheduler.add("dsp", pico.process_sensor_data, PRIORITY_HIGH, (pico.sensor_fifo,))
+    scheduler.add("ui", pico.handle_ui_events, PRIORITY_NORMAL, (pico.encoder_fifo, pico.button_fifo))
+    scheduler.add("display", pico.flush_display, PRIORITY_LOW)
+    scheduler.add("network", pico.handle_network, PRIORITY_LOW)
+    return scheduler
+
+
+def main():
+    # Instantiate the Pico class with appropriate GPIO pin numbers
+    # sw1_pin=8, sensor_pin=27, rot_a=10, rot_b=11, e_switch=12
+    pico = Pico(7, 8, 27, 10, 11, 12)
+
+    # Display the main menu on the OLED screen
+    pico.display_main_menu()
+
+    if USE_SCHEDULER:
+        create_scheduler(pico).run()
+
+    # Main loop to process events and update heart rate
+    while True:
+        # Handle events from the rotary encoder (turns and button press)
+        pico.handle_encoder_events()
+
+        # Handle events from the SW1 and SW2 buttons
+        pico.handle_button_events()
+
+        # Handle sensor data processing
+        pico.process_sensor_data()
+
+        # Send part of the queued display data between samples
+        pico.flush_display()
+
+        # Send the measurement results once sampling has stopped
+        pico.handle_network()
+
+
+# Runs when the file is started as main.py or from Thonny, not when it is imported by the host tests
+if __name__ == "__main__":
+    main()
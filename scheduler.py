@@ -0,0 +1,147 @@
+# Cooperative scheduler for the heart rate monitor
+# Each part of the device (signal processing, UI, display, network) runs as its own
+# asyncio task. uasyncio is used on the Pico and the standard asyncio on a desktop,
+# so the same task setup can be run with hardware stand-ins.
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+PRIORITY_HIGH = 0 # Signal processing: polls every 2 ms, several steps before yielding
+PRIORITY_NORMAL = 1 # User interface
+PRIORITY_LOW = 2 # Display transfers and network
+POLL_MS = (2, 20, 100) # Sleep of an idle task for each priority
+BURST = (8, 2, 1) # Steps a busy task may run before it yields, for each priority
+
+
+def sleep_ms(ms):
+    # asyncio.sleep_ms() on MicroPython, asyncio.sleep() with seconds elsewhere
+    if hasattr(asyncio, "sleep_ms"):
+        return asyncio.sleep_ms(ms)
+    return asyncio.sleep(ms / 1000)
+
+
+def wait_for_ms(awaitable, ms):
+    # asyncio.wait_for_ms() on MicroPython, asyncio.wait_for() with seconds elsewhere
+    if hasattr(asyncio, "wait_for_ms"):
+        return asyncio.wait_for_ms(awaitable, ms)
+    return asyncio.wait_for(awaitable, ms / 1000)
+
+
+# Wakes the task waiting for one or more Fifos when data is put into them
+# ThreadSafeFlag can be set from an interrupt handler. The standard asyncio has no such
+# primitive, there an Event is used, so the producer has to run in the event loop.
+class Wakeup:
+    def __init__(self):
+        self.from_interrupt = hasattr(asyncio, "ThreadSafeFlag")
+        self.flag = asyncio.ThreadSafeFlag() if self.from_interrupt else asyncio.Event()
+
+    def set(self):
+        self.flag.set()
+
+    async def wait(self, timeout_ms=None):
+        # Return once set() was called, or after timeout_ms
+        try:
+            if timeout_ms is None:
+                await self.flag.wait()
+            else:
+                await wait_for_ms(self.flag.wait(), timeout_ms)
+        except asyncio.TimeoutError:
+            pass
+        if not self.from_interrupt: # ThreadSafeFlag clears itself when a waiter wakes up
+            self.flag.clear()
+
+
+# Awaitable view of a Fifo filled from an interrupt handler
+# The interrupt side stays lock-free, put() only sets the Wakeup. FIFOs read by the same
+# task share one Wakeup, so the task can wait for any of them with wait_any().
+class AsyncFifo:
+    def __init__(self, fifo, wakeup=None):
+        self.fifo = fifo # The wrapped Fifo
+        self.wakeup = wakeup or Wakeup() # Set on every put()
+
+    def __getattr__(self, name):
+        # empty(), dropped() and the rest go to the Fifo
+        return getattr(self.fifo, name)
+
+    def put(self, value):
+        # Called from the interrupt handler
+        self.fifo.put(value)
+        self.wakeup.set()
+
+    def has_data(self):
+        return self.fifo.has_data()
+
+    def get(self):
+        return self.fifo.get()
+
+    async def wait(self, timeout_ms=None):
+        # Return once the Fifo has data, or after timeout_ms
+        if not self.fifo.has_data():
+            await self.wakeup.wait(timeout_ms)
+
+    async def get_async(self):
+        # Wait for and return the next value
+        while not self.fifo.has_data():
+            await self.wakeup.wait()
+        return self.fifo.get()
+
+
+async def wait_any(fifos, timeout_ms=None):
+    # Return once one of the AsyncFifos has data, or after timeout_ms; they must share a Wakeup
+    for fifo in fifos:
+        if fifo.has_data():
+            return
+    await fifos[0].wakeup.wait(timeout_ms)
+
+
+# Runs step functions as prioritised cooperative tasks
+# A step does one unit of work and returns True if there was work to do. A busy task
+# runs up to BURST steps and then yields. An idle one sleeps for its POLL_MS, or, if it
+# reads AsyncFifos, waits for them and wakes up as soon as an interrupt handler puts data.
+# POLL_MS then only bounds the wait, for work that does not arrive through the FIFOs
+# (DMA blocks, the menu frame-rate cap).
+class Scheduler:
+    def __init__(self):
+        self.tasks = [] # (name, step, priority, fifos)
+        self.running = False
+        self.steps = {} # Number of busy steps of each task, for tuning
+        self.wakeups = {} # Number of idle waits of each task that ended with data, for tuning
+
+    def add(self, name, step, priority=PRIORITY_NORMAL, fifos=()):
+        self.tasks.append((name, step, priority, tuple(fifos)))
+        self.steps[name] = 0
+        self.wakeups[name] = 0
+
+    async def loop(self, name, step, priority, fifos):
+        burst = BURST[priority]
+        idle_ms = POLL_MS[priority]
+        while self.running:
+            busy = 0
+            while busy < burst and step():
+                busy += 1
+            self.steps[name] += busy
+            if busy:
+                await sleep_ms(0) # Yield right away, there may be more work
+            elif fifos:
+                await wait_any(fifos, idle_ms)
+                for fifo in fifos:
+                    if fifo.has_data():
+                        self.wakeups[name] += 1
+                        break
+            else:
+                await sleep_ms(idle_ms)
+
+    async def main(self):
+        self.running = True
+        tasks = [asyncio.create_task(self.loop(*task)) for task in self.tasks]
+        for task in tasks:
+            await task
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def stop(self):
+        # The tasks finish after their current step
+        self.running = False
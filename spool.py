@@ -0,0 +1,94 @@
+# Store-and-forward spool for results published over MQTT
+# Every result is first written to flash with a sequence number and removed only after
+# the broker acknowledged it (QoS 1), so results measured while the broker or the WLAN
+# is down are sent when the connection returns. The sequence number lets the receiver
+# drop the duplicates QoS 1 can cause. drain() never waits for the broker: it publishes
+# and returns, the PUBACKs collected by the session remove the messages on a later call.
+import os
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+class Spool:
+    def __init__(self, path="spool.txt", limit=20):
+        self.path = path # File holding the pending messages, one per line
+        self.limit = limit # Maximum number of pending messages, the oldest are dropped
+        self.entries = [] # [sequence number, topic, payload, packet identifier, connection] from the oldest to the newest
+        self.next_seq = 1 # Sequence number of the next message
+        self.dropped = 0 # Messages lost because the spool was full
+        self.load()
+
+    def load(self):
+        # Read the pending messages left from before a restart
+        try:
+            with open(self.path, "r") as file:
+                for line in file:
+                    line = line.rstrip("\n")
+                    if line.startswith("#"): # Header with the next sequence number
+                        self.next_seq = int(line[1:])
+                    elif line:
+                        seq, topic, payload = line.split(" ", 2)
+                        self.entries.append([int(seq), topic, payload, 0, 0])
+        except OSError: # No spool file yet
+            pass
+
+    def save(self):
+        # Write the spool to a temporary file and rename it, so a reset never leaves half a file
+        temp = self.path + ".tmp"
+        with open(temp, "w") as file:
+            file.write("#%d\n" % self.next_seq)
+            for seq, topic, payload, pid, connection in self.entries:
+                file.write("%d %s %s\n" % (seq, topic, payload))
+        os.rename(temp, self.path)
+
+    def add(self, topic, data):
+        # Spool a result dictionary, return its sequence number
+        seq = self.next_seq
+        self.next_seq += 1
+        message = dict(data)
+        message["seq"] = seq
+        self.entries.append([seq, topic, json.dumps(message), 0, 0]) # Not sent yet
+        if len(self.entries) > self.limit:
+            self.entries.pop(0)
+            self.dropped += 1
+        self.save()
+        return seq
+
+    def drain(self, session, window=5):
+        # Drop the acknowledged messages and publish the others with QoS 1, return the number published
+        # Up to window messages wait for their PUBACK at a time. A message sent on an earlier
+        # connection is sent again, its PUBACK can no longer arrive.
+        acked = session.take_acks()
+        if acked:
+            kept = [entry for entry in self.entries if entry[3] not in acked] # Packet identifiers are not reused soon
+            removed = len(self.entries) - len(kept)
+            self.entries = kept
+            if removed:
+                self.save()
+        connection = session.connections
+        waiting = 0
+        for entry in self.entries:
+            if entry[3] and entry[4] == connection:
+                waiting += 1
+        sent = 0
+        for entry in self.entries:
+            if waiting >= window or not session.connected():
+                break
+            if entry[3] and entry[4] == connection: # Waiting for its PUBACK
+                continue
+            topic, payload = entry[1], entry[2]
+            pid = session.publish(topic, payload, qos=1)
+            if not pid:
+                break
+            entry[3] = pid
+            entry[4] = connection
+            waiting += 1
+            sent += 1
+            print("Sending to MQTT: %s -> %s" % (topic, payload))
+        return sent
+
+    def __len__(self):
+        return len(self.entries)
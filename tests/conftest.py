@@ -0,0 +1,16 @@
+# Host test setup: the firmware modules are imported from the repository root, and
+# tests/stubs stands in for the MicroPython-only modules (machine, ssd1306, umqtt, ...)
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests", "stubs"))
+
+if not hasattr(time, "ticks_ms"): # MicroPython's time functions, on the desktop clock
+    time.ticks_ms = lambda: int(time.monotonic() * 1000)
+    time.ticks_us = lambda: int(time.monotonic() * 1000000)
+    time.ticks_diff = lambda end, start: end - start
+    time.ticks_add = lambda ticks, delta: ticks + delta
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
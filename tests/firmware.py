@@ -0,0 +1,27 @@
+# Helpers to run the firmware on the host with the stand-ins from tests/stubs
+import math
+import random
+
+from umqtt import simple
+
+
+def ppg(seconds, bpm=72, seed=1):
+    # Synthetic PPG at 250 Hz: a pulse wave with breathing drift and noise, as 16-bit ADC values
+    rng = random.Random(seed)
+    phase = 0
+    for i in range(250 * seconds):
+        phase += 2 * math.pi * bpm / 60 / 250
+        yield int(30000 + 3000 * math.sin(phase) + 2000 * math.sin(2 * math.pi * 0.1 * i / 250) + rng.gauss(0, 80))
+
+
+def make_pico(tmp_path, monkeypatch):
+    # A Pico on fresh brokers, writing its history and spool files to tmp_path
+    import project_final_ver
+    monkeypatch.chdir(tmp_path)
+    simple.brokers.clear()
+    return project_final_ver.Pico(7, 8, 27, 10, 11, 12)
+
+
+def press_sw1(pico):
+    pico.last_press_time_sw1 = -1000 # Outside the debounce time
+    pico.switch1.handler(pico.switch1)
@@ -0,0 +1,32 @@
+# Host stand-in for the fifo library: a ring buffer in an array, one slot is kept free
+from array import array
+
+
+class Fifo:
+    def __init__(self, size, typecode='H'):
+        self.data = array(typecode, [0] * size)
+        self.head = 0
+        self.tail = 0
+        self.dc = 0 # Values dropped because the FIFO was full
+
+    def put(self, value):
+        nh = (self.head + 1) % len(self.data)
+        if nh != self.tail:
+            self.data[self.head] = value
+            self.head = nh
+        else:
+            self.dc += 1
+
+    def get(self):
+        value = self.data[self.tail]
+        self.tail = (self.tail + 1) % len(self.data)
+        return value
+
+    def dropped(self):
+        return self.dc
+
+    def has_data(self):
+        return self.head != self.tail
+
+    def empty(self):
+        return self.head == self.tail
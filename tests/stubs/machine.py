@@ -0,0 +1,61 @@
+# Host stand-in for the MicroPython machine module, just what the firmware uses
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    IRQ_RISING = 4
+    IRQ_FALLING = 8
+
+    def __init__(self, id, mode=IN, pull=None, value=1):
+        self.id = id
+        self.level = value # Released buttons read high with the pull-up
+        self.handler = None # Interrupt handler, call pin.handler(pin) to simulate an edge
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            return self.level
+        self.level = value
+
+    def irq(self, handler=None, trigger=IRQ_RISING, hard=False):
+        self.handler = handler
+
+
+class ADC:
+    def __init__(self, pin):
+        self.pin = pin
+        self.source = None # Iterator of 16-bit samples, or None for a constant mid-scale value
+
+    def read_u16(self):
+        if self.source is None:
+            return 32768
+        return next(self.source)
+
+
+class I2C:
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.freq = freq
+        self.sent = 0 # Number of bytes written
+
+    def writeto(self, addr, buf, stop=True):
+        self.sent += len(buf)
+        return len(buf)
+
+    def writevto(self, addr, vector, stop=True):
+        return self.writeto(addr, b"".join(bytes(buf) for buf in vector), stop)
+
+    def scan(self):
+        return [0x3C]
+
+
+mem32 = {} # Register writes, by address
+
+
+def unique_id():
+    return b"\xe6\x61\x41\x04\x03\x2b\x5c\x2a"
+
+
+def reset():
+    raise SystemExit("machine.reset()")
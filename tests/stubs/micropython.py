@@ -0,0 +1,11 @@
+# Host stand-in for the micropython module
+def const(value):
+    return value
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def schedule(function, argument):
+    function(argument)
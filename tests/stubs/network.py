@@ -0,0 +1,24 @@
+# Host stand-in for the network module: a WLAN that is always connected
+STA_IF = 0
+AP_IF = 1
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self.up = False
+        self.ssid = None
+
+    def active(self, up=None):
+        if up is None:
+            return self.up
+        self.up = up
+
+    def connect(self, ssid, password=None):
+        self.ssid = ssid
+
+    def isconnected(self):
+        return self.up and self.ssid is not None
+
+    def ifconfig(self):
+        return ("192.168.8.100", "255.255.255.0", "192.168.8.1", "192.168.8.1")
@@ -0,0 +1,21 @@
+# Host stand-in for the Piotimer library: stores the callback, the test calls it in place of the PIO
+class Piotimer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        self.mode = mode
+        self.period = period # ms
+        self.freq = freq # Hz
+        self.callback = callback
+        self.running = True
+
+    def fire(self, times=1):
+        # Run the callback as the timer interrupt would
+        for i in range(times):
+            if not self.running:
+                return
+            self.callback(self)
+
+    def deinit(self):
+        self.running = False
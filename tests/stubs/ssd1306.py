@@ -0,0 +1,98 @@
+# Host stand-in for the ssd1306 driver: a MONO_VLSB frame buffer and the I2C command and data writes
+# The drawing primitives set the same pixels as framebuf, text draws a filled 8x8 cell per
+# non-space character since the font is not needed to test what gets sent to the panel.
+class SSD1306_I2C:
+    def __init__(self, width, height, i2c, addr=0x3C, external_vcc=False):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.i2c = i2c
+        self.addr = addr
+        self.buffer = bytearray(self.pages * width) # Byte = 8 vertical pixels of one page, LSB at the top
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return 0 if c is None else None
+        index = (y >> 3) * self.width + x
+        bit = 1 << (y & 7)
+        if c is None:
+            return 1 if self.buffer[index] & bit else 0
+        if c:
+            self.buffer[index] |= bit
+        else:
+            self.buffer[index] &= ~bit & 0xFF
+
+    def fill(self, c):
+        value = 0xFF if c else 0
+        for i in range(len(self.buffer)):
+            self.buffer[i] = value
+
+    def fill_rect(self, x, y, w, h, c):
+        for yy in range(max(y, 0), min(y + h, self.height)):
+            for xx in range(max(x, 0), min(x + w, self.width)):
+                self.pixel(xx, yy, c)
+
+    def hline(self, x, y, w, c):
+        self.fill_rect(x, y, w, 1, c)
+
+    def vline(self, x, y, h, c):
+        self.fill_rect(x, y, 1, h, c)
+
+    def rect(self, x, y, w, h, c, f=False):
+        if f:
+            self.fill_rect(x, y, w, h, c)
+            return
+        self.hline(x, y, w, c)
+        self.hline(x, y + h - 1, w, c)
+        self.vline(x, y, h, c)
+        self.vline(x + w - 1, y, h, c)
+
+    def line(self, x0, y0, x1, y1, c):
+        # Bresenham, like framebuf
+        dx = abs(x1 - x0)
+        dy = -abs(y1 - y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        error = dx + dy
+        while True:
+            self.pixel(x0, y0, c)
+            if x0 == x1 and y0 == y1:
+                return
+            e2 = 2 * error
+            if e2 >= dy:
+                error += dy
+                x0 += sx
+            if e2 <= dx:
+                error += dx
+                y0 += sy
+
+    def text(self, s, x, y, c=1):
+        for i, ch in enumerate(s):
+            if ch != " ":
+                self.fill_rect(x + 8 * i, y, 8, 8, c)
+
+    def scroll(self, xstep, ystep):
+        old = bytes(self.buffer)
+        copy = SSD1306_I2C(self.width, self.height, None)
+        copy.buffer[:] = old
+        self.fill(0)
+        for y in range(self.height):
+            for x in range(self.width):
+                if copy.pixel(x, y):
+                    self.pixel(x + xstep, y + ystep, 1)
+
+    def blit(self, fbuf, x, y, *args):
+        for yy in range(fbuf.height):
+            for xx in range(fbuf.width):
+                self.pixel(x + xx, y + yy, fbuf.pixel(xx, yy))
+
+    def write_cmd(self, cmd):
+        self.i2c.writeto(self.addr, bytes((0x80, cmd)))
+
+    def write_data(self, buf):
+        self.i2c.writevto(self.addr, (b"\x40", buf))
+
+    def show(self):
+        for cmd in (0x21, 0, self.width - 1, 0x22, 0, self.pages - 1):
+            self.write_cmd(cmd)
+        self.write_data(self.buffer)
@@ -0,0 +1,2 @@
+# Host stand-in for ujson
+from json import dumps, loads
@@ -0,0 +1,309 @@
+# Host stand-in for umqtt.simple: the MQTTClient of micropython-lib talking to an in-memory broker
+# The client is the upstream code, reduced to what the firmware uses. Each broker(server, port)
+# answers the packets written to the socket right away and records what it received, so
+# tests see the exact bytes on the wire. A blocking read that could never be answered raises
+# instead of hanging the test.
+import errno
+import struct
+
+
+class MQTTException(Exception):
+    pass
+
+
+class Broker:
+    def __init__(self):
+        self.reachable = True # False: connect() fails like an unreachable host
+        self.responsive = True # False: the connection is half-open, writes succeed, nothing comes back
+        self.ack = True # Send PUBACK for QoS 1 publishes
+        self.wire = bytearray() # Everything the clients wrote
+        self.received = bytearray() # Bytes not parsed yet
+        self.packets = [] # (first byte, body) of every complete packet received
+        self.published = [] # (topic, payload, qos, pid) of every PUBLISH received
+        self.subscriptions = []
+        self.connections = 0
+        self.socket = None # Socket of the latest connection
+
+    def receive(self, data):
+        self.wire += data
+        self.received += data
+        while True:
+            packet = self.parse()
+            if packet is None:
+                return
+            self.handle(*packet)
+
+    def parse(self):
+        # Take one complete packet from the received bytes
+        data = self.received
+        if len(data) < 2:
+            return None
+        size = 0
+        shift = 0
+        i = 1
+        while True:
+            if i >= len(data):
+                return None
+            size |= (data[i] & 0x7F) << shift
+            shift += 7
+            i += 1
+            if not data[i - 1] & 0x80:
+                break
+        if len(data) < i + size:
+            return None
+        packet = (data[0], bytes(data[i:i + size]))
+        del data[:i + size]
+        return packet
+
+    def handle(self, op, body):
+        self.packets.append((op, body))
+        kind = op & 0xF0
+        if kind == 0x30:
+            qos = (op >> 1) & 3
+            length = body[0] << 8 | body[1]
+            topic = body[2:2 + length]
+            position = 2 + length
+            pid = 0
+            if qos:
+                pid = body[position] << 8 | body[position + 1]
+                position += 2
+            self.published.append((topic, body[position:], qos, pid))
+            if qos == 1 and self.ack:
+                self.reply(bytes((0x40, 2, pid >> 8, pid & 0xFF)))
+        elif kind == 0x10:
+            self.reply(b"\x20\x02\x00\x00") # CONNACK, accepted
+        elif kind == 0x80:
+            self.subscriptions.append(body[4:4 + (body[2] << 8 | body[3])])
+            self.reply(bytes((0x90, 3, body[0], body[1], 0)))
+        elif kind == 0xC0:
+            self.reply(b"\xd0\x00") # PINGRESP
+
+    def reply(self, data):
+        if self.responsive and self.socket:
+            self.socket.incoming += data
+
+    def deliver(self, topic, msg):
+        # Send a QoS 0 PUBLISH to the latest connection
+        topic = topic.encode() if isinstance(topic, str) else topic
+        msg = msg.encode() if isinstance(msg, str) else msg
+        size = 2 + len(topic) + len(msg)
+        header = bytearray((0x30,))
+        while size > 0x7F:
+            header.append((size & 0x7F) | 0x80)
+            size >>= 7
+        header.append(size)
+        self.socket.incoming += header + struct.pack("!H", len(topic)) + topic + msg
+
+    def topics(self):
+        return [topic.decode() for topic, payload, qos, pid in self.published]
+
+
+brokers = {}
+
+
+def broker(server, port=1883):
+    # The broker at server:port, created on first use
+    key = (server, port)
+    if key not in brokers:
+        brokers[key] = Broker()
+    return brokers[key]
+
+
+class HostSocket:
+    def __init__(self, broker):
+        self.broker = broker
+        self.incoming = bytearray() # Bytes sent by the broker, not read yet
+        self.timeout = None # None blocks, 0 is non-blocking, otherwise seconds
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def setblocking(self, flag):
+        # As on MicroPython, setblocking(True) also removes a timeout
+        self.timeout = None if flag else 0
+
+    def write(self, data, n=None):
+        if self.closed:
+            raise OSError(errno.EBADF, "closed")
+        data = bytes(data)
+        if n is not None:
+            data = data[:n]
+        self.broker.receive(data)
+        return len(data)
+
+    def read(self, n):
+        if self.closed:
+            raise OSError(errno.EBADF, "closed")
+        if len(self.incoming) < n:
+            if self.timeout == 0:
+                return None
+            if self.timeout is None:
+                raise RuntimeError("blocking read on a socket with no data and no timeout would hang")
+            raise OSError(errno.ETIMEDOUT, "timed out")
+        data = bytes(self.incoming[:n])
+        del self.incoming[:n]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, ssl=None):
+        if port == 0:
+            port = 1883
+        self.client_id = client_id
+        self.sock = None
+        self.server = server
+        self.port = port
+        self.pid = 0
+        self.cb = None
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+
+    def _send_str(self, s):
+        self.sock.write(struct.pack("!H", len(s)))
+        self.sock.write(s)
+
+    def _recv_len(self):
+        n = 0
+        sh = 0
+        while 1:
+            b = self.sock.read(1)[0]
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                return n
+            sh += 7
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def connect(self, clean_session=True, timeout=None):
+        target = broker(self.server, self.port)
+        if not target.reachable:
+            raise OSError(errno.EHOSTUNREACH, "host unreachable")
+        self.sock = HostSocket(target)
+        self.sock.settimeout(timeout)
+        target.socket = self.sock
+        target.connections += 1
+        premsg = bytearray(b"\x10\0\0\0\0\0")
+        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+        client_id = self.client_id.encode() if isinstance(self.client_id, str) else self.client_id
+        sz = 10 + 2 + len(client_id)
+        msg[6] = clean_session << 1
+        msg[7] |= self.keepalive >> 8
+        msg[8] |= self.keepalive & 0x00FF
+        i = 1
+        while sz > 0x7F:
+            premsg[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        premsg[i] = sz
+        self.sock.write(premsg, i + 2)
+        self.sock.write(msg)
+        self._send_str(client_id)
+        resp = self.sock.read(4)
+        assert resp[0] == 0x20 and resp[1] == 0x02
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+        return resp[2] & 1
+
+    def disconnect(self):
+        self.sock.write(b"\xe0\0")
+        self.sock.close()
+
+    def ping(self):
+        self.sock.write(b"\xc0\0")
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        topic = topic.encode() if isinstance(topic, str) else topic
+        msg = msg.encode() if isinstance(msg, str) else msg
+        pkt = bytearray(b"\x30\0\0\0")
+        pkt[0] |= qos << 1 | retain
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        assert sz < 2097152
+        i = 1
+        while sz > 0x7F:
+            pkt[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        pkt[i] = sz
+        self.sock.write(pkt, i + 1)
+        self._send_str(topic)
+        if qos > 0:
+            self.pid += 1
+            pid = self.pid
+            struct.pack_into("!H", pkt, 0, pid)
+            self.sock.write(pkt, 2)
+        self.sock.write(msg)
+        if qos == 1:
+            while 1:
+                op = self.wait_msg()
+                if op == 0x40:
+                    sz = self.sock.read(1)
+                    assert sz == b"\x02"
+                    rcv_pid = self.sock.read(2)
+                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+                    if pid == rcv_pid:
+                        return
+        elif qos == 2:
+            assert 0
+
+    def subscribe(self, topic, qos=0):
+        assert self.cb is not None, "Subscribe callback is not set"
+        topic = topic.encode() if isinstance(topic, str) else topic
+        pkt = bytearray(b"\x82\0\0\0")
+        self.pid += 1
+        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
+        self.sock.write(pkt)
+        self._send_str(topic)
+        self.sock.write(qos.to_bytes(1, "little"))
+        while 1:
+            op = self.wait_msg()
+            if op == 0x90:
+                resp = self.sock.read(4)
+                assert resp[1] == pkt[2] and resp[2] == pkt[3]
+                if resp[3] == 0x80:
+                    raise MQTTException(resp[3])
+                return
+
+    def wait_msg(self):
+        res = self.sock.read(1)
+        self.sock.setblocking(True)
+        if res is None:
+            return None
+        if res == b"":
+            raise OSError(-1)
+        if res == b"\xd0": # PINGRESP
+            sz = self.sock.read(1)[0]
+            assert sz == 0
+            return None
+        op = res[0]
+        if op & 0xF0 != 0x30:
+            return op
+        sz = self._recv_len()
+        topic_len = self.sock.read(2)
+        topic_len = (topic_len[0] << 8) | topic_len[1]
+        topic = self.sock.read(topic_len)
+        sz -= topic_len + 2
+        if op & 6:
+            pid = self.sock.read(2)
+            pid = pid[0] << 8 | pid[1]
+            sz -= 2
+        msg = self.sock.read(sz)
+        self.cb(topic, msg)
+        if op & 6 == 2:
+            pkt = bytearray(b"\x40\x02\0\0")
+            struct.pack_into("!H", pkt, 2, pid)
+            self.sock.write(pkt)
+        elif op & 6 == 4:
+            assert 0
+        return op
+
+    def check_msg(self):
+        self.sock.setblocking(False)
+        return self.wait_msg()
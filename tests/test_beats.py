@@ -0,0 +1,87 @@
+# Streaming beat correction, one test per path of BeatCorrector.add
+from beats import BeatCorrector, BeatStream, CORRECTED, PPI_MAX
+
+
+def feed(corrector, values):
+    # Beats and flags produced for a list of raw PPIs
+    beats = []
+    for ppi in values:
+        for i in range(corrector.add(ppi)):
+            beats.append((corrector.out[i], corrector.out_flags[i]))
+    return beats
+
+
+def primed(values=(800, 810, 790, 805, 795)):
+    corrector = BeatCorrector()
+    assert feed(corrector, values) == [(ppi, 0) for ppi in values]
+    return corrector
+
+
+def test_normal_beats_pass_through():
+    corrector = primed()
+    assert feed(corrector, [820, 780, 800]) == [(820, 0), (780, 0), (800, 0)]
+    assert corrector.run == 0
+
+
+def test_implausible_beats_are_dropped_before_the_reference():
+    corrector = BeatCorrector()
+    assert feed(corrector, [200, PPI_MAX, 800]) == [(800, 0)]
+    assert corrector.length == 1
+
+
+def test_missed_peak_is_split():
+    corrector = primed()
+    assert feed(corrector, [1600]) == [(800, CORRECTED)] * 2
+    assert feed(corrector, [2400]) == [(800, CORRECTED)] * 3
+
+
+def test_extra_peak_is_merged():
+    corrector = primed()
+    assert feed(corrector, [300]) == []
+    assert corrector.pending == 300
+    assert feed(corrector, [500]) == [(800, CORRECTED)]
+    assert corrector.pending == 0
+
+
+def test_outlier_is_replaced_by_the_median():
+    corrector = primed()
+    assert feed(corrector, [1150]) == [(800, CORRECTED)]
+
+
+def test_pending_short_interval_followed_by_missed_peak():
+    corrector = primed()
+    assert feed(corrector, [400, 1600]) == [(800, CORRECTED)] * 3
+
+
+def test_pending_short_interval_followed_by_normal_beat():
+    corrector = primed()
+    assert feed(corrector, [400, 810]) == [(800, CORRECTED), (810, 0)]
+
+
+def test_rhythm_change_rebuilds_the_reference():
+    corrector = primed()
+    beats = feed(corrector, [1000, 1010, 990, 1000, 1005, 995])
+    assert beats[:3] == [(800, CORRECTED)] * 3 # Taken as outliers until max_run
+    assert beats[3:] == [(1000, 0), (1005, 0), (995, 0)]
+    assert corrector.median() == 1000
+
+
+def test_long_gap_restarts_the_reference():
+    for gap in (10000, 60000, PPI_MAX):
+        corrector = primed()
+        assert feed(corrector, [gap]) == []
+        assert corrector.length == 0
+        assert feed(corrector, [700, 710, 690, 705]) == [(700, 0), (710, 0), (690, 0), (705, 0)]
+
+
+def test_stream_skips_a_dropout():
+    stream = BeatStream(sample_rate=250, corrector=BeatCorrector())
+    position = 0
+    for _ in range(6):
+        stream.add_peak(position)
+        position += 200 # 800 ms
+    assert stream.count == 5
+    position += 250 * 20 # 20 s without peaks
+    assert stream.add_peak(position) == 0
+    assert stream.count == 5
+    assert stream.corrected == 0
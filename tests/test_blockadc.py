@@ -0,0 +1,69 @@
+# Double buffer handoff of the block reader, driven by the host stand-in
+from blockadc import HostBlockReader
+
+
+def ramp(blocks, block_size=50):
+    # Sample i of block b is (1000 * b + i) << 4, so every block is recognisable after the 12-bit scaling
+    return [(1000 * b + i) << 4 for b in range(blocks) for i in range(block_size)]
+
+
+def first_of(block):
+    return block[0] >> 4
+
+
+def test_blocks_alternate_between_the_two_buffers():
+    reader = HostBlockReader(ramp(4), block_size=50, oversample=4)
+    reader.start()
+    for b in range(4):
+        assert reader.next_buffer == b & 1
+        assert reader.pump()
+        block = reader.get_block()
+        assert first_of(block) == 1000 * b
+        assert list(block) == [(1000 * b + i) << 4 for i in range(50)]
+        assert reader.buffers[b & 1][0] == 1000 * b # Raw conversions landed in the expected buffer
+    assert reader.get_block() is None
+    assert reader.overruns == 0
+    assert not reader.pump() # Source exhausted
+    assert not reader.running
+
+
+def test_oversampled_conversions_are_averaged():
+    reader = HostBlockReader([0x1230] * 10, block_size=10, oversample=8)
+    reader.start()
+    reader.pump()
+    reader.buffers[0][8] = 0x124 # One conversion of the second sample 1 LSB higher
+    block = reader.get_block()
+    assert block[0] == 0x1230
+    assert block[1] == (0x123 * 7 + 0x124 << 4) // 8
+
+
+def test_overrun_skips_to_the_newest_block():
+    reader = HostBlockReader(ramp(4), block_size=50, oversample=4)
+    reader.start()
+    reader.pump()
+    assert first_of(reader.get_block()) == 0
+    for b in range(1, 4): # The main loop falls behind while three more blocks arrive
+        assert reader.pump()
+    block = reader.get_block()
+    assert reader.overruns == 2 # Blocks 1 and 2, the DMA is already rewriting the buffer of block 2
+    assert first_of(block) == 3000 # The newest block
+    assert reader.get_block() is None
+    assert reader.taken == reader.filled == 4
+
+
+def test_discard_drops_ready_blocks():
+    reader = HostBlockReader(ramp(3), block_size=50, oversample=4)
+    reader.start()
+    reader.pump()
+    reader.pump()
+    reader.discard()
+    assert reader.get_block() is None
+    assert reader.overruns == 0
+    reader.pump()
+    assert first_of(reader.get_block()) == 2000
+
+
+def test_stopped_reader_produces_nothing():
+    reader = HostBlockReader(ramp(1))
+    assert not reader.pump()
+    assert reader.get_block() is None
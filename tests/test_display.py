@@ -0,0 +1,188 @@
+# Partial and background OLED updates, checked against an emulated panel fed from HostI2C
+import random
+
+from display import DirtyOLED, HostI2C, ScreenCache, WaveformRenderer
+from ssd1306 import SSD1306_I2C
+
+
+# Display RAM of an SSD1306 rebuilt from the recorded I2C transactions
+class Panel:
+    def __init__(self, i2c, width=128, pages=8):
+        self.i2c = i2c
+        self.width = width
+        self.ram = bytearray(width * pages)
+        self.commands = []
+
+    def replay(self):
+        for addr, data in self.i2c.log:
+            assert addr == 0x3C
+            if data[0] == 0x80: # One command byte
+                self.commands.append(data[1])
+                continue
+            assert data[0] == 0x40
+            col_lo, col_hi = self.commands[-5], self.commands[-4] # Last column and page windows
+            page_lo = self.commands[-2]
+            x, page = col_lo, page_lo
+            for byte in data[1:]:
+                self.ram[page * self.width + x] = byte
+                x += 1
+                if x > col_hi:
+                    x = col_lo
+                    page += 1
+        self.i2c.log.clear()
+
+
+def setup():
+    i2c = HostI2C()
+    oled = DirtyOLED(SSD1306_I2C(128, 64, i2c))
+    return i2c, oled, Panel(i2c)
+
+
+def draw_random(oled, rng):
+    for k in range(rng.randint(1, 6)):
+        oled.fill_rect(rng.randint(0, 127), rng.randint(0, 63), rng.randint(1, 40), rng.randint(1, 20), rng.randint(0, 1))
+
+
+def test_show_sends_only_changed_columns():
+    i2c, oled, panel = setup()
+    oled.show() # The first show sends the whole screen
+    assert i2c.sent == 6 * 2 + 1 + 1024
+    panel.replay()
+    i2c.sent = 0
+    oled.text("72 BPM", 10, 16)
+    oled.show()
+    assert i2c.sent == 6 * 2 + 1 + 48 # Page 2 only, columns 10 to 57
+    assert not oled.is_dirty()
+    panel.replay()
+    assert panel.ram == oled.buffer
+
+
+def test_random_drawing_matches_the_panel():
+    i2c, oled, panel = setup()
+    rng = random.Random(1)
+    for frame in range(50):
+        draw_random(oled, rng)
+        oled.show()
+        panel.replay()
+        assert panel.ram == oled.buffer
+
+
+def test_background_flush_matches_the_panel():
+    i2c, oled, panel = setup()
+    oled.background = True
+    rng = random.Random(2)
+    for frame in range(50):
+        draw_random(oled, rng)
+        oled.show()
+        for step in range(rng.randint(0, 3)): # Drawing goes on while the queue is only partly sent
+            oled.flush_step(rng.choice((16, 64, 128)))
+    oled.flush()
+    assert not oled.busy()
+    panel.replay()
+    assert panel.ram == oled.buffer
+
+
+def test_flush_step_keeps_a_partly_sent_page():
+    i2c, oled, panel = setup()
+    oled.background = True
+    oled.show() # Whole screen queued
+    assert oled.flush_step(100) # 100 of the 128 columns of page 0
+    assert oled.pending_lo[0] == 100
+    while oled.flush_step(128):
+        pass
+    assert not oled.busy()
+    panel.replay()
+    assert panel.ram == oled.buffer
+
+
+def test_host_i2c_transfer_time():
+    i2c = HostI2C(freq=400000)
+    i2c.writeto(0x3C, b"\x80\x21")
+    i2c.writevto(0x3C, (b"\x40", bytes(1024)))
+    assert i2c.log[1] == (0x3C, b"\x40" + bytes(1024))
+    assert i2c.sent == 2 + 1025
+    assert i2c.transfer_us() == (1027 + 4) * 9 * 1000000 // 400000
+    assert i2c.scan() == [0x3C]
+
+
+def test_waveform_redraws_few_columns():
+    i2c, oled, panel = setup()
+    oled.show()
+    panel.replay()
+    waveform = WaveformRenderer(oled)
+    rng = random.Random(3)
+    waveform.push(rng.randint(0, 55)) # The first point clears the plot area
+    oled.show()
+    panel.replay()
+    for i in range(300):
+        waveform.push(rng.randint(0, 55))
+        i2c.sent = 0
+        oled.show()
+        assert i2c.sent < 512 # A few columns on each page, never the whole 1 KB screen
+        panel.replay()
+    assert panel.ram == oled.buffer
+
+
+def test_waveform_clears_the_plot_area_once():
+    i2c, oled, panel = setup()
+    oled.text("PRESS SW1 BUTTON", 0, 30, 1) # Left by the previous screen
+    oled.text("LIVE", 0, 56, 1) # Below the plot area
+    waveform = WaveformRenderer(oled)
+    for y in (10, 12, 11):
+        waveform.push(y)
+    assert [oled.pixel(x, y) for x in range(3, 128) for y in range(56)] == [0] * 125 * 56
+    assert oled.pixel(0, 56) # Rows below the plot area are kept
+    text = oled.buffer[:]
+    waveform.reset()
+    oled.text("X", 64, 40, 1)
+    waveform.push(5) # A new trace clears again
+    assert not oled.pixel(64, 40)
+    assert oled.buffer[7 * 128:] == text[7 * 128:]
+
+
+def menu(oled, selected):
+    # Screen whose pages 2 and 5 depend on the selection
+    def render():
+        oled.fill(0)
+        oled.text("MENU", 0, 0, 1)
+        oled.text(("HR", "HRV")[selected], 0, 16, 1) # The stub font fills a cell per character
+        oled.text(">" if selected else " ", 0, 40, 1)
+        oled.text("BACK", 0, 56, 1)
+    return render
+
+
+def test_cached_screen_matches_a_fresh_render():
+    i2c, oled, panel = setup()
+    cache = ScreenCache(oled)
+    for selected in (0, 1):
+        cache.show(("menu", selected), menu(oled, selected))
+    oled.fill_rect(10, 20, 50, 30, 1) # Something else drawn in between
+    oled.show()
+    panel.replay()
+    for selected in (0, 1, 0):
+        cache.show(("menu", selected), menu(oled, selected))
+        panel.replay()
+        fresh = DirtyOLED(SSD1306_I2C(128, 64, HostI2C()))
+        menu(fresh, selected)()
+        assert oled.buffer == fresh.buffer
+        assert panel.ram == fresh.buffer
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_cached_screen_marks_only_changed_pages():
+    i2c, oled, panel = setup()
+    cache = ScreenCache(oled)
+    cache.show(("menu", 0), menu(oled, 0))
+    cache.show(("menu", 1), menu(oled, 1))
+    marked = []
+    mark = oled.mark
+    oled.mark = lambda x0, y0, x1, y1: (marked.append(y0 // 8), mark(x0, y0, x1, y1))
+    i2c.log.clear()
+    cache.show(("menu", 0), menu(oled, 0))
+    assert marked == [2, 5]
+    assert len([data for addr, data in i2c.log if data[0] == 0x40]) == 2 # One write per changed page
+    marked.clear()
+    cache.show(("menu", 0), menu(oled, 0))
+    assert marked == []
+    cache.invalidate("menu")
+    assert not cache.screens and not cache.order
@@ -0,0 +1,125 @@
+# Signal processing helpers
+import math
+import random
+
+import pytest
+
+from dsp import BandPassFilter, SlidingMinMax, parabolic_offset, COEF_BITS, INPUT_SHIFT
+
+
+def test_parabolic_offset_of_a_symmetric_peak_is_zero():
+    assert parabolic_offset(100, 110, 100) == 0.0
+    assert parabolic_offset(110, 110, 110) == 0.0
+
+
+def test_parabolic_offset_leans_to_the_larger_neighbour():
+    assert parabolic_offset(100, 110, 105) == pytest.approx(0.5 * -5 / -15)
+    assert 0 < parabolic_offset(100, 110, 105) <= 0.5
+    assert -0.5 <= parabolic_offset(108, 110, 90) < 0
+    assert parabolic_offset(100, 110, 110) == 0.5
+
+
+def test_parabolic_offset_without_a_maximum_is_zero():
+    assert parabolic_offset(110, 105, 101) == 0.0 # Would be +4.5 from the parabola
+    assert parabolic_offset(101, 105, 110) == 0.0
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 64, 750])
+def test_sliding_min_max_matches_brute_force(size):
+    rng = random.Random(size)
+    window = SlidingMinMax(size)
+    samples = []
+    for i in range(3000):
+        if rng.random() < 0.1: # Runs of equal values
+            value = samples[-1] if samples else 0
+        else:
+            value = rng.randint(-40000, 40000)
+        samples.append(value)
+        window.push(value)
+        latest = samples[-size:]
+        assert window.max() == max(latest)
+        assert window.min() == min(latest)
+
+
+def test_sliding_min_max_follows_monotonic_runs():
+    window = SlidingMinMax(10)
+    for value in range(100): # Rising: every push drops the whole max deque
+        window.push(value)
+        assert (window.min(), window.max()) == (max(value - 9, 0), value)
+    for value in range(99, -1, -1): # Falling: every push drops the whole min deque
+        window.push(value)
+    assert (window.min(), window.max()) == (0, 9)
+
+
+def test_sliding_min_max_reset():
+    window = SlidingMinMax(5)
+    assert not window.has_data()
+    for value in (5, 9, 1):
+        window.push(value)
+    window.reset()
+    window.push(3)
+    assert window.has_data()
+    assert (window.min(), window.max()) == (3, 3)
+
+
+def sine(frequency, amplitude=8000, seconds=20, sample_rate=250):
+    return [int(32768 + amplitude * math.sin(2 * math.pi * frequency * i / sample_rate)) for i in range(seconds * sample_rate)]
+
+
+def gain(frequency):
+    # Output amplitude over input amplitude, after the filter has settled
+    samples = sine(frequency)
+    band_pass = BandPassFilter()
+    band_pass.prime(samples[0])
+    output = [band_pass.process(sample) for sample in samples]
+    settled = output[len(output) // 2:]
+    return (max(settled) - min(settled)) / 2 / (8000 >> INPUT_SHIFT)
+
+
+def test_band_pass_gain():
+    for frequency in (1.0, 1.2, 2.0, 3.0): # Heart rate band
+        assert 0.9 < gain(frequency) < 1.05
+    assert gain(0.5) == pytest.approx(0.707, abs=0.05) # Corners at -3 dB
+    assert gain(5.0) == pytest.approx(0.707, abs=0.05)
+    assert gain(0.05) < 0.02 # Baseline drift
+    assert gain(40.0) < 0.03 # Noise above the band
+
+
+def test_prime_removes_the_start_up_transient():
+    primed = BandPassFilter()
+    primed.prime(45000)
+    assert [primed.process(45000) for i in range(500)] == [0] * 500
+    cold = BandPassFilter() # Starts from mid-scale, the step to 45000 rings for seconds
+    assert max(abs(cold.process(45000)) for i in range(500)) > 1000
+
+
+def test_band_pass_accumulators_stay_small_ints():
+    # MicroPython small ints hold 31 bits; rebuild each accumulator from the filter state
+    rng = random.Random(5)
+    signals = [[65535 if (i // period) % 2 else 0 for i in range(3000)] for period in (1, 2, 10, 100, 250, 500)]
+    for k in range(10):
+        signal = []
+        while len(signal) < 3000:
+            signal += [rng.choice((0, 65535))] * rng.randint(1, 400)
+        signals.append(signal)
+    largest = 0
+    for signal in signals:
+        f = BandPassFilter()
+        f.prime(signal[0])
+        for value in signal:
+            x = (value - 32768) >> INPUT_SHIFT
+            b0, b1, b2, a1, a2 = f.hp
+            terms = (b0 * x, b1 * f.hx1, b2 * f.hx2, -a1 * f.hy1, -a2 * f.hy2, f.h_err)
+            partial = 0
+            for term in terms:
+                partial += term
+                largest = max(largest, abs(partial), abs(term))
+            y = partial >> COEF_BITS
+            b0, b1, b2, a1, a2 = f.lp
+            terms = (b0 * y, b1 * f.lx1, b2 * f.lx2, -a1 * f.ly1, -a2 * f.ly2, f.l_err)
+            partial = 0
+            for term in terms:
+                partial += term
+                largest = max(largest, abs(partial), abs(term))
+            f.process(value)
+    assert largest < 2 ** 30
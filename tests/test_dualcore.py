@@ -0,0 +1,87 @@
+# Dual-core mode: core 1 runs on a host thread, core 0 collects its results through the FIFOs
+import time
+
+import pytest
+
+from firmware import make_pico, ppg, press_sw1
+
+
+def start(tmp_path, monkeypatch, dual_core):
+    pico = make_pico(tmp_path, monkeypatch)
+    pico.dual_core = dual_core
+    pico.sensor.source = ppg(60)
+    press_sw1(pico)
+    pico.handle_button_events() # Start HR measurement
+    assert pico.core1_running == dual_core
+    return pico
+
+
+def run(pico, samples):
+    for i in range(samples // 25):
+        pico.sensor_timer.fire(25)
+        while not pico.core1_done and pico.sensor_fifo.has_data(): # Let core 1 catch up
+            time.sleep(0.001)
+        while pico.process_sensor_data():
+            pass
+
+
+def stop(pico):
+    pico.stop_sensor_timer()
+    pico.process_core1_output() # Results core 1 produced before it stopped
+    while pico.process_sensor_data():
+        pass
+
+
+def results(pico):
+    return pico.count, pico.beats.count, pico.hrv.values(), pico.OLED_current_x
+
+
+def test_core1_hands_beats_and_samples_to_core0(tmp_path, monkeypatch):
+    single = start(tmp_path, monkeypatch, False)
+    run(single, 7500)
+    stop(single)
+
+    dual = start(tmp_path, monkeypatch, True)
+    run(dual, 7500)
+    stop(dual)
+    assert dual.core1_done and not dual.core1_running
+    assert dual.peak_handler == dual.calculate_hr
+    assert dual.beat_fifo.dropped() == 0 and dual.wave_fifo.dropped() == 0
+    assert results(dual) == results(single)
+    assert dual.beats.count > 30
+    assert dual.dual_core
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_core1_error_falls_back_to_single_core(tmp_path, monkeypatch):
+    pico = start(tmp_path, monkeypatch, True)
+    run(pico, 2500)
+    process_dsp = pico.process_dsp
+    def failing(sample):
+        raise ValueError("core 1 failed")
+    pico.process_dsp = failing
+    pico.sensor_timer.fire(1)
+    deadline = time.monotonic() + 1
+    while not pico.core1_done and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert pico.core1_done # Set by the finally block
+    pico.process_dsp = process_dsp
+
+    beats = pico.beats.count
+    run(pico, 2500) # Core 0 takes over
+    assert not pico.core1_running and not pico.dual_core
+    assert pico.peak_handler == pico.calculate_hr
+    assert pico.beats.count > beats
+
+
+def test_hanging_core1_is_given_up(tmp_path, monkeypatch):
+    pico = make_pico(tmp_path, monkeypatch)
+    pico.dual_core = True
+    pico.peak_handler = pico.beat_fifo.put
+    pico.core1_running = True
+    pico.core1_done = False # As if core 1 never left its loop
+    began = time.monotonic()
+    pico.stop_sensor_timer()
+    assert time.monotonic() - began < 1
+    assert not pico.dual_core
+    assert pico.peak_handler == pico.calculate_hr
@@ -0,0 +1,57 @@
+# Encoder turns are coalesced into one menu redraw per frame
+import time
+
+from firmware import make_pico
+
+
+def turn(pico, clockwise, times=1):
+    pico.b.value(0 if clockwise else 1) # Encoder B is low on a clockwise edge of A
+    for i in range(times):
+        pico.a.handler(pico.a)
+
+
+def test_burst_of_turns_gives_one_redraw(tmp_path, monkeypatch):
+    clock = [10000]
+    monkeypatch.setattr(time, "ticks_ms", lambda: clock[0])
+    pico = make_pico(tmp_path, monkeypatch)
+    pico.last_frame = clock[0] # A frame was just drawn
+    redraws = []
+    pico.display_main_menu = lambda: redraws.append(pico.option)
+
+    turn(pico, True, 3)
+    turn(pico, False)
+    clock[0] += 10
+    assert pico.handle_encoder_events()
+    assert redraws == [] # Within the frame interval
+    assert pico.option == 2 # The selection already follows every turn
+
+    clock[0] += 20
+    turn(pico, True, 5) # Clamped to the last item
+    assert pico.handle_encoder_events()
+    assert redraws == []
+    clock[0] += pico.frame_interval
+    assert not pico.handle_encoder_events()
+    assert redraws == [3] # One redraw with the net position
+    assert not pico.menu_redraw
+
+    clock[0] += 1000
+    turn(pico, True) # Already at the last item, nothing to redraw
+    pico.handle_encoder_events()
+    assert redraws == [3]
+    turn(pico, False, 2)
+    pico.handle_encoder_events()
+    assert redraws == [3, 1] # After a quiet period the first frame is drawn at once
+
+
+def test_redraws_are_capped_at_the_frame_rate(tmp_path, monkeypatch):
+    clock = [10000]
+    monkeypatch.setattr(time, "ticks_ms", lambda: clock[0])
+    pico = make_pico(tmp_path, monkeypatch)
+    redraws = []
+    pico.display_main_menu = lambda: redraws.append(pico.option)
+    for i in range(100): # One turn every 4 ms for 400 ms
+        turn(pico, i % 2 == 0)
+        pico.handle_encoder_events()
+        clock[0] += 4
+    assert len(redraws) <= 400 // pico.frame_interval + 1
+    assert len(redraws) >= 400 // pico.frame_interval - 1
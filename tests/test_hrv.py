@@ -0,0 +1,153 @@
+# HRV metrics of the online accumulator, checked against two-pass reference formulas
+import math
+import random
+import statistics
+
+import pytest
+
+from beats import PPI_MIN, PPI_MAX
+from hrv import HrvAccumulator, hrv_metrics, lf_hf, lomb_scargle, lomb_scargle_numpy, ppi_series, frequency_grid
+
+
+def ppis(count=300, seed=6):
+    # Resting rhythm around 800 ms with respiratory variation and some large jumps
+    rng = random.Random(seed)
+    values = []
+    for i in range(count):
+        ppi = 800 + 40 * math.sin(2 * math.pi * i / 4.5) + rng.gauss(0, 25)
+        if rng.random() < 0.05:
+            ppi += rng.choice((-150, 150))
+        values.append(int(ppi))
+    return values
+
+
+def diffs(values):
+    return [b - a for a, b in zip(values, values[1:])]
+
+
+def test_values_match_two_pass_reference():
+    values = ppis()
+    accumulator = HrvAccumulator()
+    for ppi in values:
+        accumulator.add(ppi)
+    d = diffs(values)
+    assert accumulator.values() == {
+            "mean_hr": int(statistics.fmean(60000 / ppi for ppi in values)),
+            "mean_ppi": int(statistics.fmean(values)),
+            "rmssd": int(math.sqrt(statistics.fmean(x * x for x in d))),
+            "sdnn": int(statistics.pstdev(values)),
+            }
+
+
+def test_values_of_no_and_one_beat():
+    accumulator = HrvAccumulator()
+    assert accumulator.values() == {"mean_hr": 0, "mean_ppi": 0, "rmssd": 0, "sdnn": 0}
+    accumulator.add(1000)
+    assert accumulator.values() == {"mean_hr": 60, "mean_ppi": 1000, "rmssd": 0, "sdnn": 0}
+
+
+def test_reset_forgets_all_beats():
+    accumulator = HrvAccumulator()
+    for ppi in ppis(50, seed=1):
+        accumulator.add(ppi)
+    accumulator.reset()
+    fresh = HrvAccumulator()
+    for ppi in ppis(80):
+        accumulator.add(ppi)
+        fresh.add(ppi)
+    assert accumulator.values() == fresh.values()
+    assert accumulator.metrics() == fresh.metrics()
+
+
+def reference_metrics(values):
+    # Extended metrics from their definitions, with the bins the device uses
+    d = diffs(values)
+    sdnn = statistics.pstdev(values)
+    sd1 = math.sqrt(statistics.pvariance(d) / 2) # Spread across the Poincare identity line
+    sd2 = math.sqrt(2 * sdnn ** 2 - sd1 ** 2) # Spread along it
+    clamped = [min(max(ppi, PPI_MIN), PPI_MAX) - PPI_MIN for ppi in values]
+    tri_bins = [x * 128 // 1000 for x in clamped] # 1/128 s bins
+    mode_bins = [x // 50 for x in clamped] # 50 ms bins for the stress index
+    mode_bin = min(statistics.multimode(mode_bins)) # Lowest bin on a tie, like the device
+    mode = (PPI_MIN + 50 * mode_bin + 25) / 1000
+    amplitude = 100 * mode_bins.count(mode_bin) / len(values)
+    spread = max(max(values) - min(values), 50) / 1000
+    return {
+            "pnn50": round(100 * sum(1 for x in d if abs(x) > 50) / len(d), 1),
+            "sd1": int(sd1),
+            "sd2": int(sd2),
+            "tri_index": round(len(values) / max(tri_bins.count(b) for b in set(tri_bins)), 1),
+            "stress_index": round(math.sqrt(amplitude / (2 * mode * spread)), 1),
+            }
+
+
+@pytest.mark.parametrize("seed", [6, 7, 8])
+def test_metrics_match_the_definitions(seed):
+    values = ppis(seed=seed)
+    accumulator = HrvAccumulator()
+    for ppi in values:
+        accumulator.add(ppi)
+    assert accumulator.metrics() == reference_metrics(values)
+
+
+def test_hrv_metrics_combines_values_and_metrics():
+    values = ppis()
+    result = hrv_metrics(values)
+    assert set(result) == {"mean_hr", "mean_ppi", "rmssd", "sdnn", "pnn50", "sd1", "sd2", "tri_index", "stress_index"}
+    assert {key: result[key] for key in reference_metrics(values)} == reference_metrics(values)
+
+
+def test_metrics_need_two_successive_differences():
+    accumulator = HrvAccumulator()
+    for ppi in (800, 850):
+        accumulator.add(ppi)
+    assert accumulator.metrics() == {}
+    assert hrv_metrics([800, 850]) == {"mean_hr": 72, "mean_ppi": 825, "rmssd": 50, "sdnn": 25}
+    accumulator.add(820)
+    assert accumulator.metrics() == reference_metrics([800, 850, 820])
+
+
+def test_out_of_range_ppis_go_to_the_edge_bins():
+    values = [250, 800, 810, 2500, 790]
+    accumulator = HrvAccumulator()
+    for ppi in values:
+        accumulator.add(ppi)
+    assert accumulator.metrics() == reference_metrics(values)
+
+
+def two_tone(seconds=300, lf=30, hf=50):
+    # PPIs around 1000 ms modulated by a 0.1 Hz sine of lf ms and a 0.25 Hz sine of hf ms, at the beat times
+    values = []
+    t = 0.0
+    while t < seconds:
+        ppi = 1000 + lf * math.sin(2 * math.pi * 0.1 * t) + hf * math.sin(2 * math.pi * 0.25 * t)
+        t += ppi / 1000
+        values.append(ppi)
+    return values
+
+
+def test_lf_hf_of_two_sines():
+    # A sine of amplitude A has power A**2 / 2: 450 ms^2 in LF and 1250 ms^2 in HF
+    result = lf_hf(two_tone())
+    assert result["lf"] == pytest.approx(450, rel=0.1)
+    assert result["hf"] == pytest.approx(1250, rel=0.1)
+    assert result["lf_hf"] == pytest.approx(0.36, abs=0.04)
+
+
+def test_lf_hf_numpy_matches():
+    pytest.importorskip("numpy")
+    values = two_tone()
+    times, centred = ppi_series(values)
+    f_min, df, count = frequency_grid(times[-1] - times[0])
+    scalar = lomb_scargle(times, centred, f_min, df, count)
+    vectorized = lomb_scargle_numpy(times, centred, f_min, df, count)
+    assert list(vectorized) == pytest.approx(scalar, rel=1e-6, abs=1e-6)
+    assert lf_hf(values, vectorized=True) == lf_hf(values)
+
+
+def test_lf_hf_of_short_and_constant_series():
+    zero = {"lf": 0, "hf": 0, "lf_hf": 0}
+    assert lf_hf([]) == zero
+    assert lf_hf([800]) == zero
+    assert lf_hf([800, 810, 790]) == zero
+    assert lf_hf([800] * 200) == zero
@@ -0,0 +1,102 @@
+# Streamed JSON and PUBLISH framing, compared with json.dumps() and the umqtt.simple client
+import json
+import random
+
+import pytest
+
+from jsonstream import JsonWriter, json_length
+from mqttsession import MqttSession
+from umqtt import simple
+
+
+VALUES = [
+    0, -1, 7, 10, -10, 99, 1000, -123456789, 2 ** 40,
+    1.5, -0.25, True, False, None, "", "abc", "quote \" and \\ and é",
+    [], {}, [1, 2, 3], {"a": 1}, [[], {}], {"nested": {"list": [1, [2, [3]]], "none": None}},
+    {"id": 123, "type": "RRI", "data": [812, 833, 790], "analysis": {"type": "readiness"}},
+]
+
+
+def stream(value, size=128):
+    out = bytearray()
+    chunks = []
+
+    def write(data):
+        chunks.append(len(data))
+        out.extend(data)
+
+    writer = JsonWriter(write, size)
+    writer.value(value)
+    writer.flush()
+    assert writer.written == len(out)
+    return bytes(out), chunks
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_writer_matches_json_dumps(value):
+    expected = json.dumps(value).encode()
+    assert stream(value)[0] == expected
+    assert json_length(value) == len(expected)
+
+
+def test_small_buffer_and_large_dataset():
+    rng = random.Random(4)
+    dataset = {"id": 9, "type": "RRI", "data": [rng.randint(300, 2000) for i in range(5000)], "analysis": {"type": "readiness"}}
+    expected = json.dumps(dataset).encode()
+    for size in (8, 16, 128):
+        out, chunks = stream(dataset, size)
+        assert out == expected
+        assert max(chunks) <= max(size, 11) # One buffer at a time, or a single longer string like "readiness"
+    assert json_length(dataset) == len(expected)
+
+
+def session_and_reference():
+    # A session on broker "a" and the upstream client on broker "b"
+    simple.brokers.clear()
+    session = MqttSession("a")
+    session.start()
+    reference = simple.MQTTClient("", "b")
+    reference.connect()
+    return session, simple.broker("a"), reference, simple.broker("b")
+
+
+@pytest.mark.parametrize("count", [0, 1, 20, 21, 5000, 40000]) # Remaining length of 1, 2 and 3 bytes
+def test_publish_framing_matches_umqtt(count):
+    session, broker, reference, reference_broker = session_and_reference()
+    dataset = {"id": 7, "type": "RRI", "data": [800 + i % 400 for i in range(count)], "analysis": {"type": "readiness"}}
+    for qos in (0, 1):
+        before = len(broker.wire)
+        result = session.publish("kubios-request", dataset, qos)
+        assert result == (session.pid if qos else True)
+        if qos:
+            reference.pid = session.pid - 1 # Same packet identifier
+        reference_before = len(reference_broker.wire)
+        reference.publish("kubios-request", json.dumps(dataset), qos=qos)
+        assert broker.wire[before:] == reference_broker.wire[reference_before:]
+    topic, payload, qos, pid = broker.published[-1]
+    assert json.loads(payload) == dataset
+    assert pid == session.pid
+
+
+def test_remaining_length_varint():
+    session, broker, reference, reference_broker = session_and_reference()
+    for size, header in ((127, b"\x30\x7f"), (128, b"\x30\x80\x01"), (16383, b"\x30\xff\x7f"), (16384, b"\x30\x80\x80\x01")):
+        before = len(broker.wire)
+        session.publish("t", b"x" * (size - 3)) # Topic length, topic and payload
+        assert broker.wire[before:before + len(header)] == header
+
+
+def test_puback_is_matched_by_packet_identifier():
+    session, broker, reference, reference_broker = session_and_reference()
+    broker.ack = False
+    first = session.publish("project", {"seq": 1}, qos=1)
+    second = session.publish("project", b"{\"seq\": 2}", qos=1)
+    assert (first, second) == (1, 2)
+    assert set(session.inflight) == {1, 2}
+    broker.socket.incoming += b"\x40\x02\x00\x02" # PUBACK for the second one only
+    session.poll()
+    assert session.take_acks() == [2]
+    assert set(session.inflight) == {1}
+    assert session.take_acks() == []
+    session.pid = 0xFFFF
+    assert session.publish("project", {}, qos=1) == 1 # Identifiers wrap around and skip 0
@@ -0,0 +1,70 @@
+# Kubios responses arrive for every device on one topic, only this device's awaited request is used
+import ujson
+
+from firmware import make_pico
+
+
+def setup(tmp_path, monkeypatch):
+    pico = make_pico(tmp_path, monkeypatch)
+    handled = []
+    pico.get_response_data_from_Kubios = lambda: handled.append(pico.kubios_response["id"])
+    return pico, handled
+
+
+def request(pico):
+    pico.kubios_request_id = pico.next_request_id()
+    pico.kubios_request.send(pico.kubios_request_id, {"id": pico.kubios_request_id}) # Kept pending while offline
+    return pico.kubios_request_id
+
+
+def respond(pico, request_id):
+    pico.mqtt_callback(b"kubios-response", ujson.dumps({"id": request_id, "data": {}}).encode())
+
+
+def test_request_ids_carry_the_device_id(tmp_path, monkeypatch):
+    pico, handled = setup(tmp_path, monkeypatch)
+    first = pico.next_request_id()
+    assert first >> 16 == pico.device_id
+    assert pico.next_request_id() == first + 1
+    pico.request_sequence = 0xFFFF
+    assert pico.next_request_id() == pico.device_id << 16 # The sequence wraps within its 16 bits
+
+
+def test_other_devices_responses_are_ignored(tmp_path, monkeypatch):
+    pico, handled = setup(tmp_path, monkeypatch)
+    request_id = request(pico)
+    other = ((pico.device_id ^ 1) << 16) | (request_id & 0xFFFF) # Same sequence number, another board
+    respond(pico, other)
+    assert handled == []
+    assert pico.kubios_request.waiting(request_id)
+    respond(pico, request_id)
+    assert handled == [request_id]
+
+
+def test_malformed_responses_are_dropped(tmp_path, monkeypatch):
+    pico, handled = setup(tmp_path, monkeypatch)
+    request_id = request(pico)
+    for msg in (b"{\"id\": ", b"\xff\xfe", b"[1, 2]", b"\"text\"", b"{\"data\": {}}", b""):
+        pico.mqtt_callback(b"kubios-response", msg)
+    assert handled == []
+    assert pico.kubios_request.waiting(request_id)
+
+
+def test_stale_and_repeated_responses_are_ignored(tmp_path, monkeypatch):
+    pico, handled = setup(tmp_path, monkeypatch)
+    cancelled = request(pico)
+    pico.kubios_request.cancel(cancelled) # The measurement was stopped
+    earlier = request(pico) # Still pending, but a newer measurement followed
+    current = request(pico)
+    assert pico.kubios_request.waiting(earlier) and pico.kubios_request.waiting(current)
+
+    respond(pico, cancelled)
+    respond(pico, earlier)
+    assert handled == []
+    assert not pico.kubios_request.waiting(earlier) # Answered, no more retries
+    assert pico.kubios_request.waiting(current) # Tracked on its own
+
+    respond(pico, current)
+    respond(pico, current) # Repeated by the broker
+    assert handled == [current]
+    assert not pico.kubios_request.waiting()
@@ -0,0 +1,78 @@
+# Measurements started and stopped with SW1, run through the polling main loop steps
+from firmware import make_pico, ppg, press_sw1
+
+
+PEAK_STATE = ("threshold", "max_value", "max_position", "before_max", "after_max", "after_max_pending", "previous_value")
+
+
+def run(pico, samples):
+    for i in range(samples // 25):
+        pico.sensor_timer.fire(25)
+        while pico.process_sensor_data():
+            pass
+
+
+def test_stop_resets_peak_detection(tmp_path, monkeypatch):
+    pico = make_pico(tmp_path, monkeypatch)
+    initial = [getattr(pico, name) for name in PEAK_STATE]
+    pico.sensor.source = ppg(60)
+    press_sw1(pico)
+    pico.handle_button_events() # Start HR measurement
+    run(pico, 2500)
+    while pico.max_value <= pico.threshold: # Stop in the middle of a peak
+        run(pico, 25)
+    press_sw1(pico)
+    pico.handle_button_events()
+    assert not pico.measurement_on
+    assert [getattr(pico, name) for name in PEAK_STATE] == initial
+
+    peaks = []
+    pico.peak_handler = lambda peak: peaks.append((peak, pico.count))
+    press_sw1(pico)
+    pico.handle_button_events() # Start again
+    run(pico, 2500)
+    assert peaks
+    for peak, count in peaks: # No peak from the previous measurement
+        assert pico.threshold_start <= peak <= count
+
+
+def measure(pico, option, batched):
+    # PPIs of 40 s of signal, fed through the block path in uneven chunks or one sample at a time
+    pico.option = option
+    pico.measurement_on = True
+    pico.mqtt_hrv.start()
+    samples = list(ppg(40))
+    if batched:
+        for start in range(0, len(samples), 37):
+            for sample in samples[start:start + 37]:
+                pico.sensor_fifo.put(sample)
+            while pico.process_sensor_data():
+                pass
+    else:
+        for sample in samples:
+            pico.process_sample(sample)
+    return pico.ppi_intervals, pico.count, pico.hrv.values()
+
+
+def test_block_processing_matches_per_sample_processing(tmp_path, monkeypatch):
+    for option in (0, 1):
+        per_sample = measure(make_pico(tmp_path, monkeypatch), option, False)
+        batched = measure(make_pico(tmp_path, monkeypatch), option, True)
+        assert batched == per_sample
+    assert len(per_sample[0]) > 40 # BASIC HRV collected the PPIs
+
+
+def test_live_ppg_replaces_the_instructions(tmp_path, monkeypatch):
+    pico = make_pico(tmp_path, monkeypatch)
+    pico.sensor.source = ppg(60)
+    press_sw1(pico)
+    pico.handle_button_events() # Start HR measurement
+    run(pico, 25)
+    assert pico.oled.pixel(0, 30) # The stop instructions are shown
+    while not pico.OLED_current_x:
+        run(pico, 25)
+    waveform = pico.PPG_waveform
+    for x in range(pico.oled_width): # Only the trace is left in the plot area
+        for y in range(waveform.height):
+            drawn = waveform.span_lo[x] <= y <= waveform.span_hi[x]
+            assert pico.oled.pixel(x, y) == drawn
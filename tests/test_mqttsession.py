@@ -0,0 +1,151 @@
+# MQTT session reconnects against the in-memory broker of the umqtt stand-in
+import time
+
+import mqttsession
+from firmware import make_pico
+from mqttsession import MqttSession, RequestTracker, BACKOFF, CONNECTED
+from umqtt import simple
+
+
+def setup(server="broker"):
+    simple.brokers.clear()
+    return MqttSession(server), simple.broker(server)
+
+
+def test_connect_is_bounded_by_the_timeout():
+    timeouts = []
+
+    class Client(simple.MQTTClient):
+        def connect(self, clean_session=True, timeout=None):
+            timeouts.append(timeout)
+            return simple.MQTTClient.connect(self, clean_session, timeout)
+
+    simple.brokers.clear()
+    session = MqttSession("broker", factory=Client)
+    assert session.start()
+    assert timeouts == [session.connect_timeout / 1000]
+
+
+def test_connect_falls_back_for_clients_without_a_timeout():
+    class OldClient(simple.MQTTClient):
+        def connect(self, clean_session=True):
+            return simple.MQTTClient.connect(self, clean_session)
+
+    simple.brokers.clear()
+    session = MqttSession("broker", factory=OldClient)
+    assert session.start()
+
+
+def test_failed_connect_backs_off():
+    session, broker = setup()
+    broker.reachable = False
+    assert not session.start()
+    assert session.state == BACKOFF
+    assert session.backoff == 2 * session.min_backoff
+    broker.reachable = True
+    session.retry_at = time.ticks_ms() # Retry due
+    session.poll(allow_connect=False) # Postponed
+    assert session.state == BACKOFF
+    session.poll()
+    assert session.state == CONNECTED
+    assert session.backoff == session.min_backoff
+
+
+def test_reconnect_waits_until_the_user_is_idle(tmp_path, monkeypatch):
+    pico = make_pico(tmp_path, monkeypatch)
+    broker = simple.broker(pico.BROKER_IP)
+    pico.mqtt_hrv.start(connect=False)
+    pico.encoder_fifo.put(1)
+    pico.handle_encoder_events() # The user turns the encoder
+    pico.flush_display()
+    pico.poll_mqtt()
+    assert broker.connections == 0 # Would block the menu
+    pico.last_input = time.ticks_add(time.ticks_ms(), -pico.reconnect_idle)
+    while pico.oled.busy() or pico.menu_redraw:
+        pico.handle_encoder_events()
+        pico.flush_display()
+    pico.last_mqtt_poll = time.ticks_add(time.ticks_ms(), -pico.mqtt_poll_interval)
+    pico.poll_mqtt()
+    assert broker.connections == 1
+    assert pico.mqtt_hrv.connected()
+
+
+# Session that records the publishes of a RequestTracker
+class FakeSession:
+    def __init__(self):
+        self.online = True
+        self.published = []
+
+    def publish(self, topic, msg, qos=0):
+        if not self.online:
+            return False
+        self.published.append((topic, msg))
+        return True
+
+    def status(self):
+        return "connected" if self.online else "offline"
+
+
+def tracker(monkeypatch, timeout=1000, retries=2):
+    clock = [5000]
+    monkeypatch.setattr(mqttsession, "ticks_ms", lambda: clock[0])
+    session = FakeSession()
+    return RequestTracker(session, "kubios-request", timeout, retries), session, clock
+
+
+def test_request_is_republished_after_the_timeout(monkeypatch):
+    requests, session, clock = tracker(monkeypatch)
+    requests.send(7, "payload")
+    assert session.published == [("kubios-request", "payload")]
+    clock[0] += 999
+    assert requests.poll() is None
+    assert len(session.published) == 1
+    clock[0] += 1
+    assert requests.poll() is None
+    assert session.published == [("kubios-request", "payload")] * 2
+    assert requests.waiting(7)
+
+
+def test_request_times_out_after_the_retries(monkeypatch):
+    requests, session, clock = tracker(monkeypatch, retries=2)
+    requests.send(7, "payload", topic="kubios-request-bin")
+    for attempt in range(2):
+        clock[0] += 1000
+        assert requests.poll() is None
+    assert session.published == [("kubios-request-bin", "payload")] * 3
+    clock[0] += 1000
+    assert requests.poll() == 7
+    assert not requests.waiting()
+    assert requests.poll() is None
+    assert len(session.published) == 3
+
+
+def test_offline_attempts_count_as_retries(monkeypatch):
+    requests, session, clock = tracker(monkeypatch, retries=1)
+    session.online = False
+    requests.send(7, "payload")
+    clock[0] += 1000
+    session.online = True
+    assert requests.poll() is None # Sent now that the session is back
+    assert session.published == [("kubios-request", "payload")]
+    clock[0] += 1000
+    assert requests.poll() == 7
+
+
+def test_response_and_cancel_stop_the_retries(monkeypatch):
+    requests, session, clock = tracker(monkeypatch)
+    for request_id in (1, 2, 3):
+        requests.send(request_id, "payload %d" % request_id)
+    assert requests.response(2)
+    assert not requests.response(2) # Answered already
+    assert not requests.response(9) # Another device's request
+    requests.cancel(3)
+    assert not requests.response(3)
+    clock[0] += 1000
+    assert requests.poll() is None
+    assert session.published[3:] == [("kubios-request", "payload 1")]
+    requests.cancel()
+    clock[0] += 10000
+    assert requests.poll() is None
+    assert len(session.published) == 4
+    assert not requests.waiting()
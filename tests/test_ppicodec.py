@@ -0,0 +1,145 @@
+# Binary PPI payloads: round trips, rejected payloads and the gateway translation to Kubios JSON
+import json
+import random
+
+import pytest
+
+import gateway
+from firmware import make_pico
+from ppicodec import encode, decode, encoded_size, kubios_dataset, DELTA_VARINT, FIXED_U16, HEADER_SIZE
+from umqtt import simple
+
+ENCODINGS = (DELTA_VARINT, FIXED_U16)
+
+
+def ppis(count=200, seed=4):
+    rng = random.Random(seed)
+    return [rng.randint(300, 2000) for i in range(count)]
+
+
+def test_round_trip():
+    for encoding in ENCODINGS:
+        for values in ([], [800], ppis(), [0, 0xFFFF, 0, 1]):
+            data = encode(0x12345678, values, encoding=encoding)
+            assert len(data) == encoded_size(values, encoding)
+            assert decode(data) == (0x12345678, "readiness", values)
+            assert decode(bytes(data)) == decode(data)
+
+
+def test_delta_sizes():
+    assert len(encode(1, [800, 863, 800])) == HEADER_SIZE + 2 + 1 + 1 # 2 bytes for the first value, 1 for each change within +-63 ms
+    assert len(encode(1, [800, 864])) == HEADER_SIZE + 2 + 2
+    assert len(encode(1, [0, 8191, 0])) == HEADER_SIZE + 1 + 2 + 2
+    assert len(encode(1, [0, 8192, 16385])) == HEADER_SIZE + 1 + 3 + 3 # Beyond +-8191 a third byte is used
+
+
+def test_deltas_beyond_the_two_byte_range():
+    values = [0, 8192, 0, 65535, 1, 100000, -100000, 2 ** 31]
+    assert decode(encode(7, values)) == (7, "readiness", values)
+    with pytest.raises(ValueError):
+        encode(7, [0x10000], encoding=FIXED_U16) # Does not fit the fixed format
+    with pytest.raises(ValueError):
+        encode(7, [-1], encoding=FIXED_U16)
+
+
+def test_encode_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        encode(1, [800], encoding=2)
+    with pytest.raises(ValueError):
+        encode(1, [800], analysis="stress")
+    with pytest.raises(ValueError):
+        encode(1 << 32, [800])
+    with pytest.raises(ValueError):
+        encode(-1, [800])
+    for encoding in ENCODINGS:
+        with pytest.raises(ValueError):
+            encode(1, [800] * 0x10000, encoding=encoding)
+        assert decode(encode(1, [800] * 0xFFFF, encoding=encoding))[2] == [800] * 0xFFFF
+
+
+def corrupt(data, position, value):
+    data = bytearray(data)
+    data[position] = value
+    return data
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_decode_rejects_bad_payloads(encoding):
+    data = encode(9, ppis(20), encoding=encoding)
+    bad = [
+        corrupt(data, 0, ord("X")), # Magic
+        corrupt(data, 2, 2), # Version
+        corrupt(data, 3, 7), # Encoding
+        corrupt(data, 4, 1), # Analysis type
+        data[:HEADER_SIZE - 1], # No complete header
+        data[:-1], # Truncated
+        data + b"\x00", # Over-long
+        corrupt(data, 9, 21), # Count larger than the PPIs
+        corrupt(data, 9, 19), # Count smaller than the PPIs
+        b"",
+    ]
+    for payload in bad:
+        with pytest.raises(ValueError):
+            decode(payload)
+
+
+def test_decode_rejects_an_unterminated_varint():
+    data = encode(9, [800])
+    with pytest.raises(ValueError):
+        decode(data[:-1] + bytes([data[-1] | 0x80]))
+
+
+# Stand-ins for the paho client and message given to gateway.on_message
+class Client:
+    def __init__(self):
+        self.published = []
+
+    def subscribe(self, topic):
+        self.subscribed = topic
+
+    def publish(self, topic, payload):
+        self.published.append((topic, payload))
+
+
+class Message:
+    def __init__(self, payload):
+        self.payload = payload
+
+
+def kubios_publish(pico, binary):
+    # What the device publishes for one Kubios request
+    broker = simple.broker(pico.BROKER_IP, 21883)
+    broker.published.clear()
+    pico.binary_ppi = binary
+    pico.request_sequence = 0
+    pico.connect_mqtt_kubios()
+    pico.create_kubios_request()
+    assert len(broker.published) == 1
+    topic, payload = broker.published[0][:2]
+    return topic.decode(), payload
+
+
+def test_gateway_gives_the_json_of_the_direct_request(tmp_path, monkeypatch):
+    pico = make_pico(tmp_path, monkeypatch)
+    pico.ppi_intervals = ppis(120)
+    topic, payload = kubios_publish(pico, False)
+    assert topic == gateway.JSON_TOPIC
+    binary_topic, binary = kubios_publish(pico, True)
+    assert binary_topic == gateway.BINARY_TOPIC
+    assert len(binary) < len(payload) // 2
+
+    client = Client()
+    gateway.on_connect(client, None, None, 0)
+    assert client.subscribed == gateway.BINARY_TOPIC
+    gateway.on_message(client, None, Message(binary))
+    assert len(client.published) == 1
+    assert client.published[0][0] == topic
+    assert json.loads(client.published[0][1]) == json.loads(payload)
+    assert kubios_dataset(binary) == json.loads(payload)
+
+
+def test_gateway_drops_bad_payloads():
+    client = Client()
+    gateway.on_message(client, None, Message(b"PI\x02"))
+    gateway.on_message(client, None, Message(bytes(encode(1, [800]))[:-1]))
+    assert client.published == []
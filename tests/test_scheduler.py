@@ -0,0 +1,90 @@
+# The firmware running as asyncio tasks on the host
+import asyncio
+
+from firmware import make_pico, ppg, press_sw1
+from fifo import Fifo
+from scheduler import AsyncFifo, Scheduler, Wakeup, wait_any, PRIORITY_HIGH
+from umqtt import simple
+
+
+def test_async_fifo_wakes_the_waiting_task():
+    async def run():
+        fifo = AsyncFifo(Fifo(10, typecode='i'))
+        reader = asyncio.create_task(fifo.get_async())
+        await asyncio.sleep(0)
+        fifo.put(42)
+        return await asyncio.wait_for(reader, 1)
+    assert asyncio.run(run()) == 42
+
+
+def test_wait_any_returns_on_timeout_or_data():
+    async def run():
+        wakeup = Wakeup()
+        fifos = (AsyncFifo(Fifo(10), wakeup), AsyncFifo(Fifo(10), wakeup))
+        await wait_any(fifos, 5) # Nothing arrives, returns after 5 ms
+        waiter = asyncio.create_task(wait_any(fifos, 10000))
+        await asyncio.sleep(0)
+        fifos[1].put(7) # The second FIFO wakes the task waiting for both
+        await asyncio.wait_for(waiter, 1)
+        return fifos[1].get()
+    assert asyncio.run(run()) == 7
+
+
+def test_idle_task_waits_for_its_fifo():
+    async def run():
+        fifo = AsyncFifo(Fifo(10, typecode='i'))
+        seen = []
+
+        def step():
+            if not fifo.has_data():
+                return False
+            seen.append(fifo.get())
+            return True
+
+        scheduler = Scheduler()
+        scheduler.add("reader", step, PRIORITY_HIGH, (fifo,))
+        main = asyncio.create_task(scheduler.main())
+        for value in range(5):
+            await asyncio.sleep(0.01)
+            fifo.put(value)
+        await asyncio.sleep(0.01)
+        scheduler.stop()
+        await main
+        return seen, scheduler
+    seen, scheduler = asyncio.run(run())
+    assert seen == [0, 1, 2, 3, 4]
+    assert scheduler.wakeups["reader"] == 5
+
+
+def test_basic_hrv_measurement_under_the_scheduler(tmp_path, monkeypatch):
+    import project_final_ver
+    pico = make_pico(tmp_path, monkeypatch)
+    pico.option = 1 # BASIC HRV
+    pico.sensor.source = ppg(45)
+    scheduler = project_final_ver.create_scheduler(pico)
+
+    async def sampler():
+        # Stands in for the Piotimer interrupt, 25 samples (100 ms of signal) per turn
+        await asyncio.sleep(0.05) # All tasks idle
+        press_sw1(pico)
+        while not pico.sensor_timer:
+            await asyncio.sleep(0)
+        while not pico.hrv_measurement:
+            if pico.sensor_timer:
+                pico.sensor_timer.fire(25)
+            await asyncio.sleep(0.001)
+        while pico.spool or pico.oled.busy(): # Let the network and display tasks finish
+            await asyncio.sleep(0.01)
+        scheduler.stop()
+
+    async def run():
+        await asyncio.wait_for(asyncio.gather(scheduler.main(), sampler()), 30)
+
+    asyncio.run(run())
+    assert pico.measurement_on
+    assert 70 <= pico.hrv_measurement["mean_hr"] <= 74
+    assert scheduler.wakeups["dsp"] > 0 and scheduler.wakeups["ui"] == 1 # Woken by the FIFOs
+    broker = simple.broker(pico.BROKER_IP)
+    assert broker.topics() == ["project"]
+    assert b'"mean_hr": %d' % pico.hrv_measurement["mean_hr"] in broker.published[0][1]
+    assert not pico.oled.busy()
@@ -0,0 +1,83 @@
+# Store-and-forward of HRV results with QoS 1, without ever waiting for the broker
+import errno
+import json
+import time
+
+import pytest
+
+from mqttsession import MqttSession, BACKOFF, BoundedSocket
+from spool import Spool
+from umqtt import simple
+
+
+def setup(tmp_path):
+    simple.brokers.clear()
+    session = MqttSession("broker")
+    session.start()
+    return session, simple.broker("broker"), Spool(str(tmp_path / "spool.txt"), limit=20)
+
+
+def seqs(broker):
+    return [json.loads(payload)["seq"] for topic, payload, qos, pid in broker.published]
+
+
+def test_messages_stay_until_acknowledged(tmp_path):
+    session, broker, spool = setup(tmp_path)
+    for i in range(7):
+        spool.add("project", {"mean_hr": 60 + i})
+    assert spool.drain(session) == 5 # Window of 5 messages in flight
+    assert seqs(broker) == [1, 2, 3, 4, 5]
+    assert len(spool) == 7 # Nothing removed before the PUBACKs are read
+    assert spool.drain(session) == 0
+    session.poll() # Reads the PUBACKs
+    assert spool.drain(session) == 2
+    assert len(spool) == 2
+    session.poll()
+    spool.drain(session)
+    assert len(spool) == 0
+    assert seqs(broker) == [1, 2, 3, 4, 5, 6, 7]
+    assert all(qos == 1 for topic, payload, qos, pid in broker.published)
+    assert len(Spool(spool.path)) == 0 # Saved after the removal
+
+
+def test_half_open_connection_times_out_and_resends(tmp_path):
+    session, broker, spool = setup(tmp_path)
+    broker.responsive = False # Writes succeed, no PUBACK ever comes back
+    spool.add("project", {"mean_hr": 70})
+    assert spool.drain(session) == 1 # Returns at once, the stand-in raises if a read would hang
+    session.poll()
+    assert session.connected()
+    pid = broker.published[0][3]
+    session.inflight[pid] = time.ticks_add(time.ticks_ms(), -session.ack_timeout)
+    session.poll()
+    assert session.state == BACKOFF
+    assert len(spool) == 1
+
+    broker.responsive = True
+    session.retry_at = time.ticks_ms()
+    session.poll() # Reconnects
+    assert session.connections == 2
+    assert spool.drain(session) == 1 # Sent again on the new connection
+    session.poll()
+    spool.drain(session)
+    assert len(spool) == 0
+    assert seqs(broker) == [1, 1] # The receiver drops the duplicate by its sequence number
+
+
+def test_publish_failure_keeps_the_message(tmp_path):
+    session, broker, spool = setup(tmp_path)
+    session.client.sock.close()
+    spool.add("project", {"mean_hr": 70})
+    assert spool.drain(session) == 0
+    assert session.state == BACKOFF
+    assert len(Spool(spool.path)) == 1
+
+
+def test_bounded_socket_keeps_its_timeout_in_blocking_mode():
+    sock = BoundedSocket(simple.HostSocket(simple.Broker()), 0.5)
+    sock.setblocking(False)
+    assert sock.read(1) is None
+    sock.setblocking(True) # umqtt.simple after check_msg()
+    with pytest.raises(OSError) as error:
+        sock.read(1)
+    assert error.value.errno == errno.ETIMEDOUT